@@ -0,0 +1,163 @@
+#========================================================
+#  Convert many chat files downloaded by TwitchDownloader to ass subtitles at once.
+#  The ban file and styles are loaded once, and files are converted in a pool of processes.
+#========================================================
+
+import contextlib, glob, io, os, sys, tempfile, time, multiprocessing, click
+from chat_to_subtitle import print
+import chat_to_subtitle
+
+
+# Return the chat files of directories (every *.json file, compressed or not) and glob patterns, without duplicates.
+def find_chat_files(inputs, ban_file=None):
+    chat_files = []
+
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            chat_files.extend(sorted(path for extension in ['', '.gz', '.bz2', '.xz'] for path in glob.glob(os.path.join(pattern, '*.json' + extension))))
+        else:
+            chat_files.extend(sorted(glob.glob(pattern)))
+
+    excluded = set() if ban_file is None else {os.path.abspath(ban_file)}
+    result = []
+
+    for chat_file in chat_files:
+        if os.path.abspath(chat_file) not in excluded:
+            excluded.add(os.path.abspath(chat_file))
+            result.append(chat_file)
+
+    return result
+
+
+# Return the subtitle file of a chat file: same name with .ass extension, in output_dir or next to it.
+# chat.json.gz -> chat.ass
+def get_output_file(input_file, output_dir=None):
+    name = chat_to_subtitle.split_file_name(os.path.basename(input_file))[0] + '.ass'
+    return os.path.join(output_dir or os.path.dirname(input_file), name)
+
+
+# Check if the output is newer than the chat file and the ban file.
+def is_up_to_date(input_file, output_file, ban_file=None):
+    try:
+        output_mtime = os.path.getmtime(output_file)
+    except OSError:
+        return False
+
+    sources = [input_file] if ban_file is None else [input_file, ban_file]
+    return all(os.path.getmtime(source) <= output_mtime for source in sources)
+
+
+# Options shared by every conversion of a worker process, set once by the pool initializer.
+worker_options = None
+
+
+def init_worker(options):
+    global worker_options
+    worker_options = options
+
+
+# Convert one file in a worker process. Return (input file, counters, seconds, error message).
+# The output is written to a temporary file, renamed only when the conversion succeeds: a partial
+# output would be newer than the chat file, and never converted again.
+def convert_one(task):
+    input_file, output_file = task
+    start = time.perf_counter()
+    fd, temp_file = tempfile.mkstemp(suffix='.ass', prefix='.tmp-', dir=os.path.dirname(output_file) or '.')
+    os.close(fd)
+
+    try:
+        # The per-file status lines would be interleaved between workers.
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = chat_to_subtitle.convert_file(input_file, temp_file, None, 0, 0, **worker_options)
+
+        os.replace(temp_file, output_file)
+
+    except SystemExit as e:
+        # Errors of the conversion functions end with sys.exit(message).
+        return input_file, {}, time.perf_counter() - start, str(e.code)
+
+    except Exception as e:
+        # Eg. a comment without commenter: only this file fails.
+        return input_file, {}, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    return input_file, stats, time.perf_counter() - start, None
+
+
+# INPUTS: directories (every *.json file in them) or glob patterns of chat files.
+@click.command()
+@click.argument('inputs', nargs=-1, required=True)
+@click.option('--output-dir', '-o', help='Directory of the output files. Default: next to each chat file.')
+@click.option('--ban-file', '-b', help='The ban comments and users file.')
+@click.option('--play-res-x', '-x', type=click.IntRange(1), default=854, help='Comment player\'s x resolution.')
+@click.option('--play-res-y', '-y', type=click.IntRange(1), default=480, help='Comment player\'s y resolution.')
+@click.option('--font-size', '-f', type=click.IntRange(1), default=36, help='Font size of comments.')
+@click.option('--visible-time', '-v', type=click.IntRange(1), default=7, help='Time in seconds that comments stay visibles.')
+@click.option('--comment-color', '-c', type=click.Choice(['White', 'Blue', 'Red', 'Green'], case_sensitive=False), default='White', callback=chat_to_subtitle.get_style, help='Color of comments displayed.')
+@click.option('--chat-cache', is_flag=True, help='Build a columnar cache of each input file next to it.')
+@click.option('--lane-policy', type=click.Choice(chat_to_subtitle.LANE_POLICIES), default='overlay', show_default=True, help='What to do with a comment when every lane is full.')
+@click.option('--retroactive', is_flag=True, help='Also delete the earlier comments of a user who writes a critical word.')
+@click.option('--jobs', '-j', type=click.IntRange(1), default=os.cpu_count() or 1, show_default=True, help='Number of files converted at the same time.')
+@click.option('--force', is_flag=True, help='Convert files whose output is already up to date.')
+def convert_batch(inputs, output_dir, ban_file, play_res_x, play_res_y, font_size, visible_time, comment_color, chat_cache, lane_policy, retroactive, jobs, force):
+    chat_to_subtitle.use_rich_output()
+    chat_files = find_chat_files(inputs, ban_file)
+
+    if len(chat_files) == 0:
+        sys.exit('No chat file found.')
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    tasks = []
+    for input_file in chat_files:
+        output_file = get_output_file(input_file, output_dir)
+
+        if not force and is_up_to_date(input_file, output_file, ban_file):
+            print(f'Up to date: {input_file}')
+            continue
+
+        tasks.append((input_file, output_file))
+
+    # Compiled once here, then sent once to each worker.
+    options = {
+        'play_res_x': play_res_x,
+        'play_res_y': play_res_y,
+        'font_size': font_size,
+        'visible_time': visible_time,
+        'comment_color': comment_color,
+        'chat_cache': chat_cache,
+        'lane_policy': lane_policy,
+        'retroactive': retroactive,
+        'ban_lists': chat_to_subtitle.compile_ban_lists(*chat_to_subtitle.load_ban_file(ban_file))
+    }
+
+    start = time.perf_counter()
+    total_comments = 0
+    failed = 0
+
+    with multiprocessing.Pool(max(1, min(jobs, len(tasks))), initializer=init_worker, initargs=(options,)) as pool:
+        for input_file, stats, seconds, error in pool.imap_unordered(convert_one, tasks):
+            if error is not None:
+                failed = failed + 1
+                print(f'Failed: {input_file}: {error}')
+                continue
+
+            comments = stats['in_range']
+            total_comments = total_comments + comments
+            print(f'Converted: {input_file}: {comments} comments in {seconds:.2f}s ({comments / max(seconds, 1e-9):.0f} comments/s)')
+
+    elapsed = time.perf_counter() - start
+
+    print(f'Files: {len(tasks) - failed} converted, {len(chat_files) - len(tasks)} up to date, {failed} failed')
+    print(f'Total: {total_comments} comments in {elapsed:.2f}s ({total_comments / max(elapsed, 1e-9):.0f} comments/s)')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    convert_batch()
@@ -0,0 +1,907 @@
+#========================================================
+#  Benchmarks for chat_to_subtitle.
+#  Run: python bench_chat_to_subtitle.py --help
+#========================================================
+
+import contextlib, hashlib, io, json, os, platform, sys, random, subprocess, tempfile, threading, time, tracemalloc, click
+from collections import deque
+from datetime import timedelta
+from itertools import islice
+import chat_to_subtitle
+import chat_converter
+
+
+# Words of the synthetic chat messages.
+ASCII_WORDS = ['gg', 'nice', 'lol', 'what', 'go go', 'clip it', 'no way', 'hello', 'first', 'F']
+CJK_WORDS = ['草', 'かわいい', 'すごい', '上手い', 'おつ', '888', '가자', '牛逼', 'ナイス']
+EMOTES = ['Kappa', 'PogChamp', 'LUL', 'KEKW', 'BibleThump', 'NotLikeThis', 'monkaS', 'OMEGALUL']
+W_RUNS = ['wwww', 'WWWWWW', 'ｗｗｗｗｗ', 'ＷＷＷＷ', 'wwwwwwwwwwww']
+
+
+# Synthetic chat settings.
+# cjk, emote and w_run are the probabilities of a CJK word, an emote or a 'wwww' run in a message.
+# repeat is the probability that a message is one of the last 50 messages again (emote spam, copypastas).
+# Hit rates are the fractions of comments that contain a word of a ban list, or come from a banned user.
+DEFAULT_CHAT = {
+    'per_second': 10,
+    'cjk': 0.3,
+    'emote': 0.3,
+    'w_run': 0.1,
+    'ban_size': 1000,
+    'word_hit_rate': 0.02,
+    'comment_hit_rate': 0.01,
+    'user_hit_rate': 0.01,
+    'critical_hit_rate': 0.001,
+    'users': 1000,
+    'repeat': 0.0,
+    'seed': 0
+}
+
+
+# Return the lists of a ban file with `size` words per word list, and size / 10 users and critical words.
+# The words are random letters, so that messages only contain them when a hit is generated.
+def generate_ban_lists(size, seed=0):
+    rng = random.Random(seed)
+
+    def words(count):
+        return [''.join(rng.choice('bcdfghjklmnpqrstvxz') for _ in range(rng.randint(6, 10))) for _ in range(count)]
+
+    return {
+        'word_only': words(size),
+        'whole_comment': words(size),
+        'user': [f'banned{i}' for i in range(max(1, size // 10))],
+        'critical_word': words(max(1, size // 10))
+    }
+
+
+# Yield (time, commenter id, commenter name, body) of a synthetic chat.
+def generate_chat(count, settings=None):
+    settings = dict(DEFAULT_CHAT, **(settings or {}))
+    rng = random.Random(settings['seed'])
+    ban_lists = generate_ban_lists(settings['ban_size'], settings['seed'])
+    hits = [
+        (settings['word_hit_rate'], ban_lists['word_only']),
+        (settings['comment_hit_rate'], ban_lists['whole_comment']),
+        (settings['critical_hit_rate'], ban_lists['critical_word'])
+    ]
+
+    recent = deque(maxlen=50)
+
+    for i in range(count):
+        if settings['repeat'] and recent and rng.random() < settings['repeat']:
+            body = rng.choice(recent)
+        else:
+            body = generate_message(rng, settings, hits)
+            recent.append(body)
+
+        if rng.random() < settings['user_hit_rate']:
+            user_id = name = rng.choice(ban_lists['user'])
+        else:
+            user = rng.randrange(settings['users'])
+            user_id, name = str(user), f'user{user}'
+
+        yield round(i / settings['per_second'], 3), user_id, name, body
+
+
+# Return a synthetic message (see generate_chat).
+def generate_message(rng, settings, hits):
+    words = []
+    for _ in range(rng.randint(1, 6)):
+        r = rng.random()
+        if r < settings['cjk']:
+            words.append(rng.choice(CJK_WORDS))
+        elif r < settings['cjk'] + settings['emote']:
+            words.append(rng.choice(EMOTES))
+        else:
+            words.append(rng.choice(ASCII_WORDS))
+
+    if rng.random() < settings['w_run']:
+        words.append(rng.choice(W_RUNS))
+
+    for rate, banned in hits:
+        if rng.random() < rate:
+            words.insert(rng.randint(0, len(words)), rng.choice(banned))
+
+    return ' '.join(words)
+
+
+# Build a comment shaped like the ones TwitchDownloader writes.
+# A compact comment only has the fields read by the converter.
+def make_comment(i, offset, body=None, user_id=None, name=None, compact=False):
+    if body is None:
+        body = f'comment number {i} ｗｗｗｗ Kappa'
+    if user_id is None:
+        user_id, name = str(i % 1000), f'user{i % 1000}'
+
+    if compact:
+        return {'content_offset_seconds': offset, 'commenter': {'_id': user_id, 'name': name}, 'message': {'body': body}}
+
+    return {
+        '_id': f'comment-{i}',
+        'created_at': '2022-01-01T00:00:00.000Z',
+        'channel_id': '12345',
+        'content_type': 'video',
+        'content_id': '67890',
+        'content_offset_seconds': offset,
+        'commenter': {
+            'display_name': name.capitalize(),
+            '_id': user_id,
+            'name': name,
+            'type': 'user',
+            'bio': None,
+            'created_at': '2020-01-01T00:00:00.000Z',
+            'updated_at': '2022-01-01T00:00:00.000Z',
+            'logo': 'https://static-cdn.jtvnw.net/user-default-pictures-uv/profile_image-300x300.png'
+        },
+        'source': 'chat',
+        'state': 'published',
+        'message': {
+            'body': body,
+            'bits_spent': 0,
+            'fragments': [{'text': body, 'emoticon': None}],
+            'is_action': False,
+            'user_badges': [{'_id': 'subscriber', 'version': '12'}],
+            'user_color': '#FF0000',
+            'emoticons': []
+        },
+        'more_replies': False
+    }
+
+
+# Yield synthetic comments (see generate_chat for the settings).
+def generate_comments(count, settings=None, compact=False):
+    for i, (offset, user_id, name, body) in enumerate(generate_chat(count, settings)):
+        yield make_comment(i, offset, body, user_id, name, compact)
+
+
+# Write a chat file with `count` comments without building it in memory.
+def write_chat_file(path, count, per_second=10, settings=None, compact=False):
+    settings = dict(settings or {}, per_second=per_second)
+
+    with open(path, mode='w', encoding="utf8") as f:
+        f.write('{"streamer": {"name": "streamer", "id": 1}, "video": {"start": 0, "end": %d}, "comments": [' % (count // per_second + 1))
+
+        for i, comment in enumerate(generate_comments(count, settings, compact)):
+            if i:
+                f.write(',')
+            json.dump(comment, f, ensure_ascii=False)
+
+        f.write(']}')
+
+
+# Write the ban file of a synthetic chat.
+def write_ban_file(path, settings=None):
+    settings = dict(DEFAULT_CHAT, **(settings or {}))
+
+    with open(path, mode='w', encoding="utf8") as f:
+        json.dump(generate_ban_lists(settings['ban_size'], settings['seed']), f)
+
+
+# Run a command and return (wall seconds, peak rss in MiB) of the child process.
+def run_measured(cmd, env=None):
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, env=env)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+
+    if proc.returncode != 0:
+        sys.exit(f'Command failed: {" ".join(cmd)}')
+
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+@click.group()
+def bench():
+    pass
+
+
+# Peak RSS of a full conversion against the input size.
+# The json.load column is the memory needed only to load the whole file at once.
+@bench.command()
+@click.option('--sizes', default='10000,50000,200000', show_default=True, help='Comma separated comment counts.')
+def memory(sizes):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_to_subtitle.py')
+
+    print(f'{"comments":>10} {"file MiB":>10} {"json.load MiB":>14} {"convert MiB":>12} {"convert s":>10}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'chat.json')
+        output_file = os.path.join(directory, 'chat.ass')
+
+        for count in [int(size) for size in sizes.split(',')]:
+            write_chat_file(input_file, count)
+            file_size = os.path.getsize(input_file) / 1024 / 1024
+
+            _, load_rss = run_measured([sys.executable, '-c', 'import json, sys; json.load(open(sys.argv[1], encoding="utf8"))', input_file])
+            convert_time, convert_rss = run_measured([sys.executable, script, '-i', input_file, '-o', output_file])
+
+            print(f'{count:>10} {file_size:>10.1f} {load_rss:>14.1f} {convert_rss:>12.1f} {convert_time:>10.2f}')
+
+
+# Ban list filtering: per-word loops against the compiled matchers.
+@bench.command()
+@click.option('--comments', default=500, show_default=True, help='Number of comments.')
+@click.option('--words', default=1000, show_default=True, help='Number of words in each ban list.')
+def ban(comments, words):
+    rng = random.Random(0)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(5, 10))) for _ in range(words * 2)]
+    banned_words = vocabulary[:words]
+    remove_words = vocabulary[words:]
+    bodies = [' '.join(rng.choice(vocabulary) if rng.random() < 0.01 else f'msg{rng.randint(0, 999)}' for _ in range(5)) for _ in range(comments)]
+    items = [{'message': {'body': body}} for body in bodies]
+
+    def run(banned, remove):
+        start = time.perf_counter()
+        result = [(chat_to_subtitle.is_banned_comment(item, banned), chat_to_subtitle.clean_up_comment(item['message']['body'], remove)) for item in items]
+        return time.perf_counter() - start, result
+
+    compile_start = time.perf_counter()
+    remover, matcher, _, _ = chat_to_subtitle.compile_ban_lists(remove_words, banned_words, [], [])
+    compile_time = time.perf_counter() - compile_start
+
+    loop_time, loop_result = run(banned_words, remove_words)
+    compiled_time, compiled_result = run(matcher, remover)
+
+    if loop_result != compiled_result:
+        sys.exit('Compiled matchers returned different results.')
+
+    print(f'{comments} comments, {words} banned words, {words} removed words')
+    print(f'word loops: {loop_time:.3f}s')
+    print(f'compiled:   {compiled_time:.3f}s (+ {compile_time:.3f}s to compile), {loop_time / compiled_time:.1f}x')
+
+
+
+# Lane layout throughput: placement cost must stay flat as the chat grows.
+@bench.command()
+@click.option('--sizes', default='100000,1000000', show_default=True, help='Comma separated comment counts.')
+@click.option('--per-second', default=30, show_default=True, help='Comments per second.')
+@click.option('--policy', type=click.Choice(chat_to_subtitle.LANE_POLICIES), default='overlay', show_default=True)
+def layout(sizes, per_second, policy):
+    rng = random.Random(0)
+
+    print(f'{"comments":>10} {"seconds":>8} {"comments/s":>12} {"dropped":>8} {"queued":>8}')
+
+    for count in [int(size) for size in sizes.split(',')]:
+        widths = [36 * rng.randint(1, 30) for _ in range(count)]
+        lanes = chat_to_subtitle.LaneLayout(854, 480, 36, 7, policy)
+
+        start = time.perf_counter()
+        for i, width in enumerate(widths):
+            lanes.place(i / per_second, width)
+        elapsed = time.perf_counter() - start
+
+        print(f'{count:>10} {elapsed:>8.2f} {count / elapsed:>12.0f} {lanes.dropped:>8} {lanes.queued:>8}')
+
+
+
+# Clip conversion time from the json file against the columnar chat cache.
+@bench.command()
+@click.option('--comments', default=200000, show_default=True, help='Number of comments (10 per second).')
+@click.option('--start-time', default='5:0:0', show_default=True, help='Start of the clip.')
+@click.option('--end-time', default='5:10:0', show_default=True, help='End of the clip.')
+def cache(comments, start_time, end_time):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_to_subtitle.py')
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'chat.json')
+        output_file = os.path.join(directory, 'chat.ass')
+        write_chat_file(input_file, comments)
+        clip = ['-i', input_file, '-o', output_file, '-s', start_time, '-e', end_time]
+
+        json_time, json_rss = run_measured([sys.executable, script] + clip)
+        build_time, _ = run_measured([sys.executable, script, '--chat-cache'] + clip)
+        cached_time, cached_rss = run_measured([sys.executable, script] + clip)
+
+        print(f'{comments} comments, clip {start_time} ~ {end_time}')
+        print(f'json:           {json_time:.2f}s {json_rss:.1f} MiB')
+        print(f'build cache:    {build_time:.2f}s ({os.path.getsize(input_file + ".chatcache") / 1024 / 1024:.1f} MiB cache, {os.path.getsize(input_file) / 1024 / 1024:.1f} MiB json)')
+        print(f'cached:         {cached_time:.2f}s {cached_rss:.1f} MiB')
+
+
+
+# Scaling of process_comments with the number of filter worker processes.
+@bench.command()
+@click.option('--comments', default=200000, show_default=True, help='Number of comments.')
+@click.option('--words', default=1000, show_default=True, help='Number of words in each ban list.')
+@click.option('--jobs', default='1,2,4,8', show_default=True, help='Comma separated worker counts.')
+def jobs(comments, words, jobs):
+    rng = random.Random(0)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(5, 10))) for _ in range(words * 2)]
+    chat = [make_comment(i, i / 10) for i in range(comments)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        ban_file = os.path.join(directory, 'ban.json')
+
+        with open(ban_file, mode='w', encoding="utf8") as f:
+            json.dump({'word_only': vocabulary[:words], 'whole_comment': vocabulary[words:], 'user': [], 'critical_word': []}, f)
+
+        results = {}
+        for count in [int(job) for job in jobs.split(',')]:
+            start = time.perf_counter()
+            results[count] = list(chat_to_subtitle.process_comments(chat, 0, 0, ban_file, 480, 36, jobs=count))
+            results[count] = (time.perf_counter() - start, results[count])
+
+    base_time, base_items = next(iter(results.values()))
+    print(f'{"jobs":>5} {"seconds":>8} {"speedup":>8}')
+
+    for count, (elapsed, items) in results.items():
+        if items != base_items:
+            sys.exit(f'{count} jobs returned different items.')
+
+        print(f'{count:>5} {elapsed:>8.2f} {base_time / elapsed:>8.2f}')
+
+
+
+# The Dialogue writer before DialogueSerializer: two timedelta per line and one write per line.
+def write_dialogues_legacy(items, font_size, output_file, visible_time, comment_color):
+    with open(output_file, mode='w', encoding="utf8") as f:
+        for item in items:
+            time = item['time']
+            td1 = str(timedelta(seconds=time)) + '.00'
+            td2 = str(timedelta(seconds = time + visible_time)) + '.00'
+            message = item['message']
+            y = item['y']
+            x2 = font_size * len(message) * -1
+            f.write(f'Dialogue: {item["layer"]},{td1},{td2},{comment_color},,0000,0000,0000,,{{\\move(854,{str(y)},{str(x2)},{str(y)})}}{message}\n')
+
+
+# Serialization of Dialogue lines: legacy writer against DialogueSerializer with batched writes.
+@bench.command()
+@click.option('--items', 'count', default=1000000, show_default=True, help='Number of items.')
+def serialize(count):
+    items = [{'time': i // 100, 'message': f'comment number {i} www', 'y': 36 * (i % 13), 'layer': 2} for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = os.path.join(directory, 'legacy.ass')
+        output_file = os.path.join(directory, 'chat.ass')
+
+        start = time.perf_counter()
+        write_dialogues_legacy(items, 36, legacy_file, 7, 'danmakuWhite')
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chat_to_subtitle.output_as_subtitle(items, 854, 480, 36, output_file, 7, 'danmakuWhite')
+        serializer_time = time.perf_counter() - start
+
+        with open(legacy_file, encoding="utf8") as f:
+            legacy_lines = f.read()
+        with open(output_file, encoding="utf8") as f:
+            output_lines = f.read().split('[Events]', 1)[1].split('\n', 2)[2]
+
+        if legacy_lines != output_lines:
+            sys.exit('The serializer wrote different lines for whole second times.')
+
+    print(f'{count} items')
+    print(f'legacy:     {legacy_time:.2f}s ({count / legacy_time:.0f} lines/s)')
+    print(f'serializer: {serializer_time:.2f}s ({count / serializer_time:.0f} lines/s), {legacy_time / serializer_time:.1f}x')
+
+
+
+# Accuracy and throughput of the message widths: font_size * len() against TextMeasure.
+# The reference widths are the advance widths of a font (characters it lacks use their East Asian Width).
+@bench.command()
+@click.option('--comments', default=1000000, show_default=True, help='Number of messages.')
+@click.option('--cjk', default=DEFAULT_CHAT['cjk'], show_default=True, help='Probability of a CJK word.')
+@click.option('--font-metrics', help='Reference font: a .ttf/.otf font (needs fontTools) or a json advance table.')
+def width(comments, cjk, font_metrics):
+    font_size = 36
+    messages = [body for _, _, _, body in generate_chat(comments, {'cjk': cjk})]
+
+    def run(measure):
+        start = time.perf_counter()
+        widths = [measure(message) for message in messages]
+        return time.perf_counter() - start, widths
+
+    length_time, length_widths = run(lambda message: font_size * len(message))
+    uncached_time, _ = run(chat_to_subtitle.TextMeasure(font_size, cache_size=0).measure)
+    cached_time, widths = run(chat_to_subtitle.TextMeasure(font_size).measure)
+
+    print(f'{comments} messages, {len(set(messages))} different')
+    print(f'{"":<16} {"seconds":>8} {"messages/s":>12} {"mean error":>11} {"max error":>10}')
+
+    if font_metrics is None:
+        errors = {}
+    else:
+        reference = chat_to_subtitle.TextMeasure(font_size, chat_to_subtitle.load_font_advances(font_metrics), cache_size=0).measure
+        reference_widths = [reference(message) for message in messages]
+        errors = {
+            name: [abs(w - r) / r for w, r in zip(results, reference_widths) if r]
+            for name, results in [('len', length_widths), ('measure', widths)]
+        }
+
+    for name, key, elapsed in [('len', 'len', length_time), ('measure', 'measure', uncached_time), ('measure cached', 'measure', cached_time)]:
+        line = f'{name:<16} {elapsed:>8.3f} {comments / elapsed:>12.0f}'
+
+        if key in errors:
+            line = line + f' {sum(errors[key]) / len(errors[key]):>10.1%} {max(errors[key]):>10.1%}'
+
+        print(line)
+
+
+# Stored comments of the Converter API (CommentRecord) against the TwitchDownloader dicts:
+# memory per comment, and items/s of Converter.iter_items against process_comments.
+@bench.command()
+@click.option('--comments', 'count', default=200000, show_default=True, help='Number of comments.')
+def api(count):
+    def measure_memory(build):
+        tracemalloc.start()
+        stored = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return stored, size / count
+
+    # The comments as json.load returns them.
+    dicts, dict_size = measure_memory(lambda: [json.loads(json.dumps(comment)) for comment in generate_comments(count)])
+    # Built from other dicts, so that the strings are not shared with the ones above.
+    records, record_size = measure_memory(lambda: [chat_to_subtitle.CommentRecord.from_comment(json.loads(json.dumps(comment))) for comment in generate_comments(count)])
+
+    converter = chat_to_subtitle.Converter()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        dict_items = list(chat_to_subtitle.process_comments(dicts, 0, 0, None, 480, 36))
+        dict_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    record_items = list(converter.iter_items(records))
+    record_time = time.perf_counter() - start
+
+    if dict_items != record_items:
+        sys.exit('The Converter returned different items.')
+
+    print(f'{count} comments')
+    print(f'{"":<22} {"bytes/comment":>14} {"items/s":>10}')
+    print(f'{"dicts, process_comments":<22} {dict_size:>14.0f} {count / dict_time:>10.0f}')
+    print(f'{"records, Converter":<22} {record_size:>14.0f} {count / record_time:>10.0f}')
+
+
+# Layout and serialization of the kept comments: item at a time against the NumPy batches of --vectorize.
+# Both outputs must be the same file.
+@bench.command()
+@click.option('--comments', 'count', default=10000000, show_default=True, help='Number of comments.')
+@click.option('--per-second', default=DEFAULT_CHAT['per_second'], show_default=True, help='Comments per second.')
+@click.option('--policy', type=click.Choice(chat_to_subtitle.LANE_POLICIES), default='overlay', show_default=True)
+def vectorize(count, per_second, policy):
+    kept = [(offset, body) for offset, _, _, body in generate_chat(count, {'per_second': per_second})]
+
+    def run(output_file, batched):
+        layout = chat_to_subtitle.LaneLayout(854, 480, 36, 7, policy)
+        text_measure = chat_to_subtitle.TextMeasure(36)
+        start = time.perf_counter()
+
+        if batched:
+            items = chat_to_subtitle.place_comments_batched(kept, 0, layout, text_measure)
+        else:
+            items = chat_to_subtitle.place_comments(kept, 0, layout.place, text_measure.measure)
+
+        chat_to_subtitle.output_as_subtitle(items, 854, 480, 36, output_file, 7, 'danmakuWhite', batched=batched)
+        elapsed = time.perf_counter() - start
+
+        with open(output_file, mode='rb') as f:
+            digest = hashlib.file_digest(f, 'sha256').hexdigest()
+
+        os.remove(output_file)
+        return elapsed, digest
+
+    with tempfile.TemporaryDirectory() as directory:
+        python_time, python_digest = run(os.path.join(directory, 'python.ass'), False)
+        numpy_time, numpy_digest = run(os.path.join(directory, 'numpy.ass'), True)
+
+    if python_digest != numpy_digest:
+        sys.exit('The vectorized path wrote a different file.')
+
+    print(f'{count} comments, {per_second}/s, {policy} policy: same output')
+    print(f'{"":<10} {"seconds":>8} {"comments/s":>12}')
+    print(f'{"python":<10} {python_time:>8.2f} {count / python_time:>12.0f}')
+    print(f'{"numpy":<10} {numpy_time:>8.2f} {count / numpy_time:>12.0f} {python_time / numpy_time:.1f}x')
+
+
+# Raw file whose reads and writes take as long as on a storage of `bandwidth` bytes per second.
+# The wait releases the GIL, like waiting for a network mount does.
+class SlowRawFile(io.RawIOBase):
+    def __init__(self, f, bandwidth):
+        self.f = f
+        self.bandwidth = bandwidth
+
+    def readable(self):
+        return self.f.readable()
+
+    def writable(self):
+        return self.f.writable()
+
+    def readinto(self, b):
+        size = self.f.readinto(b)
+        time.sleep(size / self.bandwidth)
+        return size
+
+    def write(self, b):
+        time.sleep(len(b) / self.bandwidth)
+        return self.f.write(b)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+# Return an open_text_file replacement for plain files on a storage of `bandwidth` bytes per second.
+def make_slow_open_text_file(bandwidth):
+    def open_text_file(path, mode='r', buffering=-1, newline=None):
+        raw = SlowRawFile(open(path, mode=mode + 'b', buffering=0), bandwidth)
+        size = io.DEFAULT_BUFFER_SIZE if buffering == -1 else buffering
+        buffered = io.BufferedReader(raw, size) if mode == 'r' else io.BufferedWriter(raw, size)
+        return io.TextIOWrapper(buffered, encoding='utf8', newline=newline)
+
+    return open_text_file
+
+
+# Wall time of a conversion on slow storage, with stages in sequence against the --pipeline threads.
+# The time of each stage alone is measured too: the pipeline should take about as long as the slowest one.
+@bench.command()
+@click.option('--comments', 'count', default=200000, show_default=True, help='Number of comments.')
+@click.option('--bandwidth', default=20, show_default=True, help='Read and write speed of the storage in MB/s.')
+def pipeline(count, bandwidth):
+    slow_open_text_file = make_slow_open_text_file(bandwidth * 1e6)
+
+    with tempfile.TemporaryDirectory() as directory:
+        chat_file = os.path.join(directory, 'chat.json')
+        ban_file = os.path.join(directory, 'ban.json')
+        output_file = os.path.join(directory, 'chat.ass')
+        write_chat_file(chat_file, count)
+        write_ban_file(ban_file)
+        ban_lists = chat_to_subtitle.compile_ban_lists(*chat_to_subtitle.load_ban_file(ban_file))
+
+        def convert(pipelined):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                chat_to_subtitle.convert_file(chat_file, output_file, None, 0, 0, 854, 480, 36, 7, 'danmakuWhite', ban_lists=ban_lists, pipeline=pipelined)
+            return time.perf_counter() - start
+
+        # What the reading stage does: read the text, without parsing it.
+        def read():
+            start = time.perf_counter()
+            with chat_to_subtitle.open_text_file(chat_file, buffering=chat_to_subtitle.READ_BUFFER_SIZE) as f:
+                for _ in iter(lambda: f.read(chat_to_subtitle.READ_BUFFER_SIZE), ''):
+                    pass
+            return time.perf_counter() - start
+
+        def write():
+            with open(output_file, encoding="utf8") as f:
+                text = f.read()
+
+            start = time.perf_counter()
+            with chat_to_subtitle.open_text_file(output_file, mode='w', buffering=chat_to_subtitle.WRITE_BUFFER_SIZE) as f:
+                f.write(text)
+            return time.perf_counter() - start
+
+        process_time = convert(False) # Fast storage: parsing, processing and formatting.
+        original = chat_converter.open_text_file
+
+        try:
+            chat_converter.open_text_file = slow_open_text_file
+            read_time = read()
+            write_time = write()
+            sequential_time = convert(False)
+            pipeline_time = convert(True)
+        finally:
+            chat_converter.open_text_file = original
+
+        input_size = os.path.getsize(chat_file) / 1e6
+        output_size = os.path.getsize(output_file) / 1e6
+
+    print(f'{count} comments, {input_size:.0f} MB in, {output_size:.0f} MB out, storage at {bandwidth} MB/s')
+    print(f'{"read (slow storage)":<26} {read_time:>8.2f}s')
+    print(f'{"write (slow storage)":<26} {write_time:>8.2f}s')
+    print(f'{"convert (fast storage)":<26} {process_time:>8.2f}s')
+    print(f'{"sequential":<26} {sequential_time:>8.2f}s')
+    print(f'{"pipeline":<26} {pipeline_time:>8.2f}s {sequential_time / pipeline_time:.1f}x')
+
+
+# Latency of --follow: time from a line appended to the feed to its Dialogue line in the output file.
+@bench.command()
+@click.option('--rate', default=500, show_default=True, help='Comments per second written to the feed.')
+@click.option('--seconds', default=5, show_default=True, help='Duration of the feed.')
+def follow(rate, seconds):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_to_subtitle.py')
+    count = rate * seconds
+    latencies = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        feed = os.path.join(directory, 'feed.jsonl')
+        output_file = os.path.join(directory, 'chat.ass')
+        open(feed, mode='w').close()
+
+        proc = subprocess.Popen([sys.executable, script, '-i', feed, '-o', output_file, '--follow', '--follow-timeout', '2', '--lane-policy', 'overlay'], stdout=subprocess.DEVNULL)
+
+        # The message is 'sent <monotonic time in microseconds>'.
+        def monitor():
+            while not os.path.exists(output_file):
+                time.sleep(0.001)
+
+            with open(output_file, encoding="utf8") as f:
+                pending = ''
+                while len(latencies) < count and proc.poll() is None:
+                    line = f.readline()
+
+                    if not line:
+                        time.sleep(0.001)
+                        continue
+
+                    pending = pending + line
+                    if pending.endswith('\n'):
+                        if pending.startswith('Dialogue:'):
+                            sent = int(pending.rsplit('sent ', 1)[1])
+                            latencies.append(time.monotonic() - sent / 1e6)
+                        pending = ''
+
+        thread = threading.Thread(target=monitor)
+        thread.start()
+        time.sleep(0.5) # Interpreter startup of the converter.
+
+        with open(feed, mode='a', encoding="utf8") as f:
+            start = time.monotonic()
+
+            for i in range(count):
+                # Keep the rate: sleep until the time of comment i.
+                delay = start + i / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                f.write(json.dumps({'content_offset_seconds': i / rate, 'commenter': {'_id': '1', 'name': 'user'}, 'message': {'body': f'sent {int(time.monotonic() * 1e6)}'}}) + '\n')
+                f.flush()
+
+        thread.join()
+        proc.wait()
+
+    latencies.sort()
+    if not latencies:
+        sys.exit('No comment was written.')
+
+    print(f'{len(latencies)} of {count} comments at {rate}/s')
+    print(f'latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms, max: {latencies[-1] * 1000:.1f} ms')
+
+
+
+# Stages of the conversion timed by the suite, and the whole conversion.
+STAGES = ['load', 'filter', 'normalize', 'layout', 'serialize', 'end_to_end']
+
+
+# Time each stage of the conversion of a chat file, chunk by chunk so that memory stays bounded.
+# The stages call the same functions as process_comments and output_as_subtitle.
+def time_stages(input_file, ban_file, output_file, chunk_size=10000):
+    timings = dict.fromkeys(STAGES, 0.0)
+    remove_words, banned_words, banned_users, critical_words = chat_to_subtitle.compile_ban_lists(*chat_to_subtitle.load_ban_file(ban_file))
+    moderation = chat_to_subtitle.Moderation()
+    layout = chat_to_subtitle.LaneLayout(854, 480, 36, 7)
+    measure = chat_to_subtitle.TextMeasure(36).measure
+    serializer = chat_to_subtitle.DialogueSerializer(854, 36, 7, 'danmakuWhite')
+    files = chat_to_subtitle.SegmentFiles(output_file, chat_to_subtitle.make_subtitle_header(854, 480, 36))
+    comments = chat_to_subtitle.iter_json_comments(input_file)
+
+    while True:
+        start = time.perf_counter()
+        chunk = list(islice(comments, chunk_size))
+        timings['load'] += time.perf_counter() - start
+
+        if not chunk:
+            break
+
+        start = time.perf_counter()
+        chunk = [comment for comment in chunk if moderation.judge(comment['content_offset_seconds'], chat_to_subtitle.get_ban_category(comment, banned_words, banned_users, critical_words), (comment['commenter']['_id'], comment['commenter']['name'])) is None]
+        timings['filter'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        messages = [(comment['content_offset_seconds'], remove_words.normalize(comment['message']['body'])[0]) for comment in chunk]
+        timings['normalize'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        items = []
+        for offset, message in messages:
+            if message:
+                width = measure(message)
+                placement = layout.place(offset, width)
+                if placement is not None:
+                    items.append({'time': placement[0], 'message': message, 'y': placement[1], 'layer': placement[2], 'width': width})
+        timings['layout'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for item in items:
+            files.write(0, serializer.format(item, item['time']))
+        timings['serialize'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    files.close()
+    timings['serialize'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        chat_to_subtitle.convert_file(input_file, output_file, ban_file, 0, 0, 854, 480, 36, 7, 'danmakuWhite')
+    timings['end_to_end'] = time.perf_counter() - start
+
+    return timings
+
+
+# Return the stages of `results` whose comments/s dropped by more than `threshold` from `baseline`.
+def find_regressions(results, baseline, threshold):
+    regressions = []
+
+    for size, stages in results['runs'].items():
+        for stage, result in stages.items():
+            base = baseline.get('runs', {}).get(size, {}).get(stage)
+
+            if base and result['per_second'] < base['per_second'] * (1 - threshold):
+                regressions.append(f'{size} comments, {stage}: {result["per_second"]:.0f}/s, baseline {base["per_second"]:.0f}/s')
+
+    return regressions
+
+
+# Benchmark suite: time each stage on synthetic chats of several sizes.
+# Results can be saved as json, and compared with a saved baseline (exit status 1 on regression).
+@bench.command()
+@click.option('--sizes', default='10000', show_default=True, help='Comma separated comment counts, eg. 10000,1000000,10000000.')
+@click.option('--per-second', default=DEFAULT_CHAT['per_second'], show_default=True, help='Comments per second.')
+@click.option('--cjk', default=DEFAULT_CHAT['cjk'], show_default=True, help='Probability of a CJK word.')
+@click.option('--emote', default=DEFAULT_CHAT['emote'], show_default=True, help='Probability of an emote.')
+@click.option('--w-run', default=DEFAULT_CHAT['w_run'], show_default=True, help='Probability of a wwww run in a message.')
+@click.option('--ban-size', default=DEFAULT_CHAT['ban_size'], show_default=True, help='Words in each ban word list.')
+@click.option('--word-hit-rate', default=DEFAULT_CHAT['word_hit_rate'], show_default=True, help='Fraction of messages with a word_only word.')
+@click.option('--comment-hit-rate', default=DEFAULT_CHAT['comment_hit_rate'], show_default=True, help='Fraction of messages with a whole_comment word.')
+@click.option('--user-hit-rate', default=DEFAULT_CHAT['user_hit_rate'], show_default=True, help='Fraction of comments from banned users.')
+@click.option('--save', help='Save the results to this json file.')
+@click.option('--baseline', help='Compare the results with this saved json file.')
+@click.option('--threshold', default=0.2, show_default=True, help='Maximum comments/s drop from the baseline, as a fraction.')
+def suite(sizes, per_second, cjk, emote, w_run, ban_size, word_hit_rate, comment_hit_rate, user_hit_rate, save, baseline, threshold):
+    settings = dict(DEFAULT_CHAT, per_second=per_second, cjk=cjk, emote=emote, w_run=w_run, ban_size=ban_size,
+                    word_hit_rate=word_hit_rate, comment_hit_rate=comment_hit_rate, user_hit_rate=user_hit_rate)
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'settings': settings, 'runs': {}}
+
+    print(f'{"comments":>10} ' + ' '.join(f'{stage:>14}' for stage in STAGES) + '   (comments/s)')
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'chat.json')
+        ban_file = os.path.join(directory, 'ban.json')
+        output_file = os.path.join(directory, 'chat.ass')
+        write_ban_file(ban_file, settings)
+
+        for count in [int(size) for size in sizes.split(',')]:
+            write_chat_file(input_file, count, per_second, settings, compact=True)
+            timings = time_stages(input_file, ban_file, output_file)
+            results['runs'][str(count)] = {stage: {'seconds': seconds, 'per_second': count / max(seconds, 1e-9)} for stage, seconds in timings.items()}
+
+            print(f'{count:>10} ' + ' '.join(f'{count / max(timings[stage], 1e-9):>14.0f}' for stage in STAGES))
+
+    if save:
+        with open(save, mode='w', encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline, encoding="utf8") as f:
+            regressions = find_regressions(results, json.load(f), threshold)
+
+        for regression in regressions:
+            print(f'Regression: {regression}')
+
+        if regressions:
+            sys.exit(1)
+
+        print(f'No stage slower than the baseline by more than {threshold:.0%}.')
+
+
+# Normalization of message bodies: substitute_message then clean_up_comment (one string per step,
+# for every comment), against the fused and memoized WordRemover.normalize. The outputs must be identical.
+@bench.command()
+@click.option('--comments', 'count', default=1000000, show_default=True, help='Number of messages.')
+@click.option('--repeat', default=0.5, show_default=True, help='Probability that a message repeats one of the last 50 ones.')
+@click.option('--words', default=1000, show_default=True, help='Number of words in the word_only list.')
+def normalize(count, repeat, words):
+    settings = dict(DEFAULT_CHAT, repeat=repeat, ban_size=words)
+    bodies = [body for _, _, _, body in generate_chat(count, settings)]
+    patterns = generate_ban_lists(words, settings['seed'])['word_only']
+    remover = chat_to_subtitle.WordRemover(patterns)
+
+    start = time.perf_counter()
+    chained = [chat_to_subtitle.clean_up_comment(chat_to_subtitle.substitute_message(body), remover) for body in bodies]
+    chained_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fused = [remover.normalize(body)[0] for body in bodies]
+    fused_time = time.perf_counter() - start
+
+    if fused != chained:
+        sys.exit('The fused normalization gives a different output.')
+
+    info = remover.normalize.cache_info()
+    print(f'{count} messages, {len(set(bodies))} distinct, {len(patterns)} word_only words')
+    print(f'{"replace + sub + clean up":<26} {count / chained_time:>12.0f} messages/s')
+    print(f'{"fused and memoized":<26} {count / fused_time:>12.0f} messages/s {chained_time / fused_time:.1f}x, {info.hits / count:.0%} hits')
+
+
+# Modules that the engine only imports for the options that use them.
+LAZY_MODULES = ['asyncio', 'bz2', 'click', 'concurrent.futures', 'gzip', 'hashlib', 'html', 'lzma', 'mmap', 'multiprocessing', 'numpy', 'queue', 'random', 'rich', 'shutil', 'tempfile', 'tracemalloc', 'unicodedata']
+
+
+# Return the modules loaded by `import module` in a new interpreter, and the cumulative import
+# time in microseconds of the module and of the modules it imports directly (python -X importtime).
+def measure_imports(module, env=None):
+    script = f'import sys, {module}; print(chr(10).join(sys.modules))'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True, env=env, check=True)
+    entries = []
+
+    # import time: self [us] | cumulative | imported package. The imports of a module are listed
+    # before it, indented by 2 more spaces.
+    for line in proc.stderr.splitlines():
+        _, cumulative, name = line.split('|')
+
+        if cumulative.strip().isdigit():
+            entries.append(((len(name) - len(name.lstrip()) - 1) // 2, name.strip(), int(cumulative)))
+
+    end = entries.index(next(entry for entry in entries if entry[:2] == (0, module)))
+    start = max([i + 1 for i in range(end) if entries[i][0] == 0], default=0)
+    times = {name: cumulative for depth, name, cumulative in entries[start:end] if depth == 1}
+    times[module] = entries[end][2]
+
+    return proc.stdout.split(), times
+
+
+# Cold start: import time of the engine, and wall time of the command line for --help and a
+# conversion of a few comments (the median of several runs). The conversion is the default command
+# line: a new result cache each run (a miss, stored), then the same one (a hit), and --no-cache.
+# Exit status 1 when the default conversion takes more than the budget, when the engine imports
+# a module of LAZY_MODULES, or when the command line imports the engine before converting.
+@bench.command()
+@click.option('--runs', default=10, show_default=True, help='Number of runs of each command.')
+@click.option('--budget', default=0.3, show_default=True, help='Maximum wall time of the conversion in seconds.')
+def startup(runs, budget):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_to_subtitle.py')
+
+    # Measured as installed: with the bytecode of the engine cached.
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    # The first import writes the bytecode cache.
+    measure_imports('chat_converter', env)
+    modules, times = measure_imports('chat_converter', env)
+    eager = [module for module in LAZY_MODULES if module in modules]
+    
+    if 'chat_converter' in measure_imports('chat_to_subtitle', env)[0]:
+        eager.append('chat_converter (by chat_to_subtitle)')
+
+    print(f'import chat_converter: {times["chat_converter"] / 1000:.1f} ms, {len(modules)} modules')
+
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[1:11]:
+        print(f'  {name:<24} {cumulative / 1000:>8.1f} ms')
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, 'chat.json')
+        write_chat_file(input_file, 100)
+        convert = [sys.executable, script, '-i', input_file, '-o', os.path.join(directory, 'chat.ass')]
+        cache_homes = (os.path.join(directory, f'cache-{i}') for i in range(runs + 1))
+        
+        # Command, and function of the environment of each run.
+        commands = {
+            'python': ([sys.executable, '-c', 'pass'], lambda: env),
+            'import': ([sys.executable, '-c', 'import chat_converter'], lambda: env),
+            '--help': ([sys.executable, script, '--help'], lambda: env),
+            'convert': (convert, lambda: dict(env, XDG_CACHE_HOME=next(cache_homes))),
+            'cached': (convert, lambda: dict(env, XDG_CACHE_HOME=os.path.join(directory, 'cache'))),
+            '--no-cache': (convert + ['--no-cache'], lambda: env)
+        }
+        medians = {}
+
+        for name, (cmd, get_env) in commands.items():
+            seconds = sorted(run_measured(cmd, get_env())[0] for _ in range(runs + 1))
+            medians[name] = seconds[len(seconds) // 2]
+            print(f'{name:<10} {medians[name] * 1000:>8.1f} ms')
+
+    if eager:
+        print(f'Imported by the engine: {", ".join(eager)}')
+
+    if medians['convert'] > budget:
+        print(f'The conversion takes more than the budget of {budget * 1000:.0f} ms.')
+
+    if eager or medians['convert'] > budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench()
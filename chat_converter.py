@@ -0,0 +1,3009 @@
+#========================================================
+#  Convert twitch comments downloaded by TwitchDownloader to ass subtitle format.
+#  Conversion engine, without the command line (see chat_to_subtitle.py): only the modules
+#  of every conversion are imported here, the others (compression, hashing, asyncio,
+#  multiprocessing, numpy, rich...) by the options that use them.
+#========================================================
+
+# Todo:
+# - Exception handling (File not found,...)
+# - Add tests (use pytest)
+# - Add styles to comments (color, big, static)
+# - Smaller functions
+# - Make a class of arguments?
+
+
+import builtins, json, os, sys, re, contextlib, heapq, bisect, math, struct, time
+from array import array
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from chat_options import get_style, FORMAT_NAMES, LANE_POLICIES, RESULT_CACHE_DIR
+
+
+# Print function of the status lines: the builtin print, or rich.print (see use_rich_output).
+printer = builtins.print
+
+
+# Print a status line.
+def print(*objects, **options):
+    printer(*objects, **options)
+
+
+# Print the status lines with rich (colors) when stdout is a terminal and rich is installed.
+# Otherwise, eg. in the many short conversions of a script, rich is not even imported.
+def use_rich_output():
+    global printer
+    
+    if not sys.stdout.isatty():
+        return
+        
+    try:
+        from rich import print as rich_print
+    except ImportError:
+        return
+        
+    printer = rich_print
+
+
+# Escape the rich markup ('[bold]'...) of a text printed in a status line.
+def escape_markup(text):
+    if printer is builtins.print:
+        return text
+        
+    from rich.markup import escape
+    return escape(text)
+
+
+# Subtitle layer of the comments, and of the comments shown over a full screen.
+COMMENT_LAYER = 2
+OVERLAY_LAYER = 3
+
+
+# Convert one chat file to a subtitle file and return the comment counters.
+# ban_lists (from compile_ban_lists) can be passed instead of ban_file, to compile them only once for many files.
+# split_every (seconds) or split_into (number of files) writes the output in several files, in one pass.
+# With follow, the input file is a growing json lines feed and each comment is written as soon as it arrives.
+# A Profile collects the timings and counters of each stage (jobs must be 1).
+# With retroactive, the earlier comments of a user who writes a critical word are deleted too.
+# A DensityControl limits the comments kept after filtering.
+# font_advances (from load_font_advances) are the widths of the characters in the font of the player.
+# Every format in formats (keys of OUTPUT_FORMATS) is written from the same pass.
+# With vectorize, comments are laid out and written in batches of NumPy arrays (not with follow).
+# With pipeline, reading, processing and writing overlap in threads (see run_pipeline; not with follow nor a Profile, and jobs is 1).
+def convert_file(input_file, output_file, ban_file, start_time_in_seconds, end_time_in_seconds, play_res_x, play_res_y, font_size, visible_time, comment_color, chat_cache=False, jobs=1, lane_policy='overlay', ban_lists=None, split_every=0, split_into=1, follow=False, follow_timeout=0, profile=None, retroactive=False, density=None, font_advances=None, formats=('ass',), vectorize=False, pipeline=False):
+    stats = {} if profile is None else profile.comments
+    
+    if profile is not None:
+        profile.start()
+
+    if follow:
+        comments = follow_jsonl_comments(input_file, follow_timeout)
+    else:
+        # Load the comments of the input file (json with comments) from its cache, or stream them one at a time.
+        comments = load_comments(input_file, chat_cache)
+    
+    segment_length, segment_count = get_segments(input_file, comments, start_time_in_seconds, end_time_in_seconds, split_every, split_into)
+    
+    if pipeline:
+        # A process pool must not be forked from a stage thread while the others run.
+        jobs = 1
+        read, read_channel, comments = get_reading_stage(input_file, comments, start_time_in_seconds, end_time_in_seconds)
+    
+    # Process each comment and yield formatted items.
+    batch_size = LAYOUT_BATCH_SIZE if vectorize else 0
+    items = process_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, play_res_y, font_size, play_res_x, visible_time, lane_policy, jobs, ban_lists, stats, profile, retroactive, density, font_advances, batch_size)
+
+    # Write comments in the items to subtitle file.
+    try:
+        if pipeline:
+            items_channel = Channel()
+            
+            run_pipeline([
+                (read, None, read_channel),
+                (lambda: items_channel.send(items), read_channel, items_channel),
+                (lambda: output_as_subtitle(items_channel, play_res_x, play_res_y,  font_size, output_file, visible_time, comment_color, segment_length, segment_count, formats=formats, batched=vectorize), items_channel, None)
+            ])
+            
+        else:
+            output_as_subtitle(items, play_res_x, play_res_y,  font_size, output_file, visible_time, comment_color, segment_length, segment_count, live=follow, profile=profile, formats=formats, batched=vectorize)
+        
+    finally:
+        if profile is not None:
+            profile.stop()
+    
+    return stats
+
+
+# Pipeline of the conversion stages.
+#
+# Read, process and write run in their own threads, so that waiting for the disk (or a network
+# mount) while reading and writing overlaps the processing. The stages are connected by Channels:
+# bounded queues of batches, so that a fast stage waits for a slow one instead of piling up
+# comments or items in memory.
+
+# Values sent through a Channel at once, and batches a Channel holds.
+PIPELINE_BATCH_SIZE = 1024
+PIPELINE_QUEUE_SIZE = 16
+
+# Time in seconds a producer waits for room in a full Channel before checking if it was closed.
+PIPELINE_POLL_INTERVAL = 0.1
+
+
+# Bounded queue of values between a producer stage and a consumer stage.
+# The producer sends an iterable, the consumer iterates the channel.
+class Channel:
+    def __init__(self, batch_size=PIPELINE_BATCH_SIZE, queue_size=PIPELINE_QUEUE_SIZE):
+        import queue
+        
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.full = queue.Full
+        self.closed = False # Set by the consumer: nothing more will be read.
+        self.ended = False # Set by the producer: nothing more will be sent.
+
+    # Send the values of an iterable, then the end of the values.
+    # Stop early if the consumer closes the channel.
+    def send(self, values):
+        values = iter(values)
+        
+        try:
+            while True:
+                batch = list(islice(values, self.batch_size))
+                
+                if not batch or not self.put(batch):
+                    return
+                    
+        finally:
+            self.end()
+
+    # Wait for room in the queue and add a batch. Return False if the channel was closed.
+    def put(self, batch):
+        while not self.closed:
+            try:
+                self.queue.put(batch, timeout=PIPELINE_POLL_INTERVAL)
+                return True
+            except self.full:
+                pass
+                
+        return False
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            
+            if batch is None:
+                return
+                
+            yield from batch
+
+    # Send the end of the values, once. Also when the producer fails: the consumer ends,
+    # and the error is raised by run_pipeline.
+    def end(self):
+        if not self.ended:
+            self.ended = True
+            self.put(None)
+
+    def close(self):
+        self.closed = True
+
+
+# Text file whose chunks are read from a Channel (see read_text_chunks).
+class ChannelFile:
+    def __init__(self, text_channel):
+        self.chunks = iter(text_channel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    # Return the next chunk, whatever its size, or '' at the end of the file.
+    def read(self, size=-1):
+        return next(self.chunks, '')
+
+
+# Return the reading stage of a pipeline, its output Channel, and the comments it feeds to the processing stage.
+# A chat file is read ahead as text, parsed by the processing stage, so that the reading stage only
+# waits for the storage. Other comments (a ChatCache) are sent between start and end time.
+def get_reading_stage(input_file, comments, start_time_in_seconds, end_time_in_seconds):
+    if isinstance(comments, ChatCache):
+        channel = Channel()
+        return lambda: channel.send(select_time_range(comments, start_time_in_seconds, end_time_in_seconds)), channel, channel
+        
+    # At most PIPELINE_QUEUE_SIZE chunks are read ahead.
+    text_channel = Channel(batch_size=1)
+    return lambda: read_text_chunks(input_file, text_channel), text_channel, iter_json_comments(input_file, text_channel=text_channel)
+
+
+# Run a stage, and when it ends (even with an error raised before it sends anything), end its
+# output channel so that its consumer does not wait for it, and close its input channel so
+# that its producer does not wait for it.
+def run_stage(stage, input_channel, output_channel):
+    try:
+        stage()
+    finally:
+        if output_channel is not None:
+            output_channel.end()
+            
+        if input_channel is not None:
+            input_channel.close()
+
+
+async def run_stages(stages):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    
+    with ThreadPoolExecutor(len(stages)) as executor:
+        results = await asyncio.gather(*(loop.run_in_executor(executor, run_stage, *stage) for stage in stages), return_exceptions=True)
+        
+    # The error of the first stage that failed (eg. sys.exit of the reading stage).
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+# Run stages, (function, input Channel or None, output Channel or None), at the same time in threads, and wait for all of them.
+def run_pipeline(stages):
+    import asyncio
+    asyncio.run(run_stages(stages))
+
+
+# Return the segment length in seconds and the segment count (0: as many as needed) of a time split output.
+def get_segments(input_file, comments, start_time_in_seconds, end_time_in_seconds, split_every=0, split_into=1):
+    if split_into == 1:
+        return split_every, 0
+        
+    end_time = end_time_in_seconds or get_chat_end_time(input_file, comments)
+    
+    if end_time is None:
+        sys.exit(f'The length of {input_file} is unknown. Use --end-time or --split-every.')
+        
+    return math.ceil(max(end_time - start_time_in_seconds, 1) / split_into), split_into
+
+
+# Return the output file of a variant: chat.ass -> chat_1280x720_48_red_7.ass
+def get_variant_file_name(output_file, variant):
+    base, extension, compression = split_file_name(output_file)
+    color = variant['comment_color'].replace('danmaku', '').lower()
+    return f'{base}_{variant["play_res_x"]}x{variant["play_res_y"]}_{variant["font_size"]}_{color}_{variant["visible_time"]}{extension}{compression}'
+
+
+# Kept comments (times and messages) and options shared by the variants rendered in a process, set once by the pool initializer.
+variant_comments = None
+variant_options = None
+
+
+def init_variant_worker(comments, options):
+    global variant_comments, variant_options
+    variant_comments = comments
+    variant_options = options
+
+
+# Place and write the kept comments with the style and resolution of a variant. Return (output file, items, dropped).
+def render_variant(task):
+    variant, output_file = task
+    options = variant_options
+    times, messages = variant_comments
+    layout = LaneLayout(variant['play_res_x'], variant['play_res_y'], variant['font_size'], variant['visible_time'], options['lane_policy'])
+    measure = TextMeasure(variant['font_size'], options['font_advances']).measure
+    items = place_comments(zip(times, messages), options['start_time'], layout.place, measure)
+    
+    output_as_subtitle(items, variant['play_res_x'], variant['play_res_y'], variant['font_size'], output_file, variant['visible_time'], variant['comment_color'],
+                       options['segment_length'], options['segment_count'], formats=options['formats'])
+    
+    return output_file, len(times) - layout.dropped, layout.dropped
+
+
+# Convert one chat file to one subtitle file per variant (a dictionary of play_res_x, play_res_y,
+# font_size, comment_color and visible_time), see get_variant_file_name.
+# The comments are parsed, filtered and moderated once, then placed and written for each
+# variant; with jobs > 1, the variants are rendered in a pool of processes.
+# The other arguments are the same as convert_file. Return the comment counters.
+def convert_variants(input_file, output_file, ban_file, start_time_in_seconds, end_time_in_seconds, variants, chat_cache=False, jobs=1, lane_policy='overlay', ban_lists=None, split_every=0, split_into=1, retroactive=False, density=None, font_advances=None, formats=('ass',)):
+    comments = load_comments(input_file, chat_cache)
+    segment_length, segment_count = get_segments(input_file, comments, start_time_in_seconds, end_time_in_seconds, split_every, split_into)
+    moderation = Moderation()
+    
+    # The comments shared by every variant, in a compact form.
+    times = array('d')
+    messages = []
+    
+    for time, message in keep_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, moderation, jobs, ban_lists, None, retroactive, density):
+        times.append(time)
+        messages.append(message)
+        
+    print(f'Comments in range: {moderation.judged}')
+    print(f'Comments kept: {len(times)}')
+    print(f'Comments deleted: {moderation.deleted}')
+    
+    for category, count in moderation.counts.items():
+        if count:
+            print(f'  {category}: {count}')
+            
+    if density is not None:
+        print(f'Comments merged (duplicates): {density.merged}')
+        print(f'Comments dropped (rate limit): {density.rate_limited}')
+        print(f'Comments dropped (on screen limit): {density.screen_limited}')
+        
+    options = {
+        'start_time': start_time_in_seconds,
+        'lane_policy': lane_policy,
+        'font_advances': font_advances,
+        'segment_length': segment_length,
+        'segment_count': segment_count,
+        'formats': formats
+    }
+    if len(formats) == 1:
+        output_file = get_output_file_name(output_file, formats[0])
+        
+    tasks = [(variant, get_variant_file_name(output_file, variant)) for variant in variants]
+    
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        
+        with multiprocessing.Pool(min(jobs, len(tasks)), initializer=init_variant_worker, initargs=((times, messages), options)) as pool:
+            results = pool.map(render_variant, tasks)
+    else:
+        init_variant_worker((times, messages), options)
+        results = [render_variant(task) for task in tasks]
+        
+    for variant_file, item_count, dropped in results:
+        print(f'Written: {variant_file} ({item_count} comments, {dropped} dropped)')
+        
+    return {'in_range': moderation.judged, 'after': len(times), 'deleted': moderation.deleted, 'deleted_by': dict(moderation.counts),
+            'variants': {variant_file: {'after': item_count, 'dropped': dropped} for variant_file, item_count, dropped in results}}
+
+
+# Compressed files: module of each file name extension, and magic bytes at the start of the files.
+# The modules are imported with the first compressed file.
+COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma')]
+
+
+# Return the errors of a truncated or corrupted compressed file. LZMAError can only be
+# raised once an .xz file was opened, by lzma.
+def get_compression_errors():
+    lzma = sys.modules.get('lzma')
+    return (EOFError, OSError) if lzma is None else (EOFError, OSError, lzma.LZMAError)
+
+
+# Return the compression module of a file, from its extension or (for an existing file) its first bytes, or None.
+def get_compression(path, mode='r'):
+    name = COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+    
+    if name is None and mode == 'r':
+        with open(path, mode='rb') as f:
+            head = f.read(6)
+            
+        for magic, magic_name in COMPRESSION_MAGIC:
+            if head.startswith(magic):
+                name = magic_name
+                break
+                
+    return None if name is None else __import__(name)
+
+
+# Open a text file, compressed or not (see get_compression). Compressed files are
+# decompressed or compressed as a stream: there is never an uncompressed copy.
+def open_text_file(path, mode='r', buffering=-1, newline=None):
+    module = get_compression(path, mode)
+    
+    if module is None:
+        return open(path, mode=mode, encoding="utf8", buffering=buffering, newline=newline)
+        
+    return module.open(path, mode=mode + 't', encoding="utf8", newline=newline)
+
+
+# Split a file name in base, extension and compression extension: chat.ass.gz -> chat, .ass, .gz
+def split_file_name(path):
+    base, extension = os.path.splitext(path)
+    
+    if extension.lower() not in COMPRESSIONS:
+        return base, extension, ''
+        
+    base, inner_extension = os.path.splitext(base)
+    return base, inner_extension, extension
+
+
+# Load a json file (with comments data).
+def load_json_file(input_file):
+    try: 
+        with open_text_file(input_file) as f:
+            return json.load(f)
+            
+    except ValueError:
+        sys.exit(f'The {input_file} is not a json file.')
+        
+    except FileNotFoundError as e:
+        sys.exit(f'File {input_file} not found. Confirm the file name.')
+        
+    except get_compression_errors() as e:
+        sys.exit(f'Could not read {input_file}: {e}')
+
+
+# Skip JSON whitespace.
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+# Incremental reader over a json text file.
+# Only the unread part of the current chunk is kept in memory, and values are
+# decoded one at a time with the C json scanner.
+class JsonStream:
+    def __init__(self, f, chunk_size=65536):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    # Drop the consumed text and read at least `size` more characters.
+    def fill(self, size=0):
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        
+        chunk = self.f.read(max(size, self.chunk_size))
+        
+        if not chunk:
+            self.eof = True
+            return False
+        
+        self.buffer += chunk
+        return True
+
+    # Skip whitespace and return the next character without consuming it ('' at the end of file).
+    def peek(self):
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            
+            if not self.fill():
+                return ''
+
+    # Consume the next character, which must be one of `chars`.
+    def expect(self, chars):
+        c = self.peek()
+        
+        if c == '' or c not in chars:
+            raise ValueError(f'Expected {chars!r} at position {self.pos}, found {c!r}.')
+        
+        self.pos += 1
+        return c
+
+    # Decode the next json value.
+    # A value ending exactly at the end of the buffer may be truncated (eg. a number), so read more first.
+    def decode(self):
+        while True:
+            self.peek()
+            
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+                    
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            
+            # Double the buffer so that a long value is not rescanned once per chunk.
+            self.fill(len(self.buffer))
+
+
+# Yield the items of the array stored under `key` in the top level json object.
+# Other top level values are decoded and discarded one by one.
+def iter_json_array(stream, key):
+    stream.expect('{')
+    
+    if stream.peek() == '}':
+        return
+    
+    while True:
+        name = stream.decode()
+        
+        if not isinstance(name, str):
+            raise ValueError(f'Expected an object key at position {stream.pos}.')
+        
+        stream.expect(':')
+        
+        if name != key:
+            stream.decode()
+            
+        else:
+            stream.expect('[')
+            
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield stream.decode()
+                    
+                    if stream.expect(',]') == ']':
+                        break
+        
+        if stream.expect(',}') == '}':
+            return
+
+
+# Return the value of a top level key of a json file, or None.
+# Reading stops at stop_key, so that a large value after it (eg. comments) is never decoded.
+def read_json_value(input_file, key, stop_key):
+    try:
+        with open_text_file(input_file) as f:
+            stream = JsonStream(f)
+            stream.expect('{')
+            
+            while stream.peek() == '"':
+                name = stream.decode()
+                stream.expect(':')
+                
+                if name == key:
+                    return stream.decode()
+                    
+                if name == stop_key:
+                    return None
+                    
+                stream.decode()
+                
+                if stream.expect(',}') == '}':
+                    return None
+                    
+    except (OSError, ValueError):
+        return None
+        
+    return None
+
+
+# Return the end time of a chat in seconds: the end of the video (TwitchDownloader
+# writes it before the comments), else the last comment of a chat cache, else None.
+def get_chat_end_time(input_file, comments):
+    video = read_json_value(input_file, 'video', 'comments')
+    
+    if isinstance(video, dict):
+        for key in ['end', 'length']:
+            if isinstance(video.get(key), (int, float)):
+                return video[key]
+                
+    if isinstance(comments, ChatCache) and comments.last > 0:
+        return comments.all_offsets[comments.last - 1]
+        
+    return None
+
+
+# Size of the read buffer of a chat file. Large reads make few round trips to a network mount.
+READ_BUFFER_SIZE = 1 << 20
+
+
+# Exit with a message on the errors of reading a chat file.
+@contextlib.contextmanager
+def exit_on_read_errors(input_file):
+    try:
+        yield
+        
+    except ValueError:
+        sys.exit(f'The {input_file} is not a json file.')
+        
+    except FileNotFoundError as e:
+        sys.exit(f'File {input_file} not found. Confirm the file name.')
+        
+    except get_compression_errors() as e:
+        sys.exit(f'Could not read {input_file}: {e}')
+
+
+# Load the comments of a chat file one at a time.
+# Peak memory stays flat no matter how big the chat file is.
+# Compressed files are decompressed as they are read.
+# With a text_channel, the text of the file is read from it instead (see read_text_chunks).
+def iter_json_comments(input_file, chunk_size=65536, text_channel=None):
+    with exit_on_read_errors(input_file):
+        with open_text_file(input_file, buffering=READ_BUFFER_SIZE) if text_channel is None else ChannelFile(text_channel) as f:
+            yield from iter_json_array(JsonStream(f, chunk_size), 'comments')
+
+
+# Reading stage of a pipeline: send the text of a chat file in chunks of READ_BUFFER_SIZE characters.
+def read_text_chunks(input_file, text_channel):
+    with exit_on_read_errors(input_file):
+        with open_text_file(input_file, buffering=READ_BUFFER_SIZE) as f:
+            text_channel.send(iter(lambda: f.read(READ_BUFFER_SIZE), ''))
+
+
+# Columnar chat cache.
+#
+# Only the fields used by the conversion are kept, in one file opened with mmap:
+#   header: magic, size and mtime of the json file, comment count
+#   content_offset_seconds of each comment (float64, sorted)
+#   commenter of each comment (uint32 index in the commenters table)
+#   message offset table (count + 1 uint64 offsets into the message blob)
+#   message blob (utf8 bodies)
+#   commenters table (json list of [_id, name], each commenter once)
+# Arrays are stored in native byte order: a cache is local to the machine that built it.
+CACHE_SUFFIX = '.chatcache'
+CACHE_MAGIC = b'CHATC001'
+CACHE_HEADER = struct.Struct('=8sqqQ')
+
+
+# Round up to 8 bytes, so that every array starts aligned.
+def align(size):
+    return (size + 7) & ~7
+
+
+# Size and mtime of the json file, stored in the cache to tell if it is fresh.
+def get_source_stamp(input_file):
+    stat = os.stat(input_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Convert a chat file to a columnar cache, reading the json file once as a stream.
+def build_chat_cache(input_file, cache_file):
+    import shutil, tempfile
+    
+    stamp = get_source_stamp(input_file)
+    offsets = array('d')
+    commenter_index = array('I')
+    message_index = array('Q', [0])
+    commenters = {} # (_id, name) -> index in the commenters table
+    
+    directory = os.path.dirname(os.path.abspath(cache_file))
+    
+    with tempfile.TemporaryFile(dir=directory) as blob:
+        for comment in iter_json_comments(input_file):
+            offsets.append(comment['content_offset_seconds'])
+            
+            commenter = (comment['commenter']['_id'], comment['commenter']['name'])
+            commenter_index.append(commenters.setdefault(commenter, len(commenters)))
+            
+            body = comment['message']['body'].encode('utf8')
+            blob.write(body)
+            message_index.append(message_index[-1] + len(body))
+            
+        blob.flush()
+        count = len(offsets)
+        
+        # Sort once, so that time ranges can be found with bisect.
+        order = None
+        if any(offsets[i] > offsets[i + 1] for i in range(count - 1)):
+            order = sorted(range(count), key=offsets.__getitem__)
+            offsets = array('d', (offsets[i] for i in order))
+            commenter_index = array('I', (commenter_index[i] for i in order))
+        
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            try:
+                f.write(CACHE_HEADER.pack(CACHE_MAGIC, stamp[0], stamp[1], count))
+                f.write(offsets.tobytes())
+                f.write(commenter_index.tobytes())
+                f.write(bytes(align(f.tell()) - f.tell()))
+                
+                if order is None:
+                    f.write(message_index.tobytes())
+                    blob.seek(0)
+                    shutil.copyfileobj(blob, f)
+                    
+                else:
+                    sorted_index = array('Q', [0])
+                    for i in order:
+                        sorted_index.append(sorted_index[-1] + message_index[i + 1] - message_index[i])
+                    f.write(sorted_index.tobytes())
+                    
+                    if message_index[-1]:
+                        import mmap
+                        
+                        with mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                            for i in order:
+                                f.write(m[message_index[i]:message_index[i + 1]])
+                
+                f.write(bytes(align(f.tell()) - f.tell()))
+                f.write(json.dumps(list(commenters), ensure_ascii=False).encode('utf8'))
+                
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+                
+    # Readers never see a partly written cache.
+    os.replace(f.name, cache_file)
+
+
+# Comments of a columnar chat cache, decoded row by row on access.
+# A slice is a view on the same mmap; the time column is used for bisect without decoding rows.
+class ChatCache:
+    def __init__(self, cache_file):
+        import mmap
+        
+        with open(cache_file, mode='rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+        view = memoryview(self.mmap)
+        magic, self.source_size, self.source_mtime_ns, count = CACHE_HEADER.unpack_from(view)
+        
+        if magic != CACHE_MAGIC:
+            raise ValueError(f'{cache_file} is not a chat cache.')
+        
+        position = CACHE_HEADER.size
+        self.all_offsets = view[position:position + 8 * count].cast('d')
+        position = position + 8 * count
+        self.commenter_index = view[position:position + 4 * count].cast('I')
+        position = align(position + 4 * count)
+        self.message_index = view[position:position + 8 * (count + 1)].cast('Q')
+        position = position + 8 * (count + 1)
+        self.messages = view[position:position + self.message_index[count]]
+        self.commenters_position = align(position + self.message_index[count])
+        self.commenters = None # Loaded on first access.
+        self.views = [view, self.all_offsets, self.commenter_index, self.message_index, self.messages]
+        self.first = 0
+        self.last = count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Unmap the file (and every slice of it). Rows can not be read anymore.
+    def close(self):
+        for view in self.views:
+            view.release()
+            
+        self.mmap.close()
+        
+    @property
+    def offsets(self):
+        return self.all_offsets[self.first:self.last]
+
+    def __len__(self):
+        return self.last - self.first
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            rows = range(self.first, self.last)[key]
+            
+            if rows.step != 1:
+                raise ValueError('Chat cache slices must be contiguous.')
+                
+            view = object.__new__(ChatCache)
+            view.__dict__.update(self.__dict__)
+            view.first, view.last = rows.start, rows.stop
+            return view
+        
+        return self.get_row(range(self.first, self.last)[key])
+
+    def __iter__(self):
+        for i in range(self.first, self.last):
+            yield self.get_row(i)
+
+    # Rebuild a comment with the fields used by the conversion.
+    def get_row(self, i):
+        if self.commenters is None:
+            self.commenters = json.loads(str(self.mmap[self.commenters_position:], 'utf8'))
+            
+        _id, name = self.commenters[self.commenter_index[i]]
+        
+        return {
+            'content_offset_seconds': self.all_offsets[i],
+            'commenter': {'_id': _id, 'name': name},
+            'message': {'body': str(self.messages[self.message_index[i]:self.message_index[i + 1]], 'utf8')}
+        }
+
+    # Check that the json file did not change since the cache was built.
+    def is_fresh(self, input_file):
+        try:
+            return get_source_stamp(input_file) == (self.source_size, self.source_mtime_ns)
+        except OSError:
+            return False
+
+
+# Open the cache of a chat file, or return None if there is no fresh cache.
+def open_chat_cache(input_file, cache_file=None):
+    if cache_file is None:
+        cache_file = input_file + CACHE_SUFFIX
+        
+    try:
+        cache = ChatCache(cache_file)
+    except (OSError, ValueError, struct.error):
+        return None
+        
+    if not cache.is_fresh(input_file):
+        return None
+        
+    return cache
+
+
+# Return the comments of a chat file: from its cache when it is fresh, otherwise streamed from the json file.
+# If build_cache is set, (re)build the cache first.
+def load_comments(input_file, build_cache=False):
+    cache = open_chat_cache(input_file)
+    
+    if cache is None and build_cache and os.path.exists(input_file):
+        try:
+            build_chat_cache(input_file, input_file + CACHE_SUFFIX)
+            cache = open_chat_cache(input_file)
+            
+        except OSError as e:
+            print(f'Could not write the chat cache: {e}')
+            
+    if cache is not None:
+        return cache
+        
+    return iter_json_comments(input_file)
+
+
+# Seconds between two reads of a feed that has no new line.
+FOLLOW_POLL_INTERVAL = 0.02
+
+
+# Yield the comments of a growing json lines feed (one comment object per line) as they are appended.
+# A line is decoded once its newline is written. Stop after idle_timeout seconds without
+# a new line (0: never).
+def follow_jsonl_comments(input_file, idle_timeout=0, poll_interval=FOLLOW_POLL_INTERVAL):
+    try:
+        with open(input_file, mode='r', encoding="utf8", newline='') as f:
+            pending = '' # Line being written.
+            last_line_time = time.monotonic()
+            
+            while True:
+                line = f.readline()
+                
+                if line:
+                    pending = pending + line
+                    
+                    if pending.endswith('\n'):
+                        if pending.strip():
+                            yield json.loads(pending)
+                            
+                        pending = ''
+                        last_line_time = time.monotonic()
+                        
+                    continue
+                
+                if idle_timeout and time.monotonic() - last_line_time >= idle_timeout:
+                    if pending.strip():
+                        # Last line without newline.
+                        yield json.loads(pending)
+                        
+                    return
+                    
+                time.sleep(poll_interval)
+                
+    except ValueError:
+        sys.exit(f'The {input_file} contains a line that is not a json object.')
+        
+    except FileNotFoundError as e:
+        sys.exit(f'File {input_file} not found. Confirm the file name.')
+
+
+# Changed when the output of a conversion changes, so that older cached outputs are not used.
+RESULT_CACHE_VERSION = 3
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# Files whose hash is memoized in a file hash table.
+FILE_HASH_ENTRIES = 1000
+
+
+# Return the sha256 of a file.
+# With a hash_file (json table), the hash is memoized by path, size and modification time, so that
+# a large chat file is only read again when it changes. Only the FILE_HASH_ENTRIES last used are kept.
+def get_file_hash(path, hash_file=None):
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    path = os.path.abspath(path)
+    hashes = {}
+    
+    if hash_file is not None:
+        try:
+            with open(hash_file, encoding="utf8") as f:
+                hashes = json.load(f)
+        except (OSError, ValueError):
+            pass # No table yet, or a broken one: start a new one.
+            
+        entry = hashes.pop(path, None)
+        
+        if entry is not None and entry[:2] == stamp:
+            hashes[path] = entry # Last used.
+            return entry[2]
+            
+    import hashlib
+    digest = hashlib.sha256()
+    
+    with open(path, mode='rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+            
+    if hash_file is not None:
+        hashes[path] = stamp + [digest.hexdigest()]
+        
+        try:
+            os.makedirs(os.path.dirname(hash_file) or '.', exist_ok=True)
+            temp_file = f'{hash_file}.{os.getpid()}.tmp'
+            
+            with open(temp_file, mode='w', encoding="utf8") as f:
+                json.dump(dict(list(hashes.items())[-FILE_HASH_ENTRIES:]), f)
+                
+            os.replace(temp_file, hash_file)
+            
+        except OSError as e:
+            print(f'Could not store the file hash: {e}')
+            
+    return digest.hexdigest()
+
+
+# Return the content hash of a conversion: the input file, the ban file and the options that change the output.
+# The hashes of the files are memoized in hash_file if given (see get_file_hash).
+def get_result_key(input_file, ban_file, options, hash_file=None):
+    files = [None if path is None else get_file_hash(path, hash_file) for path in (input_file, ban_file)]
+    key = {'version': RESULT_CACHE_VERSION, 'options': options, 'files': files}
+    
+    import hashlib
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Directory of converted outputs named by their content hash, limited to max_bytes.
+# The modification time of an output is its last use, and the least recently used ones are removed first.
+# Outputs are copied both ways, never linked: an output file edited in place would change the cached output too.
+# A fetched output is copied next to output_file first, so a failed copy keeps the existing output.
+class ResultCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get_file_name(self, key):
+        return os.path.join(self.directory, key + '.ass')
+
+    # Table of the memoized hashes of the input files (see get_file_hash).
+    @property
+    def hash_file(self):
+        return os.path.join(self.directory, 'file_hashes.json')
+
+    # Copy the cached output of key to output_file. Return False if there is none.
+    def fetch(self, key, output_file):
+        import shutil
+        
+        cached_file = self.get_file_name(key)
+        directory, name = os.path.split(output_file)
+        temp_file = os.path.join(directory, f'.tmp-{os.getpid()}-{name}')
+        
+        try:
+            shutil.copyfile(cached_file, temp_file)
+            os.replace(temp_file, output_file)
+            os.utime(cached_file)
+            
+        except FileNotFoundError:
+            return False
+            
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            
+        return True
+
+    # Add output_file to the cache, then remove the least recently used outputs over the size limit.
+    # An output larger than the limit is not stored: it would evict every other output, then itself.
+    # The cache is only an optimization: an error is reported but does not fail the conversion.
+    def store(self, key, output_file):
+        import shutil
+        
+        try:
+            if os.path.getsize(output_file) > self.max_bytes:
+                return
+                
+            os.makedirs(self.directory, exist_ok=True)
+            temp_file = os.path.join(self.directory, f'{key}.{os.getpid()}.tmp')
+            
+            try:
+                shutil.copyfile(output_file, temp_file)
+                os.replace(temp_file, self.get_file_name(key))
+            except BaseException:
+                os.remove(temp_file)
+                raise
+                
+            self.evict()
+            
+        except OSError as e:
+            print(f'Could not store the output in the result cache: {e}')
+
+    def evict(self):
+        entries = []
+        
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.ass') and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                    
+        total = sum(size for _, size, _ in entries)
+        
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+                
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # Removed by another conversion.
+                
+            total = total - size
+
+
+# Load the ban file and returns each list.
+# {
+#     "word_only": [], # ban the word only
+#     "whole_comment": [], # ban the whole comment
+#     "user": [], # ban the user
+#     "critical_word": [], # ban the comment and the user
+# }
+#
+def load_ban_file(ban_file):
+    if ban_file == None:
+        return [], [], [], []
+
+    dicts = load_json_file(ban_file)
+    
+    try:
+        # List of words to remove from a comment. (Delete the word only)
+        remove_words = dicts["word_only"]
+
+        # List of words. (Delete whole comment)
+        banned_words = dicts["whole_comment"] 
+        
+        # List of user ids and names.
+        banned_users = dicts["user"] 
+        
+        # List of words that bans also the user. (Delete whole comment)
+        banned_critical_word = dicts["critical_word"]
+        
+        if (not isinstance(remove_words, list) or
+            not isinstance(banned_words, list) or
+            not isinstance(banned_users, list) or
+            not isinstance(banned_critical_word, list)):
+                sys.exit("All values must be in lists.")
+        
+        return remove_words, banned_words, banned_users, banned_critical_word
+
+    except KeyError as e:
+        sys.exit("The ban file does not contain all required keys.\n The file must contain: 'word_only', 'whole_comment', 'user', and 'critical_word' keys.")
+
+
+# Multi-pattern substring matcher (Aho-Corasick automaton).
+# Finds whether any of the words occurs in a text with a single scan of the text,
+# whatever the number of words.
+class WordMatcher:
+    def __init__(self, words):
+        self.words = list(words)
+        self.goto = [{}] # Trie transitions of each node.
+        self.fail = [0]  # Longest proper suffix of each node that is also in the trie.
+        self.out = [False] # True if a word ends at the node (or at one of its suffixes).
+        
+        for word in self.words:
+            node = 0
+            
+            for c in word:
+                child = self.goto[node].get(c)
+                
+                if child is None:
+                    child = len(self.goto)
+                    self.goto[node][c] = child
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(False)
+                    
+                node = child
+                
+            self.out[node] = True
+        
+        # Breadth first, so that the failure link of the parent is always known.
+        queue = deque(self.goto[0].values())
+        
+        while queue:
+            node = queue.popleft()
+            
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                    
+                self.fail[child] = self.goto[f].get(c, 0)
+                self.out[child] = self.out[child] or self.out[self.fail[child]]
+
+    def __len__(self):
+        return len(self.words)
+
+    # Return True if any word is a substring of the text.
+    def search(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        
+        if out[0]: # An empty word matches everything.
+            return True
+            
+        node = 0
+        
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+                
+            node = goto[node].get(c, 0)
+            
+            if out[node]:
+                return True
+                
+        return False
+
+
+# Backreferences and conditionals refer to group numbers, which change once the patterns are combined.
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+# Characters that make a pattern more than a literal string.
+REGEX_METACHARACTERS = re.compile(r'[\\.^$*+?{}\[\]|()]')
+
+
+# Distinct message bodies whose normalization is memoized (see WordRemover.normalize).
+NORMALIZE_CACHE_SIZE = 65536
+
+
+# Remove every match of a list of regex patterns, applied one after another.
+# All patterns are compiled once. Literal patterns are looked for with a
+# WordMatcher and the other ones with a single alternation, which tells
+# whether a message contains anything to remove; most messages do not, and
+# are then scanned only once. Otherwise the patterns are applied in order, so
+# the result is always the same as running re.sub for each pattern.
+#
+# normalize is the whole normalization of a message body (substitute_message, then
+# clean_up_comment with these patterns) fused in one pass. Chat repeats itself (emote spam,
+# copypastas), so its result for each distinct body is memoized in a bounded LRU:
+# normalize.cache_info() gives the hits.
+class WordRemover:
+    def __init__(self, patterns, cache_size=NORMALIZE_CACHE_SIZE):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.literals = WordMatcher(pattern for pattern in patterns if not REGEX_METACHARACTERS.search(pattern))
+        self.regexes = [pattern for pattern in patterns if REGEX_METACHARACTERS.search(pattern)]
+        self.any_pattern = None
+        
+        if self.regexes and not any(GROUP_REFERENCE.search(pattern) for pattern in self.regexes):
+            try:
+                self.any_pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in self.regexes))
+            except re.error:
+                pass # eg. inline global flags. Apply the patterns one by one.
+                
+        self.cache_size = cache_size
+        self.normalize = lru_cache(maxsize=cache_size)(self.normalize_message)
+
+    # The processes of a pool (spawned, not forked) get the patterns without the memo.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['normalize']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.normalize = lru_cache(maxsize=self.cache_size)(self.normalize_message)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    # Check if any pattern may match the message.
+    def may_match(self, message):
+        if self.regexes and (self.any_pattern is None or self.any_pattern.search(message) is not None):
+            return True
+            
+        return self.literals.search(message)
+
+    def sub(self, message):
+        if not self.may_match(message):
+            return message
+            
+        for pattern in self.patterns:
+            message = pattern.sub('', message)
+            
+        return message
+
+    # Return the normalized message of a body, and the substitutions made: a tuple of
+    # (pattern, count) for the Profile.
+    def normalize_message(self, body):
+        substitutions = []
+        dots = body.count('.')
+        
+        if dots:
+            # '.' causes file loading error.
+            body = body.replace('.', ' ')
+            substitutions.append(('.', dots))
+            
+        message, count = W_RUN.subn('www', body)
+        
+        if count:
+            substitutions.append((W_RUN.pattern, count))
+            
+        if self.patterns:
+            if self.may_match(message):
+                for pattern in self.patterns:
+                    removed = pattern.sub('', message)
+                    
+                    # subn is slower on the many patterns that do not match: count only the ones that did.
+                    if removed != message:
+                        substitutions.append((pattern.pattern, pattern.subn('', message)[1]))
+                        message = removed
+                        
+            message = message.strip()
+            
+        return message, tuple(substitutions)
+
+
+# Compile the lists returned by load_ban_file, once per run.
+# Banned user ids and names are kept in a set, so looking a commenter up does not depend on the number of users.
+def compile_ban_lists(remove_words, banned_words, banned_users, banned_critical_word):
+    return WordRemover(remove_words), WordMatcher(banned_words), frozenset(banned_users), WordMatcher(banned_critical_word)
+
+
+# Check if the comment time is out of range (between start and end time).
+def is_out_of_range(comment, start_time, end_time):  
+    time = comment['content_offset_seconds']
+    
+    if time < start_time:
+        return True
+        
+    if end_time != 0 and time > end_time:
+        return True
+    
+    return False
+
+
+# Read-only view of the comment times of a list of comments, for bisect.
+class OffsetView:
+    def __init__(self, comments):
+        self.comments = comments
+
+    def __len__(self):
+        return len(self.comments)
+
+    def __getitem__(self, i):
+        return self.comments[i]['content_offset_seconds']
+
+
+# Check if the comment times never decrease.
+def is_sorted_by_time(comments):
+    offsets = OffsetView(comments)
+    return all(offsets[i] <= offsets[i + 1] for i in range(len(offsets) - 1))
+
+
+# Keep only the comments between start and end time.
+# A list is checked to be sorted by time (or sorted once) and the boundaries of the
+# range are found by binary search, so only the comments in range are processed.
+# A chat cache is always sorted and is bisected on its time column.
+# Any other iterable is a stream, read to the end (see iter_time_range).
+def select_time_range(comments, start_time, end_time):
+    if isinstance(comments, ChatCache):
+        # Sorted when the cache was built. Bisect on the time column only.
+        offsets = comments.offsets
+        first = bisect.bisect_left(offsets, start_time)
+        last = len(offsets) if end_time == 0 else bisect.bisect_right(offsets, end_time, first)
+        return comments[first:last]
+        
+    if not isinstance(comments, (list, tuple)):
+        return iter_time_range(comments, start_time, end_time)
+        
+    if not is_sorted_by_time(comments):
+        comments = sorted(comments, key=lambda comment: comment['content_offset_seconds'])
+        
+    offsets = OffsetView(comments)
+    first = bisect.bisect_left(offsets, start_time)
+    last = len(offsets) if end_time == 0 else bisect.bisect_right(offsets, end_time, first)
+    
+    return comments[first:last]
+
+
+# Yield the comments of a stream between start and end time, in stream order.
+# A stream can not be checked to be sorted before it is read, so it is read to the end: stopping
+# at the first comment past the end time would lose the later comments of an unsorted stream.
+# A ChatCache (--chat-cache) is sorted, and only its range is read.
+def iter_time_range(comments, start_time, end_time):
+    for comment in comments:
+        if not is_out_of_range(comment, start_time, end_time):
+            yield comment
+
+
+# Check if the comment includes a banned word.
+# banned_words is a list of words or a WordMatcher.
+def is_banned_comment(comment, banned_words):       
+    return contains_banned_word(comment['message']['body'], banned_words)
+
+
+# Check if a message body contains one of the words (a list or a WordMatcher).
+def contains_banned_word(body, banned_words):
+    if len(banned_words) == 0:
+        return False
+        
+    if isinstance(banned_words, WordMatcher):
+        return banned_words.search(body)
+
+    for banned_word in banned_words:
+        if banned_word in body:
+            return True
+
+    return False
+
+
+# Check if the comment is from a banned user.
+# banned_users is a list or a set of user ids and names.
+def is_banned_user(comment, banned_users):    
+    if len(banned_users) == 0:
+        return False
+        
+    if (comment['commenter']['name'] in banned_users or comment['commenter']['_id'] in banned_users):
+        return True
+        
+    return False
+
+
+# Why a comment is deleted.
+# 'user', 'critical_word' and 'whole_comment' only depend on the ban file and the comment,
+# 'escalated' (later comments of a user who wrote a critical word) and 'retroactive'
+# (earlier comments of such a user) on the state of the pass, 'empty' on the cleaned up text.
+MODERATION_CATEGORIES = ['user', 'critical_word', 'whole_comment', 'escalated', 'retroactive', 'empty']
+
+
+# Return why the comment is banned by the ban file ('user', 'critical_word' or 'whole_comment'), or None.
+def get_ban_category(comment, banned_words, banned_users, critical_words=()):
+    commenter = comment['commenter']
+    return get_message_ban_category(comment['message']['body'], commenter['_id'], commenter['name'], banned_words, banned_users, critical_words)
+
+
+# Same as get_ban_category, for the body, user id and user name of a comment (see CommentRecord).
+def get_message_ban_category(body, user_id, name, banned_words, banned_users, critical_words=()):
+    if len(banned_users) and (name in banned_users or user_id in banned_users):
+        return 'user'
+        
+    if contains_banned_word(body, critical_words):
+        return 'critical_word'
+        
+    if contains_banned_word(body, banned_words):
+        return 'whole_comment'
+        
+    return None
+
+
+# Moderation state of one pass over the comments, which must be judged in time order.
+# A user who writes a critical word is banned for the rest of the pass, by id and by name.
+class Moderation:
+    def __init__(self):
+        self.escalated = {} # Ids and names of the users banned by a critical word -> time of the comment.
+        self.counts = dict.fromkeys(MODERATION_CATEGORIES, 0)
+        self.judged = 0
+
+    @property
+    def deleted(self):
+        return sum(self.counts.values())
+
+    # Check if a (user id, user name) commenter was banned by a critical word.
+    def is_escalated(self, commenter):
+        return commenter[0] in self.escalated or commenter[1] in self.escalated
+
+    # Return the final category of a comment, from its ban category (see get_ban_category).
+    def judge(self, time, category, commenter):
+        self.judged = self.judged + 1
+        
+        if category == 'critical_word':
+            for key in commenter:
+                self.escalated.setdefault(key, time)
+                
+        elif category != 'user' and self.is_escalated(commenter):
+            category = 'escalated'
+            
+        if category is not None:
+            self.counts[category] = self.counts[category] + 1
+            
+        return category
+
+
+# Yield (time, message) of the comments kept by the moderation, from the output of filter_comments.
+# With retroactive, the kept comments are first stored in a compact index (times, messages and
+# interned users), then the comments of users banned later by a critical word are removed in a
+# second pass over this index. Nothing is yielded before the end of the first pass.
+def moderate_comments(filtered, moderation, retroactive=False):
+    judge = moderation.judge
+    
+    if not retroactive:
+        for time, message, category, commenter in filtered:
+            if judge(time, category, commenter) is None:
+                yield time, message
+                
+        return
+        
+    times = array('d')
+    messages = []
+    users = array('l')
+    user_indexes = {}
+    
+    for time, message, category, commenter in filtered:
+        if judge(time, category, commenter) is None:
+            times.append(time)
+            messages.append(message)
+            users.append(user_indexes.setdefault(commenter, len(user_indexes)))
+            
+    banned = {index for commenter, index in user_indexes.items() if moderation.is_escalated(commenter)}
+    
+    for time, message, user in zip(times, messages, users):
+        if user in banned:
+            moderation.counts['retroactive'] = moderation.counts['retroactive'] + 1
+            continue
+            
+        yield time, message
+
+
+# Characters ignored when comparing messages for duplicates.
+NON_WORD = re.compile(r'[\W_]+')
+
+# A text made of one repeated unit, eg. 'lollollol'.
+REPEATED_UNIT = re.compile(r'(.+?)\1+')
+
+
+# Return the text compared to find near duplicate messages: case, spaces, punctuation
+# and repetitions are ignored, so that 'LOL', 'lol!!' and 'lol lol lol' are the same.
+def get_duplicate_key(message):
+    key = NON_WORD.sub('', message.casefold())
+    
+    if len(key) == 0:
+        # Only symbols or emojis.
+        return message
+        
+    match = REPEATED_UNIT.fullmatch(key)
+    return key if match is None else match.group(1)
+
+
+# Reduction of the number of comments, between filtering and layout, to bound the output
+# size and the rendering cost during chat spikes:
+# - dedup_window: the near duplicates of a message sent within this number of seconds after
+#   it are merged into it, shown as "message ×N".
+# - max_per_second: at most this number of comments per second, picked by reservoir sampling
+#   so that every comment of a second has the same chance to be kept.
+# - max_on_screen: a comment is dropped when this number of comments are still visible.
+# Comments are held until their duplicate window or second is over (a delay in follow mode).
+# The sampling is seeded, so the same input always gives the same output.
+class DensityControl:
+    def __init__(self, dedup_window=0, max_per_second=0, max_on_screen=0, visible_time=7, seed=0):
+        import random
+        
+        self.dedup_window = dedup_window
+        self.max_per_second = max_per_second
+        self.max_on_screen = max_on_screen
+        self.visible_time = visible_time
+        self.random = random.Random(seed)
+        self.merged = 0
+        self.rate_limited = 0
+        self.screen_limited = 0
+
+    # Yield the (time, message) kept from a time ordered stream of (time, message).
+    def reduce(self, comments):
+        if self.dedup_window:
+            comments = self.merge_duplicates(comments)
+            
+        if self.max_per_second:
+            comments = self.limit_rate(comments)
+            
+        if self.max_on_screen:
+            comments = self.limit_on_screen(comments)
+            
+        return comments
+
+    def merge_duplicates(self, comments):
+        pending = deque() # [time, message, count, key] of the messages whose window is not over, in time order.
+        events = {} # key -> pending message.
+        
+        for time, message in comments:
+            while pending and pending[0][0] + self.dedup_window <= time:
+                yield self.pop_event(pending, events)
+                
+            key = get_duplicate_key(message)
+            event = events.get(key)
+            
+            if event is None:
+                event = [time, message, 1, key]
+                events[key] = event
+                pending.append(event)
+            else:
+                event[2] = event[2] + 1
+                self.merged = self.merged + 1
+                
+        while pending:
+            yield self.pop_event(pending, events)
+
+    def pop_event(self, pending, events):
+        time, message, count, key = pending.popleft()
+        del events[key]
+        
+        if count > 1:
+            message = f'{message} ×{count}'
+            
+        return time, message
+
+    def limit_rate(self, comments):
+        second = None
+        reservoir = [] # (index in the second, time, message)
+        seen = 0
+        
+        for time, message in comments:
+            if math.floor(time) != second:
+                yield from ((time, message) for _, time, message in sorted(reservoir))
+                second = math.floor(time)
+                reservoir = []
+                seen = 0
+                
+            if seen < self.max_per_second:
+                reservoir.append((seen, time, message))
+            else:
+                # Keep the comment with probability max_per_second / (seen + 1), in place of a random one.
+                self.rate_limited = self.rate_limited + 1
+                index = self.random.randrange(seen + 1)
+                
+                if index < self.max_per_second:
+                    reservoir[index] = (seen, time, message)
+                    
+            seen = seen + 1
+            
+        yield from ((time, message) for _, time, message in sorted(reservoir))
+
+    def limit_on_screen(self, comments):
+        end_times = deque() # End times of the comments on screen, in order.
+        
+        for time, message in comments:
+            while end_times and end_times[0] <= time:
+                end_times.popleft()
+                
+            if len(end_times) >= self.max_on_screen:
+                self.screen_limited = self.screen_limited + 1
+                continue
+                
+            end_times.append(time + self.visible_time)
+            yield time, message
+
+
+# Remove words from a comment.
+# remove_words is a list of regex patterns or a WordRemover.
+def clean_up_comment(message, remove_words):
+    # message = comment['message']['body']
+    
+    if len(remove_words) == 0:
+        return message
+        
+    if isinstance(remove_words, WordRemover):
+        return remove_words.sub(message).strip()
+        
+    for remove_word in remove_words:
+        message = re.sub(remove_word, '', message)
+        
+    return message.strip()
+
+
+# Text modifications.
+def substitute_text(comment):
+    return substitute_message(comment['message']['body'])
+
+
+# Text modifications of a message body.
+def substitute_message(message):
+    # Substitute '.' to one white space ('.' causes file loading error)
+    message = message.replace('.', ' ')
+    
+    # Convert 4 or more w's to www.
+    message = W_RUN.sub('www', message)
+
+    return message
+
+
+# 4 or more w's.
+W_RUN = re.compile('[wWｗＷ]{4,}')
+
+
+# Convert a list: [hour, minutes, seconds] to seconds.
+def convert_hms_to_seconds(hms):
+    return int(hms[0]) * 3600 + int(hms[1]) * 60 + int(hms[2])
+
+
+# Width of a character in ems, by East Asian Width class, for a sans-serif font:
+# wide and fullwidth characters (CJK, kana, hangul, emojis...) are one em wide, the others narrower.
+WIDE_EM = 1.0
+NARROW_EM = 0.6
+
+# Combining marks and format characters (zero width joiner, variation selectors...) have no width.
+ZERO_WIDTH_CATEGORIES = {'Mn', 'Me', 'Cf'}
+
+# Messages whose width is remembered by a TextMeasure. Chats repeat the same short messages a lot.
+TEXT_WIDTH_CACHE_SIZE = 65536
+
+# Return the width of a character in ems, from its Unicode properties.
+def get_char_width(c):
+    import unicodedata
+    
+    if unicodedata.category(c) in ZERO_WIDTH_CATEGORIES:
+        return 0.0
+        
+    if unicodedata.east_asian_width(c) in ('W', 'F'):
+        return WIDE_EM
+        
+    return NARROW_EM
+
+
+# Load the advance widths of the characters of a font, in ems.
+# A .ttf/.otf/.ttc file is read with fontTools (optional), other files are json advance tables.
+def load_font_advances(font_file):
+    if os.path.splitext(font_file)[1].lower() in ('.ttf', '.otf', '.ttc'):
+        try:
+            from fontTools.ttLib import TTFont
+        except ImportError:
+            sys.exit('Reading a font file needs fontTools (pip install fonttools). A json advance table can be used instead.')
+            
+        with TTFont(font_file, fontNumber=0, lazy=True) as font:
+            units_per_em = font['head'].unitsPerEm
+            metrics = font['hmtx'].metrics
+            cmap = font.getBestCmap()
+            advances = {chr(codepoint): metrics[glyph][0] for codepoint, glyph in cmap.items()}
+            
+    else:
+        metrics = load_json_file(font_file)
+        
+        try:
+            units_per_em = metrics['units_per_em']
+            advances = metrics['advances']
+        except (KeyError, TypeError):
+            sys.exit("The font metrics file must contain 'units_per_em' and 'advances' keys.")
+            
+    return {c: advance / units_per_em for c, advance in advances.items()}
+
+
+# Width in pixels of the messages displayed with a font size.
+# The characters in font_advances use their advance width in the font, the others
+# their East Asian Width class. The width of each character is looked up once and
+# kept in a table, and the width of the last messages is cached.
+class TextMeasure:
+    def __init__(self, font_size, font_advances=None, cache_size=TEXT_WIDTH_CACHE_SIZE):
+        self.font_size = font_size
+        self.ascii_is_narrow = not font_advances
+        self.widths = dict(font_advances or {}) # Character -> width in ems.
+        self.measure = lru_cache(maxsize=cache_size)(self.measure_text)
+
+    def measure_text(self, message):
+        if self.ascii_is_narrow and message.isascii():
+            return round(self.font_size * NARROW_EM * len(message))
+            
+        try:
+            return round(self.font_size * sum(map(self.widths.__getitem__, message)))
+            
+        except KeyError:
+            # New characters.
+            for c in message:
+                if c not in self.widths:
+                    self.widths[c] = get_char_width(c)
+                    
+            return round(self.font_size * sum(map(self.widths.__getitem__, message)))
+
+    # Same as measure for a list of messages: return a NumPy array of widths.
+    # The widths of ASCII messages are computed at once from their lengths.
+    def measure_batch(self, messages):
+        numpy = import_numpy()
+        
+        if not self.ascii_is_narrow:
+            return numpy.fromiter(map(self.measure, messages), dtype=numpy.int64, count=len(messages))
+            
+        lengths = numpy.fromiter(map(len, messages), dtype=numpy.int64, count=len(messages))
+        widths = numpy.rint(self.font_size * NARROW_EM * lengths).astype(numpy.int64)
+        others = numpy.flatnonzero(~numpy.fromiter(map(str.isascii, messages), dtype=bool, count=len(messages)))
+        
+        if len(others):
+            widths[others] = [self.measure(messages[i]) for i in others.tolist()]
+            
+        return widths
+
+
+# NumPy is optional: only the vectorized layout and serialization (--vectorize) need it.
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        sys.exit('--vectorize needs NumPy (pip install numpy).')
+        
+    return numpy
+
+
+# Collision free placement of scrolling comments.
+#
+# The screen is divided in lanes of one font size height. A comment enters at
+# the right edge and scrolls to the left in `visible_time` seconds, so longer
+# comments are faster. A lane accepts a new comment once the tail of its last
+# comment has left the right edge, and if the new comment does not catch up
+# with it before it leaves the screen.
+#
+# Lanes whose tail has cleared are kept in a heap ordered by lane (top-most
+# first), the others in a heap ordered by the time they clear, so placing a
+# comment costs O(log lanes).
+class LaneLayout:
+    def __init__(self, play_res_x, play_res_y, font_size, visible_time, policy='overlay', layer=COMMENT_LAYER, offset_y=0):
+        self.play_res_x = play_res_x
+        self.play_res_y = play_res_y
+        self.font_size = font_size
+        self.visible_time = visible_time
+        self.policy = policy
+        self.layer = layer
+        self.offset_y = offset_y
+        self.lanes = max(1, (play_res_y - offset_y) // font_size)
+        self.free = list(range(self.lanes)) # Heap of lanes whose tail has cleared.
+        self.busy = [] # Heap of (clear time, lane).
+        self.exit_time = [float('-inf')] * self.lanes # When the last comment of each lane leaves the screen.
+        self.overlay = None
+        self.placed = 0
+        self.dropped = 0
+        self.queued = 0
+
+    # Move the lanes whose tail has cleared the right edge at `time` to the free heap.
+    def release(self, time):
+        while self.busy and self.busy[0][0] <= time:
+            heapq.heappush(self.free, heapq.heappop(self.busy)[1])
+
+    # Time for the head of a comment of `width` to reach the left edge.
+    def head_time(self, width):
+        return self.visible_time * self.play_res_x / (self.play_res_x + width)
+
+    def occupy(self, lane, time, width):
+        heapq.heappush(self.busy, (time + self.visible_time - self.head_time(width), lane))
+        self.exit_time[lane] = time + self.visible_time
+        self.placed = self.placed + 1
+        return time, lane * self.font_size + self.offset_y, self.layer
+
+    # Layout of the overlay layer, used when every lane is full with the 'overlay' policy.
+    def get_overlay(self):
+        # Half a lane lower, so that the overlaid text stays readable.
+        if self.overlay is None:
+            self.overlay = LaneLayout(self.play_res_x, self.play_res_y, self.font_size, self.visible_time, 'force', self.layer + 1, self.offset_y + self.font_size // 2)
+            
+        return self.overlay
+
+    # Return (time, y, layer) of a comment shown at `time`, or None if it is dropped.
+    def place(self, time, width):
+        self.release(time)
+        head_time = self.head_time(width)
+        
+        # Top-most free lane the comment does not catch up in.
+        rejected = []
+        lane = None
+        
+        while self.free:
+            candidate = heapq.heappop(self.free)
+            
+            if time + head_time >= self.exit_time[candidate]:
+                lane = candidate
+                break
+                
+            rejected.append(candidate)
+            
+        for candidate in rejected:
+            heapq.heappush(self.free, candidate)
+        
+        if lane is not None:
+            return self.occupy(lane, time, width)
+            
+        return self.place_when_full(time, width, head_time, rejected)
+
+    # Same as place when every lane is full. rejected are the free lanes the comment would catch up in.
+    def place_when_full(self, time, width, head_time, rejected):
+        if self.policy == 'drop':
+            self.dropped = self.dropped + 1
+            return None
+            
+        if self.policy == 'overlay':
+            return self.get_overlay().place(time, width)
+        
+        # The lane that clears first.
+        clear_time, lane = self.busy[0] if self.busy else (time, rejected[0])
+        start_time = max(clear_time, self.exit_time[lane] - head_time)
+        
+        if self.policy == 'queue':
+            if start_time - time > self.visible_time:
+                # Too late to be related to the stream anymore.
+                self.dropped = self.dropped + 1
+                return None
+                
+            self.queued = self.queued + 1
+            
+        else: # 'force': overlay layer, show it now in the lane that clears first.
+            start_time = time
+            
+        if self.busy and self.busy[0][1] == lane:
+            heapq.heappop(self.busy)
+        else:
+            self.free.remove(lane)
+            heapq.heapify(self.free)
+            
+        return self.occupy(lane, start_time, width)
+
+    # Place a batch of comments: NumPy arrays of times and widths, in time order.
+    # The timings of the whole batch are computed at once, then the lanes are assigned in one
+    # loop; a comment that finds every lane full goes through place_when_full(), or to the
+    # overlay layout in one more batch.
+    # Return the arrays of start times, y and layers, and the mask of the comments placed.
+    def place_batch(self, times, widths):
+        numpy = import_numpy()
+        head_times = self.visible_time * self.play_res_x / (self.play_res_x + widths)
+        exit_times = times + self.visible_time
+
+        start_times = times.tolist()
+        ys = [0] * len(start_times)
+        layers = [self.layer] * len(start_times)
+        placed = [True] * len(start_times)
+
+        free, busy, exit_time = self.free, self.busy, self.exit_time
+        heappush, heappop = heapq.heappush, heapq.heappop
+        assigned = 0 # Comments placed in a free lane by this loop, place_when_full() counts the others.
+        overlaid = []
+
+        head_times_list = head_times.tolist()
+        
+        for i, (time, arrival_time, clear_time, lane_exit_time) in enumerate(zip(start_times, (times + head_times).tolist(), (exit_times - head_times).tolist(), exit_times.tolist())):
+            while busy and busy[0][0] <= time:
+                heappush(free, heappop(busy)[1])
+
+            # Top-most free lane the comment does not catch up in.
+            rejected = []
+            lane = None
+
+            while free:
+                candidate = heappop(free)
+
+                if arrival_time >= exit_time[candidate]:
+                    lane = candidate
+                    break
+
+                rejected.append(candidate)
+
+            for candidate in rejected:
+                heappush(free, candidate)
+
+            if lane is None:
+                if self.policy == 'overlay':
+                    # Placed on the overlay layer after the loop: its lanes do not depend on these.
+                    overlaid.append(i)
+                    continue
+                    
+                placement = self.place_when_full(time, int(widths[i]), head_times_list[i], rejected)
+
+                if placement is None:
+                    placed[i] = False
+                else:
+                    start_times[i], ys[i], layers[i] = placement
+                continue
+
+            heappush(busy, (clear_time, lane))
+            exit_time[lane] = lane_exit_time
+            ys[i] = lane * self.font_size + self.offset_y
+            assigned = assigned + 1
+
+        self.placed = self.placed + assigned
+        start_times, ys, layers, placed = numpy.array(start_times, dtype=numpy.float64), numpy.array(ys, dtype=numpy.int64), numpy.array(layers, dtype=numpy.int64), numpy.array(placed, dtype=bool)
+        
+        if overlaid:
+            overlaid = numpy.array(overlaid, dtype=numpy.int64)
+            start_times[overlaid], ys[overlaid], layers[overlaid], _ = self.get_overlay().place_batch(times[overlaid], widths[overlaid])
+            
+        return start_times, ys, layers, placed
+
+
+# Stateless part of the processing: ban checks, substitutions and clean up.
+# Return the message to display, or None if the comment is deleted.
+def filter_comment(comment, remove_words, banned_words, banned_users, critical_words=()):
+    commenter = comment['commenter']
+    return filter_message(comment['message']['body'], commenter['_id'], commenter['name'], remove_words, banned_words, banned_users, critical_words)[0]
+
+
+# Yield (time, message or None, category or None, (user id, user name)) of each comment.
+# The category is the ban category, or 'empty' when nothing is left of the message; the
+# state of the pass (users banned by a critical word) is left to Moderation.
+def filter_comments(comments, remove_words, banned_words, banned_users, critical_words=()):
+    for comment in comments:
+        commenter = comment['commenter']
+        message, category = filter_message(comment['message']['body'], commenter['_id'], commenter['name'], remove_words, banned_words, banned_users, critical_words)
+        yield comment['content_offset_seconds'], message, category, (commenter['_id'], commenter['name'])
+
+
+# Return (message or None, category or None) of the body, user id and user name of a comment
+# (see filter_comments).
+def filter_message(body, user_id, name, remove_words, banned_words, banned_users, critical_words=()):
+    category = get_message_ban_category(body, user_id, name, banned_words, banned_users, critical_words)
+    
+    if category is not None:
+        return None, category
+        
+    if isinstance(remove_words, WordRemover):
+        message = remove_words.normalize(body)[0]
+    else:
+        message = clean_up_comment(substitute_message(body), remove_words)
+    
+    if len(message) == 0:
+        return None, 'empty'
+        
+    return message, None
+
+
+# Comments sent to a filter worker at once.
+PARALLEL_CHUNK_SIZE = 2000
+
+# Compiled ban lists of a filter worker process.
+worker_ban_lists = None
+
+
+def init_filter_worker(ban_lists):
+    global worker_ban_lists
+    worker_ban_lists = ban_lists
+
+
+def filter_chunk(chunk):
+    return list(filter_comments(chunk, *worker_ban_lists))
+
+
+# Keep only the fields used by filter_comment, so that chunks are cheap to send to the workers.
+def slim_comment(comment):
+    return {
+        'content_offset_seconds': comment['content_offset_seconds'],
+        'commenter': {'_id': comment['commenter']['_id'], 'name': comment['commenter']['name']},
+        'message': {'body': comment['message']['body']}
+    }
+
+
+# Split the comments in chunks of consecutive comments (contiguous time spans).
+def iter_chunks(comments, chunk_size):
+    chunk = []
+    
+    for comment in comments:
+        chunk.append(slim_comment(comment))
+        
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+            
+    if chunk:
+        yield chunk
+
+
+# Same as filter_comments, with the chunks filtered in a pool of `jobs` processes.
+# Results are yielded in the original order, so that the moderation state stays sequential. At most 2 chunks per worker are in
+# flight, so a stream is never read far ahead of the output.
+def filter_comments_parallel(comments, ban_lists, jobs, chunk_size=PARALLEL_CHUNK_SIZE):
+    import multiprocessing
+    
+    with multiprocessing.Pool(jobs, initializer=init_filter_worker, initargs=(ban_lists,)) as pool:
+        pending = deque()
+        
+        for chunk in iter_chunks(comments, chunk_size):
+            pending.append(pool.apply_async(filter_chunk, (chunk,)))
+            
+            if len(pending) >= jobs * 2:
+                yield from pending.popleft().get()
+                
+        while pending:
+            yield from pending.popleft().get()
+
+
+# Stages of the processing, in order.
+PROFILE_STAGES = ['load', 'filter', 'normalize', 'layout', 'serialize']
+
+
+# Opt-in instrumentation of a conversion: time, comments/s and (optionally traced)
+# peak memory of each stage, matches of each ban category and substitution, and
+# lane statistics. The pipeline only takes its profiled code paths when a Profile
+# is given, so nothing is measured (or slowed down) otherwise.
+class Profile:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {stage: {'seconds': 0.0, 'calls': 0, 'peak_traced_bytes': 0} for stage in PROFILE_STAGES}
+        self.comments = {} # Counters of process_comments.
+        self.bans = dict.fromkeys(MODERATION_CATEGORIES, 0) # Deleted comments of each category.
+        self.substitutions = {} # Pattern -> number of substitutions.
+        self.lanes = {} # (layer, y) -> number of comments.
+        self.layout = {}
+        self.started = None
+        self.wall_seconds = 0.0
+        self.max_rss_kib = None
+        self.peak_traced_bytes = 0
+        self.normalize_cache = None # WordRemover.normalize of the ban lists, for its hit rate.
+
+    def start(self):
+        self.started = time.perf_counter()
+        
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def stop(self):
+        self.wall_seconds = time.perf_counter() - self.started
+        
+        if self.trace_memory:
+            import tracemalloc
+            self.peak_traced_bytes = max(self.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            
+        try:
+            import resource
+            self.max_rss_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            pass # Not on Windows.
+
+    # Enter a call of a stage and return its start time. Stages run interleaved, one comment
+    # at a time, so the traced peak is reset here (after keeping it for the overall peak) to
+    # only see the allocations of this call.
+    def enter(self):
+        if self.trace_memory:
+            import tracemalloc
+            self.peak_traced_bytes = max(self.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            
+        return time.perf_counter()
+
+    # Add a call of a stage entered with enter, or `calls` calls made at once.
+    def add(self, stage, seconds, calls=1):
+        stage = self.stages[stage]
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+        
+        if self.trace_memory:
+            import tracemalloc
+            stage['peak_traced_bytes'] = max(stage['peak_traced_bytes'], tracemalloc.get_traced_memory()[1])
+
+    def count_substitutions(self, pattern, count):
+        if count:
+            self.substitutions[pattern] = self.substitutions.get(pattern, 0) + count
+
+    # Return the profile as a json serializable dictionary.
+    def report(self):
+        in_range = self.comments.get('in_range', 0)
+        
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = {
+                'seconds': round(stage['seconds'], 6),
+                'calls': stage['calls'],
+                'per_second': round(stage['calls'] / stage['seconds']) if stage['seconds'] else None
+            }
+            
+            if self.trace_memory:
+                stages[name]['peak_traced_bytes'] = stage['peak_traced_bytes']
+        
+        report = {
+            'wall_seconds': round(self.wall_seconds, 6),
+            'comments_per_second': round(in_range / self.wall_seconds) if self.wall_seconds else None,
+            'comments': self.comments,
+            'stages': stages,
+            'bans': self.bans,
+            'substitutions': self.substitutions,
+            'layout': dict(self.layout, lane_counts=[{'layer': layer, 'y': y, 'comments': count} for (layer, y), count in sorted(self.lanes.items())]),
+            'max_rss_kib': self.max_rss_kib,
+            'normalize_cache': None
+        }
+        
+        if self.normalize_cache is not None:
+            info = self.normalize_cache.cache_info()
+            lookups = info.hits + info.misses
+            report['normalize_cache'] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'hit_rate': round(info.hits / lookups, 4) if lookups else None}
+        
+        if self.trace_memory:
+            report['peak_traced_bytes'] = self.peak_traced_bytes
+            
+        return report
+
+
+# Print a profile report as a table.
+def print_profile(report):
+    print(f'Wall time: {report["wall_seconds"]:.3f}s ({report["comments_per_second"]} comments/s)')
+    
+    for name, stage in report['stages'].items():
+        print(f'  {name:<10} {stage["seconds"]:>9.3f}s {stage["calls"]:>10} calls {stage["per_second"] or 0:>10}/s')
+        
+    print(f'Bans: {report["bans"]}')
+    
+    for pattern, count in report['substitutions'].items():
+        print(f'  {escape_markup(pattern)}: {count} substitutions')
+        
+    print(f'Lanes used: {len(report["layout"]["lane_counts"])}, dropped: {report["layout"]["dropped"]}, queued: {report["layout"]["queued"]}')
+    
+    if report['normalize_cache'] is not None and report['normalize_cache']['hit_rate'] is not None:
+        print(f'Normalized bodies reused: {report["normalize_cache"]["hit_rate"]:.1%} ({report["normalize_cache"]["hits"]} hits, {report["normalize_cache"]["size"]} distinct bodies cached)')
+
+
+# Yield the items of an iterable, adding the time of each step to a stage.
+def iter_profiled(iterable, profile, stage):
+    clock = time.perf_counter
+    iterator = iter(iterable)
+    
+    while True:
+        start = profile.enter()
+        
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+            
+        profile.add(stage, clock() - start)
+        yield item
+
+
+# Same as filter_comments, timing the ban checks ('filter') apart from the normalization
+# ('normalize'), and counting substitutions.
+def filter_comments_profiled(comments, remove_words, banned_words, banned_users, critical_words, profile):
+    clock = time.perf_counter
+    profile.normalize_cache = remove_words.normalize
+    
+    for comment in comments:
+        start = profile.enter()
+        category = get_ban_category(comment, banned_words, banned_users, critical_words)
+        commenter = (comment['commenter']['_id'], comment['commenter']['name'])
+        profile.add('filter', clock() - start)
+        
+        if category is not None:
+            yield comment['content_offset_seconds'], None, category, commenter
+            continue
+        
+        filtered = profile.enter()
+        message, substitutions = remove_words.normalize(comment['message']['body'])
+        
+        for pattern, count in substitutions:
+            profile.count_substitutions(pattern, count)
+        
+        profile.add('normalize', clock() - filtered)
+        
+        yield comment['content_offset_seconds'], message or None, None if message else 'empty', commenter
+
+
+# Return layout.place, timing each call and counting the comments of each lane.
+def profile_place(layout, profile):
+    clock = time.perf_counter
+    
+    def place(time, width):
+        start = profile.enter()
+        placement = layout.place(time, width)
+        profile.add('layout', clock() - start)
+        
+        if placement is not None:
+            lane = (placement[2], placement[1])
+            profile.lanes[lane] = profile.lanes.get(lane, 0) + 1
+            
+        return placement
+        
+    return place
+
+
+# TODO: Create smaller funcitions.
+# Generator: consume comments from any iterable and yield processed items one at a time.
+# With jobs > 1, the filtering runs in worker processes; placing comments is always done here, in order.
+# If given, ban_lists replaces ban_file, and the counters are stored in the stats dictionary.
+# With a Profile, the profiled versions of the stages are used instead.
+# With retroactive, the earlier comments of a user banned by a critical word are deleted too
+# (the items are then only yielded once every comment is read).
+# A DensityControl reduces the comments kept by the moderation before they are placed.
+# The width of each message is measured by a TextMeasure, with the font_advances if given.
+# With a batch_size, batches of batch_size items are yielded instead (see place_comments_batched).
+def process_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, play_res_y, font_size, play_res_x=854, visible_time=7, lane_policy='overlay', jobs=1, ban_lists=None, stats=None, profile=None, retroactive=False, density=None, font_advances=None, batch_size=0):
+    item_counter = 0
+    layout = LaneLayout(play_res_x, play_res_y, font_size, visible_time, lane_policy)
+    text_measure = TextMeasure(font_size, font_advances)
+    measure = text_measure.measure
+    moderation = Moderation()
+    place = layout.place
+    
+    if profile is not None:
+        place = profile_place(layout, profile)
+    
+    kept = keep_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, moderation, jobs, ban_lists, profile, retroactive, density)
+    
+    if batch_size:
+        for batch in place_comments_batched(kept, start_time_in_seconds, layout, text_measure, batch_size, profile):
+            item_counter = item_counter + len(batch['message'])
+            yield batch
+    else:
+        for item in place_comments(kept, start_time_in_seconds, place, measure):
+            item_counter = item_counter + 1
+            yield item
+
+    print(f'Comments in range: {moderation.judged}')
+    print(f'Comments after:  {item_counter}')
+    print(f'Comments deleted: {moderation.deleted}')
+    
+    for category, count in moderation.counts.items():
+        if count:
+            print(f'  {category}: {count}')
+    
+    if layout.dropped:
+        print(f'Comments dropped (screen full): {layout.dropped}')
+        
+    if density is not None:
+        print(f'Comments merged (duplicates): {density.merged}')
+        print(f'Comments dropped (rate limit): {density.rate_limited}')
+        print(f'Comments dropped (on screen limit): {density.screen_limited}')
+        
+    if stats is not None:
+        stats.update({'in_range': moderation.judged, 'after': item_counter, 'deleted': moderation.deleted, 'deleted_by': dict(moderation.counts), 'dropped': layout.dropped})
+        
+        if density is not None:
+            stats.update({'merged': density.merged, 'rate_limited': density.rate_limited, 'screen_limited': density.screen_limited})
+        
+    if profile is not None:
+        profile.bans = dict(moderation.counts)
+        profile.layout = {'lanes': layout.lanes, 'placed': layout.placed, 'dropped': layout.dropped, 'queued': layout.queued,
+                          'overlay': 0 if layout.overlay is None else layout.overlay.placed}
+
+
+# Yield (time, message) of the comments to display: between start and end time, filtered,
+# moderated (the counters are in moderation) and reduced by the DensityControl if given.
+def keep_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, moderation, jobs=1, ban_lists=None, profile=None, retroactive=False, density=None):
+    # List of user names, ids and comments that are banned.
+    # If ban file was not passed as command line argument, return empty lists.
+    if ban_lists is None:
+        ban_lists = compile_ban_lists(*load_ban_file(ban_file))
+    
+    # Only the comments between start and end time.
+    comments = select_time_range(comments, start_time_in_seconds, end_time_in_seconds)
+    
+    #
+    # TODO: validate comment here. Fields exist, etc.
+    #
+    
+    if profile is not None:
+        comments = iter_profiled(comments, profile, 'load')
+        filtered = filter_comments_profiled(comments, *ban_lists, profile)
+        
+    elif jobs > 1:
+        filtered = filter_comments_parallel(comments, ban_lists, jobs)
+        
+    else:
+        filtered = filter_comments(comments, *ban_lists)
+    
+    # Ban the users who write a critical word, and delete the banned comments.
+    kept = moderate_comments(filtered, moderation, retroactive)
+    
+    if density is not None:
+        kept = density.reduce(kept)
+        
+    return kept
+
+
+# Yield the items of kept comments placed by place (LaneLayout.place) with their width measured by measure.
+def place_comments(kept, start_time_in_seconds, place, measure):
+    for time, message in kept:
+        # Load comment time and adjust it considering the start time.
+        time = time - start_time_in_seconds
+        
+        # Define where to display a comment: in a lane where it does not overlap other comments.
+        width = measure(message)
+        placement = place(time, width)
+        
+        if placement is None:
+            # Every lane is full.
+            continue
+            
+        time, y, layer = placement
+        
+        yield {'time': time, 'message': message, 'y': y, 'layer': layer, 'width': width}
+
+
+# Comments laid out at once by place_comments_batched.
+LAYOUT_BATCH_SIZE = 65536
+
+
+# Same as place_comments with the columns of batch_size comments in NumPy arrays: yield batches of
+# items, dictionaries of columns with the keys of an item ('message' is a list, the others are arrays).
+# Time rebasing, widths (measured by text_measure, a TextMeasure) and lane timings are computed for
+# a whole batch (see LaneLayout.place_batch).
+# With a Profile, the layout time and the comments of each lane are added to it.
+def place_comments_batched(kept, start_time_in_seconds, layout, text_measure, batch_size=LAYOUT_BATCH_SIZE, profile=None):
+    numpy = import_numpy()
+    kept = iter(kept)
+    
+    while True:
+        chunk = list(islice(kept, batch_size))
+        
+        if not chunk:
+            return
+            
+        messages = [message for _, message in chunk]
+        
+        # Load comment times and adjust them considering the start time.
+        times = numpy.array([offset for offset, _ in chunk], dtype=numpy.float64) - start_time_in_seconds
+        widths = text_measure.measure_batch(messages)
+        
+        start = time.perf_counter() if profile is None else profile.enter()
+        start_times, ys, layers, placed = layout.place_batch(times, widths)
+        
+        if profile is not None:
+            profile.add('layout', time.perf_counter() - start, len(messages))
+        
+        if not placed.all():
+            # Every lane was full for some comments.
+            messages = [message for message, is_placed in zip(messages, placed.tolist()) if is_placed]
+            start_times, ys, layers, widths = start_times[placed], ys[placed], layers[placed], widths[placed]
+            
+        if profile is not None:
+            for lane in zip(layers.tolist(), ys.tolist()):
+                profile.lanes[lane] = profile.lanes.get(lane, 0) + 1
+            
+        if messages:
+            yield {'time': start_times, 'message': messages, 'y': ys, 'layer': layers, 'width': widths}
+
+
+# Yield the items of a batch of items (see place_comments_batched) one at a time.
+def iter_batch_items(batch):
+    for time, message, y, layer, width in zip(batch['time'].tolist(), batch['message'], batch['y'].tolist(), batch['layer'].tolist(), batch['width'].tolist()):
+        yield {'time': time, 'message': message, 'y': y, 'layer': layer, 'width': width}
+
+
+# Yield the items and add the time until the next one is requested (formatting and writing it) to the 'serialize' stage.
+# With batched, items are batches of items (see place_comments_batched).
+def iter_profiled_serialize(items, profile, batched=False):
+    clock = time.perf_counter
+    
+    for item in items:
+        start = profile.enter()
+        yield item
+        profile.add('serialize', clock() - start, len(item['message']) if batched else 1)
+
+
+# Return the header of a subtitle file.
+def make_subtitle_header(play_res_x, play_res_y, font_size):
+    # Color: &H33BBGGRR
+    return f"""[Script Info]
+ScriptType: v4.00+
+PlayResX: {play_res_x}
+PlayResY: {play_res_y}
+Aspect Ratio: {play_res_x}:{play_res_y}
+Collisions: Normal
+WrapStyle: 2
+ScaledBorderAndShadow: yes
+YCbCr Matrix: TV.601
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: danmakuWhite, sans-serif, {font_size}, &H33FFFFFF, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
+Style: danmakuBlue, sans-serif, {font_size}, &H33FF0000, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
+Style: danmakuRed, sans-serif, {font_size}, &H330000FF, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
+Style: danmakuGreen, sans-serif, {font_size}, &H3300FF00, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+# Format a time in centiseconds as an ASS timestamp: h:mm:ss.cc
+# Chat times repeat a lot (whole seconds, and start + visible time), so results are memoized.
+@lru_cache(maxsize=65536)
+def format_ass_time(centiseconds):
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f'{hours}:{minutes:02}:{seconds:02}.{centiseconds:02}'
+
+
+# Centiseconds part of ASS timestamps.
+CENTISECOND_SUFFIXES = [f'.{centiseconds:02}' for centiseconds in range(100)]
+
+
+# Same as format_ass_time for a NumPy array of times in centiseconds. Return a list.
+# A batch spans few distinct seconds: 'h:mm:ss' is formatted once per second, and joined
+# to the centiseconds in object arrays.
+def format_ass_times(centiseconds):
+    numpy = import_numpy()
+    seconds, centiseconds = numpy.divmod(centiseconds, 100)
+    distinct_seconds, index = numpy.unique(seconds, return_inverse=True)
+    prefixes = numpy.array([format_ass_time(second * 100)[:-3] for second in distinct_seconds.tolist()], dtype=object)
+    return (prefixes[index] + numpy.array(CENTISECOND_SUFFIXES, dtype=object)[centiseconds]).tolist()
+
+
+# Format a time in milliseconds as an SRT (separator ',') or WebVTT (separator '.') timestamp: hh:mm:ss,mmm
+@lru_cache(maxsize=65536)
+def format_clock_time(milliseconds, separator):
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{hours:02}:{minutes:02}:{seconds:02}{separator}{milliseconds:03}'
+
+
+# Output formats.
+#
+# A serializer formats the items of one output format. Every serializer is created with
+# (play_res_x, font_size, visible_time, comment_color, play_res_y), and has:
+# - extension: file name extension of the format.
+# - header(): text at the start of each file, and footer: text at its end.
+# - format(item, time, segment): text of an item displayed from `time` in the file of a
+#   segment (see SegmentFiles). Items come in time order.
+
+
+# Format items as Dialogue lines. Everything that does not depend on the item is computed once.
+class DialogueSerializer:
+    extension = '.ass'
+    footer = ''
+    
+    def __init__(self, play_res_x, font_size, visible_time, comment_color, play_res_y=480):
+        self.play_res_x = play_res_x
+        self.play_res_y = play_res_y
+        self.font_size = font_size
+        self.visible_centiseconds = round(visible_time * 100)
+        self.style = f',{comment_color},,0000,0000,0000,,{{\\move({play_res_x},'
+
+    def header(self):
+        return make_subtitle_header(self.play_res_x, self.play_res_y, self.font_size)
+
+    # Return the Dialogue line of an item displayed from `time`.
+    def format(self, item, time, segment=0):
+        start = round(time * 100)
+        message = item['message']
+        y = item['y'] # Comment's height
+        width = item.get('width') # Comment's length (display speed)
+        
+        if width is None:
+            width = self.font_size * len(message)
+            
+        x2 = -width
+        
+        return f'Dialogue: {item["layer"]},{format_ass_time(start)},{format_ass_time(start + self.visible_centiseconds)}{self.style}{y},{x2},{y})}}{message}\n'
+
+    # Return the Dialogue lines of a batch of items (see place_comments_batched) displayed from `times`.
+    def format_batch(self, batch, times, segments):
+        numpy = import_numpy()
+        starts = numpy.rint(times * 100).astype(numpy.int64)
+        ends = format_ass_times(starts + self.visible_centiseconds)
+        style = self.style
+        
+        return [f'Dialogue: {layer},{start},{end}{style}{y},{x2},{y})}}{message}\n'
+                for layer, start, end, y, x2, message in zip(batch['layer'].tolist(), format_ass_times(starts), ends, batch['y'].tolist(), (-batch['width']).tolist(), batch['message'])]
+
+
+# Format items as numbered SRT cues. SRT can not scroll nor place a cue: players stack them.
+class SrtSerializer:
+    extension = '.srt'
+    footer = ''
+    
+    def __init__(self, play_res_x, font_size, visible_time, comment_color, play_res_y=480):
+        self.visible_milliseconds = round(visible_time * 1000)
+        self.numbers = {} # Number of the last cue of each segment.
+
+    def header(self):
+        return ''
+
+    def format(self, item, time, segment=0):
+        number = self.numbers.get(segment, 0) + 1
+        self.numbers[segment] = number
+        start = round(time * 1000)
+        
+        return f'{number}\n{format_clock_time(start, ",")} --> {format_clock_time(start + self.visible_milliseconds, ",")}\n{item["message"]}\n\n'
+
+
+# Format items as WebVTT cues, each one on the line of its lane.
+class VttSerializer:
+    extension = '.vtt'
+    footer = ''
+    
+    def __init__(self, play_res_x, font_size, visible_time, comment_color, play_res_y=480):
+        from html import escape
+        
+        self.play_res_y = play_res_y
+        self.visible_milliseconds = round(visible_time * 1000)
+        self.escape = escape
+
+    def header(self):
+        return 'WEBVTT\n\n'
+
+    def format(self, item, time, segment=0):
+        start = round(time * 1000)
+        line = min(100, round(item['y'] * 100 / self.play_res_y))
+        
+        # Cue text can not contain '<', '&' nor '-->'.
+        message = self.escape(item['message'], quote=False)
+        
+        return f'{format_clock_time(start, ".")} --> {format_clock_time(start + self.visible_milliseconds, ".")} line:{line}% align:start\n{message}\n\n'
+
+
+# Colors of the comment styles, as RGB numbers and Niconico color names.
+STYLE_COLORS = {
+    'danmakuWhite': (0xFFFFFF, 'white'),
+    'danmakuBlue': (0x0000FF, 'blue'),
+    'danmakuRed': (0xFF0000, 'red'),
+    'danmakuGreen': (0x00FF00, 'green')
+}
+
+
+# Format items as Bilibili danmaku (<d> elements). The danmaku player scrolls and places the comments itself.
+# p: time in seconds, mode (1: scrolling), font size, color, send timestamp, pool, user hash, id.
+class BilibiliXmlSerializer:
+    extension = '.xml'
+    footer = '</i>\n'
+    
+    def __init__(self, play_res_x, font_size, visible_time, comment_color, play_res_y=480):
+        from html import escape
+        
+        self.attributes = f',1,{font_size},{STYLE_COLORS[comment_color][0]},0,0,0,0">'
+        self.escape = escape
+
+    def header(self):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<i>\n<chatserver>chat.bilibili.com</chatserver>\n<chatid>0</chatid>\n'
+
+    def format(self, item, time, segment=0):
+        return f'<d p="{time:.3f}{self.attributes}{self.escape(item["message"], quote=False)}</d>\n'
+
+
+# Format items as Niconico danmaku (<chat> elements). vpos is the time in centiseconds.
+class NiconicoXmlSerializer:
+    extension = '_nico.xml' # Not the same file as the Bilibili danmaku.
+    footer = '</packet>\n'
+    
+    def __init__(self, play_res_x, font_size, visible_time, comment_color, play_res_y=480):
+        from html import escape
+        
+        self.mail = STYLE_COLORS[comment_color][1]
+        self.escape = escape
+        self.numbers = {} # Number of the last comment of each segment.
+
+    def header(self):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<packet>\n'
+
+    def format(self, item, time, segment=0):
+        number = self.numbers.get(segment, 0) + 1
+        self.numbers[segment] = number
+        
+        return f'<chat thread="0" no="{number}" vpos="{round(time * 100)}" mail="{self.mail}">{self.escape(item["message"], quote=False)}</chat>\n'
+
+
+# Serializer of each output format.
+OUTPUT_FORMATS = {
+    'ass': DialogueSerializer,
+    'srt': SrtSerializer,
+    'vtt': VttSerializer,
+    'xml': BilibiliXmlSerializer,
+    'nico': NiconicoXmlSerializer
+}
+
+
+# Return the output file of a format, when several formats are written: chat.ass -> chat.vtt, chat.ass.gz -> chat.vtt.gz
+def get_format_file_name(output_file, extension):
+    base, _, compression = split_file_name(output_file)
+    return base + extension + compression
+
+
+# File name extensions of the output formats (nico files are .xml files too).
+FORMAT_EXTENSIONS = {'.' + serializer.extension.rsplit('.', 1)[1] for serializer in OUTPUT_FORMATS.values()}
+
+# Return the file written for a format (key of OUTPUT_FORMATS). With several formats, or when output_file
+# has the extension of another format (eg. the default chat.ass with the vtt format), the extension of
+# the format replaces it (see get_format_file_name). Other names are kept.
+def get_output_file_name(output_file, name, several=False):
+    extension = OUTPUT_FORMATS[name].extension
+    file_extension = split_file_name(output_file)[1].lower()
+    
+    if several or (file_extension in FORMAT_EXTENSIONS and not extension.endswith(file_extension)):
+        return get_format_file_name(output_file, extension)
+        
+    return output_file
+
+
+# Return the file name of a segment of a time split output: chat.ass -> chat_1.ass, chat_2.ass, ...
+def get_segment_file_name(output_file, index):
+    base, extension, compression = split_file_name(output_file)
+    return f'{base}_{index + 1}{extension}{compression}'
+
+
+# Lines written to a file at once, and size of the file buffers.
+WRITE_BATCH = 4096
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+# Output files of the segments of a time split output, each one with its own header.
+# Lines are buffered and written in batches of WRITE_BATCH, or written and flushed at once when live.
+# Items come in time order (a queued comment is at most a few seconds late), so only
+# the last two segments are kept open; an older one is reopened to append if needed.
+# With a segment length of 0 there is only one segment: the output file itself.
+# The footer is added to every file when the output is closed.
+# Files named .gz, .bz2 or .xz are compressed; a reopened one gets another compressed stream
+# appended, which is read back as the continuation of the first one.
+# Each segment is written to a temporary file next to it, renamed when the output is closed: a
+# conversion that fails (eg. a missing or corrupt input, read only while writing) keeps the existing
+# output. When live, the output is written in place, to be read while it grows.
+class SegmentFiles:
+    def __init__(self, output_file, header, segment_length=0, segment_count=0, live=False, footer=''):
+        self.output_file = output_file
+        self.live = live
+        self.header = header
+        self.footer = footer
+        self.segment_length = segment_length
+        self.segment_count = segment_count
+        self.files = {} # Open files by segment index.
+        self.buffers = {} # Lines not written yet, by segment index.
+        self.created = 0 # Number of segment files created.
+        self.temp_files = {} # Temporary file of each segment, by segment index.
+
+    # Return the segment of a time, and the time relative to the start of the segment.
+    def locate(self, time):
+        if self.segment_length == 0:
+            return 0, time
+            
+        index = int(time // self.segment_length)
+        
+        if self.segment_count:
+            # The end of the last segment is rounded up.
+            index = min(index, self.segment_count - 1)
+            
+        return index, time - index * self.segment_length
+
+    # Same as locate, for a NumPy array of times: return the arrays of segments and relative times.
+    def locate_batch(self, times):
+        numpy = import_numpy()
+        
+        if self.segment_length == 0:
+            return numpy.zeros(len(times), dtype=numpy.int64), times
+            
+        indexes = (times // self.segment_length).astype(numpy.int64)
+        
+        if self.segment_count:
+            numpy.minimum(indexes, self.segment_count - 1, out=indexes)
+            
+        return indexes, times - indexes * self.segment_length
+
+    def get_file_name(self, index):
+        if self.segment_length == 0:
+            return self.output_file
+            
+        return get_segment_file_name(self.output_file, index)
+
+    # Return the file written for a segment. The temporary file keeps the extensions (compression).
+    def get_temp_file_name(self, index):
+        file_name = self.get_file_name(index)
+        
+        if self.live:
+            return file_name
+            
+        directory, name = os.path.split(file_name)
+        return self.temp_files.setdefault(index, os.path.join(directory, f'.tmp-{os.getpid()}-{id(self):x}-{name}'))
+
+    # Return the open file of a segment. Every segment before it gets a file too, even without comments.
+    def get(self, index):
+        f = self.files.get(index)
+        
+        if f is not None:
+            return f
+            
+        if index < self.created:
+            f = open_text_file(self.get_temp_file_name(index), mode='a', buffering=WRITE_BUFFER_SIZE)
+        else:
+            while self.created <= index:
+                f = open_text_file(self.get_temp_file_name(self.created), mode='w', buffering=WRITE_BUFFER_SIZE)
+                f.write(self.header) # Write file header.
+                self.files[self.created] = f
+                self.buffers[self.created] = []
+                self.created = self.created + 1
+        
+        self.files[index] = f
+        self.buffers.setdefault(index, [])
+        
+        for old_index in [i for i in self.files if i < index - 1]:
+            self.flush(old_index)
+            self.files.pop(old_index).close()
+            del self.buffers[old_index]
+            
+        return f
+
+    # Add a line to a segment.
+    def write(self, index, line):
+        if index not in self.files:
+            self.get(index)
+            
+        if self.live:
+            f = self.files[index]
+            f.write(line)
+            f.flush()
+            return
+            
+        buffer = self.buffers[index]
+        buffer.append(line)
+        
+        if len(buffer) >= WRITE_BATCH:
+            self.flush(index)
+
+    # Add lines to a segment (not live).
+    def write_lines(self, index, lines):
+        if index not in self.files:
+            self.get(index)
+            
+        buffer = self.buffers[index]
+        buffer.extend(lines)
+        
+        if len(buffer) >= WRITE_BATCH:
+            self.flush(index)
+
+    def flush(self, index):
+        self.files[index].write(''.join(self.buffers[index]))
+        self.buffers[index].clear()
+
+    def close(self):
+        # Split into N parts: every part has a file.
+        self.get(max(self.segment_count, self.created, 1) - 1)
+        
+        for index, f in self.files.items():
+            self.flush(index)
+            f.write(self.footer)
+            f.close()
+            
+        if self.footer:
+            # Segments closed before the end.
+            for index in range(self.created):
+                if index not in self.files:
+                    with open_text_file(self.get_temp_file_name(index), mode='a') as f:
+                        f.write(self.footer)
+            
+        for index, temp_file in self.temp_files.items():
+            os.replace(temp_file, self.get_file_name(index))
+            
+        self.files = {}
+        self.buffers = {}
+        self.temp_files = {}
+
+    # Close the output after an error: remove the temporary files, the existing output is kept.
+    # A live output is what was written so far: it is closed with its footer.
+    def discard(self):
+        if self.live:
+            self.close()
+            return
+            
+        for f in self.files.values():
+            with contextlib.suppress(Exception):
+                f.close()
+                
+        for temp_file in self.temp_files.values():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_file)
+            
+        self.files = {}
+        self.buffers = {}
+        self.temp_files = {}
+
+
+# Convert items dictionary and write as subtitle file.
+# With a segment length (in seconds), write one file per segment instead, in the same pass.
+# Times in each segment file start from the start of the segment.
+# When live, the header is written first and every line is flushed as soon as its item arrives.
+# With a Profile, the time to format and write each item is added to the 'serialize' stage.
+# Each item is written in every format of formats (keys of OUTPUT_FORMATS), each one to its own
+# output file, named with the extension of the format (see get_output_file_name).
+# With batched, items are batches of items (see place_comments_batched), written with write_batch.
+def output_as_subtitle(items, play_res_x, play_res_y,  font_size, output_file, visible_time, comment_color, segment_length=0, segment_count=0, live=False, profile=None, formats=('ass',), batched=False):
+    outputs = []
+    
+    for name in formats:
+        serializer = OUTPUT_FORMATS[name](play_res_x, font_size, visible_time, comment_color, play_res_y)
+        file_name = get_output_file_name(output_file, name, len(formats) > 1)
+        outputs.append((SegmentFiles(file_name, serializer.header(), segment_length, segment_count, live, serializer.footer), serializer))
+    
+    # Write the comments as subtitle.
+    try:
+        if live:
+            for files, serializer in outputs:
+                files.get(0).flush()
+            
+        if profile is not None:
+            items = iter_profiled_serialize(items, profile, batched)
+            
+        if batched:
+            for batch in items:
+                for files, serializer in outputs:
+                    write_batch(files, serializer, batch)
+                    
+        elif len(outputs) == 1:
+            files, serializer = outputs[0]
+            
+            for item in items:
+                index, time = files.locate(item['time'])
+                
+                # Write a comment to output file.
+                files.write(index, serializer.format(item, time, index))
+                
+        else:
+            for item in items:
+                for files, serializer in outputs:
+                    index, time = files.locate(item['time'])
+                    files.write(index, serializer.format(item, time, index))
+            
+    except BaseException:
+        for files, serializer in outputs:
+            files.discard()
+            
+        raise
+        
+    for files, serializer in outputs:
+        files.close()
+
+
+# Write a batch of items (see place_comments_batched) to the segment files of a serializer.
+# Serializers without a format_batch method format the items one at a time.
+def write_batch(files, serializer, batch):
+    numpy = import_numpy()
+    segments, times = files.locate_batch(batch['time'])
+    format_batch = getattr(serializer, 'format_batch', None)
+    
+    if format_batch is not None:
+        lines = format_batch(batch, times, segments)
+    else:
+        lines = [serializer.format(item, time, segment) for item, time, segment in zip(iter_batch_items(batch), times.tolist(), segments.tolist())]
+        
+    # Runs of consecutive lines of the same segment.
+    bounds = [0, *(numpy.flatnonzero(numpy.diff(segments)) + 1).tolist(), len(lines)]
+    
+    for start, end in zip(bounds, bounds[1:]):
+        files.write_lines(int(segments[start]), lines[start:end])
+
+
+# Library API.
+#
+# Converter converts comments in the calling process, eg. in a service: it prints nothing,
+# and errors raise ConversionError instead of exiting.
+
+
+# Error of a conversion made with a Converter.
+class ConversionError(Exception):
+    pass
+
+
+# Turn the sys.exit(message) of the command line functions into a ConversionError.
+@contextlib.contextmanager
+def raise_conversion_errors():
+    try:
+        yield
+    except SystemExit as e:
+        raise ConversionError(e.code) from None
+
+
+# Comment with only the fields used by the conversion.
+class CommentRecord:
+    __slots__ = ('offset', 'body', 'user_id', 'name')
+
+    def __init__(self, offset, body, user_id, name):
+        self.offset = offset
+        self.body = body
+        self.user_id = user_id
+        self.name = name
+
+    # Return the record of a TwitchDownloader comment.
+    @classmethod
+    def from_comment(cls, comment):
+        commenter = comment['commenter']
+        return cls(comment['content_offset_seconds'], comment['message']['body'], commenter['_id'], commenter['name'])
+
+    def __eq__(self, other):
+        return isinstance(other, CommentRecord) and (self.offset, self.body, self.user_id, self.name) == (other.offset, other.body, other.user_id, other.name)
+
+    def __repr__(self):
+        return f'CommentRecord({self.offset!r}, {self.body!r}, {self.user_id!r}, {self.name!r})'
+
+
+# Same as filter_comments, for CommentRecords and compiled ban lists (see compile_ban_lists).
+def filter_records(records, remove_words, banned_words, banned_users, critical_words):
+    for record in records:
+        message, category = filter_message(record.body, record.user_id, record.name, remove_words, banned_words, banned_users, critical_words)
+        yield record.offset, message, category, (record.user_id, record.name)
+
+
+# CommentRecords sorted by time, with the column of their offsets: the records of a time range are
+# found by binary search (see select_record_range). Built once, eg. by Converter.load, then only read.
+class RecordList(list):
+    def __init__(self, records):
+        super().__init__(record if isinstance(record, CommentRecord) else CommentRecord.from_comment(record) for record in records)
+        self.offsets = array('d', (record.offset for record in self))
+        
+        if any(a > b for a, b in zip(self.offsets, islice(self.offsets, 1, None))):
+            self.sort(key=lambda record: record.offset)
+            self.offsets = array('d', (record.offset for record in self))
+
+
+# Return the records between start and end time. A RecordList is sliced by binary search, and
+# another list is made into one first; any other iterable is read to the end (see iter_time_range).
+def select_record_range(records, start_time, end_time):
+    if not isinstance(records, list):
+        return iter_record_range(records, start_time, end_time)
+        
+    if not isinstance(records, RecordList):
+        records = RecordList(records)
+        
+    first = bisect.bisect_left(records.offsets, start_time)
+    last = len(records) if end_time == 0 else bisect.bisect_right(records.offsets, end_time, first)
+    
+    return records[first:last]
+
+
+def iter_record_range(records, start_time, end_time):
+    for record in records:
+        if not isinstance(record, CommentRecord):
+            record = CommentRecord.from_comment(record)
+            
+        if record.offset >= start_time and (end_time == 0 or record.offset <= end_time):
+            yield record
+
+
+# Converter with preloaded ban lists and style, for many conversions in one process.
+# The options are the same as the command line ones (times in seconds); ban_lists (from
+# compile_ban_lists) can be passed instead of ban_file. The widths of the messages are cached
+# across conversions.
+class Converter:
+    def __init__(self, ban_file=None, play_res_x=854, play_res_y=480, font_size=36, visible_time=7, comment_color='White', lane_policy='overlay', formats=('ass',), font_metrics=None, retroactive=False, dedup_window=0, max_per_second=0, max_on_screen=0, ban_lists=None):
+        if min(play_res_x, play_res_y, font_size, visible_time) < 1:
+            raise ConversionError('play_res_x, play_res_y, font_size and visible_time must be 1 or greater.')
+            
+        if lane_policy not in LANE_POLICIES:
+            raise ConversionError(f"lane_policy must be one of {', '.join(LANE_POLICIES)}.")
+            
+        unknown = [name for name in formats if name not in OUTPUT_FORMATS]
+        if unknown or not formats:
+            raise ConversionError(f"formats must be among {', '.join(OUTPUT_FORMATS)}.")
+            
+        self.comment_color = get_style(None, None, comment_color)
+        
+        if self.comment_color is None:
+            raise ConversionError('comment_color must be White, Blue, Red or Green.')
+            
+        with raise_conversion_errors():
+            self.ban_lists = ban_lists if ban_lists is not None else compile_ban_lists(*load_ban_file(ban_file))
+            font_advances = None if font_metrics is None else load_font_advances(font_metrics)
+            
+        self.play_res_x = play_res_x
+        self.play_res_y = play_res_y
+        self.font_size = font_size
+        self.visible_time = visible_time
+        self.lane_policy = lane_policy
+        self.formats = list(formats)
+        self.retroactive = retroactive
+        self.density = (dedup_window, max_per_second, max_on_screen)
+        self.measure = TextMeasure(font_size, font_advances).measure
+
+    # Return the comments of a chat file as a RecordList, to convert many clips of it.
+    def load(self, input_file):
+        with raise_conversion_errors():
+            return RecordList(iter_json_comments(input_file))
+
+    # Yield the items (see process_comments) of comments between start and end time.
+    # comments is an iterable of TwitchDownloader comments or CommentRecords. The counters are stored in the stats dictionary if given.
+    def iter_items(self, comments, start_time=0, end_time=0, stats=None):
+        if start_time < 0 or end_time < 0 or (end_time != 0 and start_time >= end_time):
+            raise ConversionError(f'Start time {start_time}s must be lower than end time {end_time}s.')
+            
+        moderation = Moderation()
+        density = DensityControl(*self.density, self.visible_time) if any(self.density) else None
+        layout = LaneLayout(self.play_res_x, self.play_res_y, self.font_size, self.visible_time, self.lane_policy)
+        item_counter = 0
+        
+        records = select_record_range(comments, start_time, end_time)
+        kept = moderate_comments(filter_records(records, *self.ban_lists), moderation, self.retroactive)
+        
+        if density is not None:
+            kept = density.reduce(kept)
+            
+        for item in place_comments(kept, start_time, layout.place, self.measure):
+            item_counter = item_counter + 1
+            yield item
+            
+        if stats is not None:
+            stats.update({'in_range': moderation.judged, 'after': item_counter, 'deleted': moderation.deleted, 'deleted_by': dict(moderation.counts), 'dropped': layout.dropped})
+            
+            if density is not None:
+                stats.update({'merged': density.merged, 'rate_limited': density.rate_limited, 'screen_limited': density.screen_limited})
+
+    # Write the comments between start and end time to output_file (one file per format, see
+    # output_as_subtitle), split every split_every seconds if not 0. Return the counters.
+    def convert(self, comments, output_file, start_time=0, end_time=0, split_every=0):
+        stats = {}
+        
+        with raise_conversion_errors():
+            try:
+                output_as_subtitle(self.iter_items(comments, start_time, end_time, stats), self.play_res_x, self.play_res_y, self.font_size, output_file,
+                                   self.visible_time, self.comment_color, split_every, formats=self.formats)
+            except OSError as e:
+                raise ConversionError(f'Could not write {output_file}: {e}') from e
+                
+        return stats
+
+    # Convert a chat file, read as a stream. Return the counters.
+    def convert_file(self, input_file, output_file, start_time=0, end_time=0, split_every=0):
+        return self.convert(iter_json_comments(input_file), output_file, start_time, end_time, split_every)
+
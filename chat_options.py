@@ -0,0 +1,34 @@
+#========================================================
+#  Values of the command line options, shared by the command line (chat_to_subtitle.py) and
+#  the conversion engine (chat_converter.py). Kept apart so that --help and the option errors
+#  do not import the engine.
+#========================================================
+
+import os
+
+
+# Return the style name that corresponds the user input.
+def get_style(ctx, param, value):
+    color = value.lower()
+    
+    if color == 'white':
+        return 'danmakuWhite'
+        
+    elif color == 'blue':
+        return 'danmakuBlue'
+        
+    elif color == 'red':
+        return 'danmakuRed'
+        
+    elif color == 'green':
+        return 'danmakuGreen'
+
+
+# Output formats, the keys of chat_converter.OUTPUT_FORMATS.
+FORMAT_NAMES = ['ass', 'srt', 'vtt', 'xml', 'nico']
+
+# What to do with a comment when every lane is full.
+LANE_POLICIES = ['drop', 'overlay', 'queue']
+
+# Default directory of the result cache.
+RESULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'chat-converter')
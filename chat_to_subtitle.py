@@ -1,20 +1,23 @@
 #========================================================
 #  Convert twitch comments downloaded by TwitchDownloader to ass subtitle format.
+#  Command line of the conversion engine (chat_converter.py). This script is kept small:
+#  run as a script, it is compiled on every start, while the engine is imported from its
+#  cached bytecode, and only to convert: --help and the option errors do not import it.
 #========================================================
 
-# Todo:
-# - Exception handling (File not found,...)
-# - Add tests (use pytest)
-# - Add styles to comments (color, big, static)
-# - Divide chat: per 3 hour, or eg. 3分割 指定時間でコメント分割
-# - Smaller functions
-# - Implement better comments display algorythm
-# - Make a class of arguments?
+import sys, click
+from chat_options import get_style, FORMAT_NAMES, LANE_POLICIES, RESULT_CACHE_DIR
 
 
-import json, os, sys, re, click
-from datetime import timedelta
-from rich import print
+# The engine, also re-exported here for the scripts that import chat_to_subtitle
+# (chat_to_subtitle.convert_file...). It is imported with the first name used.
+def __getattr__(name):
+    import chat_converter
+    
+    try:
+        return getattr(chat_converter, name)
+    except AttributeError:
+        raise AttributeError(f"module 'chat_to_subtitle' has no attribute '{name}'") from None
 
 
 # Validate start time and end time parameters.
@@ -44,21 +47,46 @@ def validate_time(ctx, param, value):
         raise click.BadParameter("The format must be 'h:m:s'")
 
 
-# Return the style name that corresponds the user input.
-def get_style(ctx, param, value):
-    color = value.lower()
+# Return the list of output formats of a comma separated value, eg. 'ass,vtt'.
+def validate_formats(ctx, param, value):
+    formats = [name.strip().lower() for name in value.split(',') if name.strip()]
     
-    if color == 'white':
-        return 'danmakuWhite'
-        
-    elif color == 'blue':
-        return 'danmakuBlue'
+    unknown = [name for name in formats if name not in FORMAT_NAMES]
+    if unknown or not formats:
+        raise click.BadParameter(f"Formats must be among {', '.join(FORMAT_NAMES)}.")
         
-    elif color == 'red':
-        return 'danmakuRed'
+    # Without duplicates, in order.
+    return list(dict.fromkeys(formats))
+
+
+# Return the variants of --variant values: WIDTHxHEIGHT:FONT_SIZE:COLOR:VISIBLE_TIME, eg. 1280x720:48:Red:7
+def validate_variants(ctx, param, values):
+    variants = []
+    
+    for value in values:
+        try:
+            resolution, font_size, color, visible_time = value.split(':')
+            play_res_x, play_res_y = resolution.lower().split('x')
+            variant = {
+                'play_res_x': int(play_res_x),
+                'play_res_y': int(play_res_y),
+                'font_size': int(font_size),
+                'comment_color': get_style(ctx, param, color),
+                'visible_time': int(visible_time)
+            }
+            
+        except ValueError:
+            raise click.BadParameter(f"'{value}': the format must be 'WIDTHxHEIGHT:FONT_SIZE:COLOR:VISIBLE_TIME', eg. 1280x720:48:Red:7")
+            
+        if min(variant['play_res_x'], variant['play_res_y'], variant['font_size'], variant['visible_time']) < 1:
+            raise click.BadParameter(f"'{value}': values must be 1 or greater.")
+            
+        if variant['comment_color'] is None:
+            raise click.BadParameter(f"'{value}': the color must be White, Blue, Red or Green.")
+            
+        variants.append(variant)
         
-    elif color == 'green':
-        return 'danmakuGreen'
+    return variants
 
 
 @click.command()
@@ -72,12 +100,36 @@ def get_style(ctx, param, value):
 @click.option('--font-size', '-f', type=click.IntRange(1), default=36, help='Font size of comments.')
 @click.option('--visible-time', '-v', type=click.IntRange(1), default=7, help='Time in seconds that comments stay visibles.')
 @click.option('--comment-color', '-c', type=click.Choice(['White', 'Blue', 'Red', 'Green'], case_sensitive=False), default='White', callback=get_style, help='Color of comments displayed.')
-def convert_chat(input_file, output_file, ban_file, start_time, end_time, play_res_x, play_res_y, font_size, visible_time, comment_color):
-
-    # Load the input file (json with comments).
-    data = load_json_file(input_file)
-
-    comments = data['comments'] # Load all comments.
+@click.option('--variant', 'variants', multiple=True, callback=validate_variants, help='Also render the comments with this resolution, font size, color and visible time: WIDTHxHEIGHT:FONT_SIZE:COLOR:VISIBLE_TIME, eg. 1280x720:48:Red:7. Repeat for each variant; the comments are parsed and filtered once, and each variant is written to its own file. Replaces the style options.')
+@click.option('--format', 'formats', default='ass', show_default=True, callback=validate_formats, help='Comma separated output formats among ass, srt, vtt, xml (Bilibili danmaku) and nico (Niconico danmaku), eg. ass,vtt,xml. With several formats, or an output file named with the extension of another format, the extension of the output file is replaced for each one.')
+@click.option('--compress', type=click.Choice(['gz', 'bz2', 'xz']), help='Compress the output files, adding this extension to their name. Output files named .gz, .bz2 or .xz are always compressed. Compressed input files are detected and read as a stream.')
+@click.option('--split-every', type=click.UNPROCESSED, callback=validate_time, default='0:0:0', help='Split the output in one file per time span. Parameter format: h:m:s')
+@click.option('--split-into', type=click.IntRange(1), default=1, help='Split the output in this number of files of the same time span.')
+@click.option('--chat-cache', is_flag=True, help='Build a columnar cache of the input file next to it. Later runs load a fresh cache instead of parsing the json file.')
+@click.option('--follow', is_flag=True, help='The input file is a growing feed of comments, one json object per line. Convert new comments as they arrive (stop with Ctrl+C).')
+@click.option('--follow-timeout', type=click.IntRange(0), default=0, help='With --follow, stop after this number of seconds without new comments. 0: never stop.')
+@click.option('--retroactive', is_flag=True, help='Also delete the earlier comments of a user who writes a critical word.')
+@click.option('--font-metrics', help='Advance widths of the font of the player, to measure comments: a .ttf/.otf font (needs fontTools) or a json file {"units_per_em": 2048, "advances": {"a": 1139, ...}}.')
+@click.option('--dedup-window', type=click.FloatRange(0), default=0, help='Show the same (or nearly the same) message sent again within this number of seconds once, as "message ×N". 0: no merging.')
+@click.option('--max-per-second', type=click.IntRange(0), default=0, help='Keep at most this number of comments per second, sampled fairly among the comments of each second. 0: no limit.')
+@click.option('--max-on-screen', type=click.IntRange(0), default=0, help='Maximum number of comments on screen at once. 0: no limit.')
+@click.option('--profile', is_flag=True, help='Print the time, comments/s and match counts of each processing stage.')
+@click.option('--profile-memory', is_flag=True, help='With --profile or --stats-json, also trace the peak memory of each stage (slower).')
+@click.option('--stats-json', help='Write the profile of the conversion to this json file.')
+@click.option('--no-cache', is_flag=True, help='Always convert, without looking up or storing the output in the result cache.')
+@click.option('--cache-dir', default=RESULT_CACHE_DIR, show_default=True, help='Directory of the result cache.')
+@click.option('--cache-size', type=click.IntRange(0), default=512, show_default=True, help='Maximum size of the result cache in MB. The least recently used outputs are removed first.')
+@click.option('--jobs', '-j', type=click.IntRange(1), default=1, show_default=True, help='Number of worker processes for filtering comments.')
+@click.option('--lane-policy', type=click.Choice(LANE_POLICIES), default='overlay', show_default=True, help='What to do with a comment when every lane is full: drop it, show it on an overlay layer, or queue it until a lane is free.')
+@click.option('--pipeline', is_flag=True, help='Read, process and write at the same time, in threads. Faster when the files are on slow or network storage.')
+@click.option('--vectorize', is_flag=True, help='Lay out and write the comments in batches of NumPy arrays (needs numpy). Same output, faster on large chats.')
+def convert_chat(input_file, output_file, ban_file, start_time, end_time, play_res_x, play_res_y, font_size, visible_time, comment_color, font_metrics, variants, formats, compress, split_every, split_into, chat_cache, follow, follow_timeout, retroactive, dedup_window, max_per_second, max_on_screen, profile, profile_memory, stats_json, no_cache, cache_dir, cache_size, jobs, lane_policy, pipeline, vectorize):
+    import json, os
+    from chat_converter import (print, use_rich_output, convert_hms_to_seconds, split_file_name, import_numpy, load_font_advances, Profile, DensityControl,
+                                get_output_file_name,
+                                ResultCache, get_result_key, convert_variants, convert_file, print_profile)
+    
+    use_rich_output()
 
     start_time_in_seconds = convert_hms_to_seconds(start_time)
     end_time_in_seconds = convert_hms_to_seconds(end_time)
@@ -90,242 +142,102 @@ def convert_chat(input_file, output_file, ban_file, start_time, end_time, play_r
     elif (end_time_in_seconds != 0 and 
     start_time_in_seconds > end_time_in_seconds):
         sys.exit(f'Start time {start_time_in_seconds}s is greater than end time {end_time_in_seconds}s. Change one of them.')
-
-    print(f'Output range: {start_time[0]}:{start_time[1]}:{start_time[2]} ~ {end_time[0]}:{end_time[1]}:{end_time[2]}')
-    print(f'Comments before: {len(comments)}')
-    
-    # Process each comment and return formatted list.
-    items = process_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, play_res_y, font_size)
-
-    # Write comments in the items list to subtitle file.
-    output_as_subtitle(items, play_res_x, play_res_y,  font_size, output_file, visible_time, comment_color)
-
-
-# Load a json file (with comments data).
-def load_json_file(input_file):
-    try: 
-        with open(input_file, mode='r', encoding="utf8") as f:
-            return json.load(f)
-            
-    except ValueError:
-        sys.exit(f'The {input_file} is not a json file.')
         
-    except FileNotFoundError as e:
-        sys.exit(f'File {input_file} not found. Confirm the file name.')
-
-
-# Load the ban file and returns each list.
-# {
-#     "word_only": [], # ban the word only
-#     "whole_comment": [], # ban the whole comment
-#     "user": [], # ban the user
-#     "critical_word": [], # ban the comment and the user
-# }
-#
-def load_ban_file(ban_file):
-    if ban_file == None:
-        return [], [], [], []
-
-    dicts = load_json_file(ban_file)
+    split_every_in_seconds = convert_hms_to_seconds(split_every)
     
-    try:
-        # List of words to remove from a comment. (Delete the word only)
-        remove_words = dicts["word_only"]
-
-        # List of words. (Delete whole comment)
-        banned_words = dicts["whole_comment"] 
+    if split_every_in_seconds != 0 and split_into != 1:
+        sys.exit('Use either --split-every or --split-into, not both.')
         
-        # List of user ids and names.
-        banned_users = dicts["user"] 
+    if follow and (jobs != 1 or split_into != 1):
+        sys.exit('--follow can not be used with --jobs or --split-into.')
         
-        # List of words that bans also the user. (Delete whole comment)
-        banned_critical_word = dicts["critical_word"]
+    if pipeline and (follow or profile or stats_json or jobs != 1):
+        sys.exit('--pipeline can not be used with --follow, --profile, --stats-json or --jobs: the stages already run in threads.')
         
-        if (not isinstance(remove_words, list) or
-            not isinstance(banned_words, list) or
-            not isinstance(banned_users, list) or
-            not isinstance(banned_critical_word, list)):
-                sys.exit("All values must be in lists.")
+    if follow and (compress or split_file_name(output_file)[2]):
+        sys.exit('--follow can not write a compressed file: each comment is flushed as soon as it arrives.')
         
-        return remove_words, banned_words, banned_users, banned_critical_word
-
-    except KeyError as e:
-        sys.exit("The ban file does not contain all required keys.\n The file must contain: 'word_only', 'whole_comment', 'user', and 'critical_word' keys.")
-
-
-# Check if the comment time is out of range (between start and end time).
-def is_out_of_range(comment, start_time, end_time):  
-    time = comment['content_offset_seconds']
-    
-    if time < start_time:
-        return True
+    if follow and vectorize:
+        sys.exit('--follow can not be used with --vectorize: comments are written one at a time as they arrive.')
         
-    if end_time != 0 and time > end_time:
-        return True
-    
-    return False
-
-
-# Check if the comment includes a banned word.
-def is_banned_comment(comment, banned_words):       
-    if len(banned_words) == 0:
-        return False
-
-    for banned_word in banned_words:
-        if banned_word in comment['message']['body']:
-            return True
-
-    return False
-
-
-# Check if the comment is from a banned user.
-def is_banned_user(comment, banned_users):    
-    if len(banned_users) == 0:
-        return False
+    if follow and retroactive:
+        sys.exit('--follow can not be used with --retroactive: comments are written before the later ones are read.')
         
-    if (comment['commenter']['name'] in banned_users or comment['commenter']['_id'] in banned_users):
-        return True
+    if (profile or stats_json) and jobs != 1:
+        sys.exit('--profile and --stats-json need --jobs 1: the filtering stages run in this process only.')
         
-    return False
-
-
-# Remove words from a comment.
-def clean_up_comment(message, remove_words):
-    # message = comment['message']['body']
+    if variants and (follow or profile or stats_json or vectorize or pipeline):
+        sys.exit('--variant can not be used with --follow, --profile, --stats-json, --vectorize or --pipeline.')
+        
+    if vectorize:
+        import_numpy()
+        
+    profiler = Profile(profile_memory) if (profile or stats_json) else None
     
-    if len(remove_words) == 0:
-        return message
+    if compress and split_file_name(output_file)[2] != '.' + compress:
+        output_file = f'{output_file}.{compress}'
         
-    for remove_word in remove_words:
-        message = re.sub(remove_word, '', message)
+    if len(formats) == 1:
+        # Eg. --format vtt with the default chat.ass writes chat.vtt.
+        output_file = get_output_file_name(output_file, formats[0])
         
-    return message.strip()
-
-
-# Text modifications.
-def substitute_text(comment):
-    # Substitute '.' to one white space ('.' causes file loading error)
-    message = comment['message']['body'].replace('.', ' ')
+    font_advances = None if font_metrics is None else load_font_advances(font_metrics)
+    density = None
     
-    # Convert 4 or more w's to www.
-    message = re.sub('[wWｗＷ]{4,}', 'www', message)
+    if dedup_window or max_per_second or max_on_screen:
+        density = DensityControl(dedup_window, max_per_second, max_on_screen, visible_time)
 
-    return message
-
-
-# Convert a list: [hour, minutes, seconds] to seconds.
-def convert_hms_to_seconds(hms):
-    td = timedelta(hours=int(hms[0]), minutes=int(hms[1]), seconds=int(hms[2]))
-    return int(td.total_seconds())
-
-
-# TODO: Create smaller funcitions.
-def process_comments(comments, start_time_in_seconds, end_time_in_seconds, ban_file, play_res_y, font_size):
-    deleted_comment_counter = 0
-    items = [] # Store processed comment data.
-    
-    # List of user names, ids and comments that are banned.
-    # If ban file was not passed as command line argument, return empty lists.
-    remove_words, banned_words, banned_users, banned_critical_word = load_ban_file(ban_file)
+    print(f'Output range: {start_time[0]}:{start_time[1]}:{start_time[2]} ~ {end_time[0]}:{end_time[1]}:{end_time[2]}')
     
-    for comment in comments:
-        #
-        # TODO: validate comment here. Fields exist, etc.
-        #
+    # Only single file conversions of a complete chat file are cached. A profile needs a real conversion.
+    cache = None
+    if not (no_cache or follow or profiler or variants or split_every_in_seconds or split_into != 1 or len(formats) != 1) and os.path.isfile(input_file):
+        cache = ResultCache(cache_dir, cache_size * 1024 * 1024)
+        options = {
+            'start_time': start_time_in_seconds,
+            'end_time': end_time_in_seconds,
+            'play_res_x': play_res_x,
+            'play_res_y': play_res_y,
+            'font_size': font_size,
+            'visible_time': visible_time,
+            'comment_color': comment_color,
+            'lane_policy': lane_policy,
+            'retroactive': retroactive,
+            'dedup_window': dedup_window,
+            'max_per_second': max_per_second,
+            'max_on_screen': max_on_screen,
+            'font_advances': font_advances,
+            'format': formats[0],
+            'compression': split_file_name(output_file)[2]
+        }
+        key = get_result_key(input_file, ban_file, options, cache.hash_file)
+        
+        if cache.fetch(key, output_file):
+            print(f'Same input, ban file and options as a previous conversion: copied the cached output to {output_file}')
+            return
     
+    if variants:
+        convert_variants(input_file, output_file, ban_file, start_time_in_seconds, end_time_in_seconds, variants, chat_cache, jobs, lane_policy, split_every=split_every_in_seconds, split_into=split_into, retroactive=retroactive, density=density, font_advances=font_advances, formats=formats)
+        return
     
-        if is_out_of_range(comment, start_time_in_seconds, end_time_in_seconds):
-            # skip out of range comment.
-            continue
-
-        if (is_banned_comment(comment, banned_users) or is_banned_user(comment, banned_words)):
-            # Delete a comment of a banned user or containing a banned word.
-            deleted_comment_counter = deleted_comment_counter + 1
-            continue
-               
-        # Substitute the comment text partially.
-        message = substitute_text(comment)
-        
-        # Delete undesired words from a comment.
-        message = clean_up_comment(message, remove_words)
-        
-        if len(message) == 0:
-            # Skip empty comment.
-            deleted_comment_counter = deleted_comment_counter + 1
-            continue
-        
-        i = len(items) # Processed comments quantity.
+    try:
+        convert_file(input_file, output_file, ban_file, start_time_in_seconds, end_time_in_seconds, play_res_x, play_res_y, font_size, visible_time, comment_color, chat_cache, jobs, lane_policy, split_every=split_every_in_seconds, split_into=split_into, follow=follow, follow_timeout=follow_timeout, profile=profiler, retroactive=retroactive, density=density, font_advances=font_advances, formats=formats, vectorize=vectorize, pipeline=pipeline)
         
-        # Load comment time and adjust it considering the start time.
-        time = comment['content_offset_seconds'] - start_time_in_seconds
+    except KeyboardInterrupt:
+        if not follow:
+            raise
+            
+        print('Stopped following the feed.')
         
-        # TODO: Implement better comments display algorythm
-        # Define where to display a comment.
-        # If the current comment is the 1st comment, show it in the first line.
-        # or If the comment's time is greater than 1s after the previous comment, show it in the first line.
-        # or If the previous comment was displayed in the last line of display range, show it in the first line.
-        # Otherwise, show the comment in the next line.
-        if (i == 0 or
-            time - items[i-1]['time'] > 1 or
-            items[i-1]['y'] >= (play_res_y - font_size * 2)):
-            y = 0
-        else:
-            y = items[i-1]['y'] + font_size
+    if cache is not None:
+        cache.store(key, output_file)
         
-        item = {'time': time, 'message': message, 'y': y}
-        items.append(item)
-
-    print(f'Comments after:  {len(items)}')
-    print(f'Comments deleted: {deleted_comment_counter}')
-    
-    return items
-
-
-# Convert items dictionary and write as subtitle file.
-def output_as_subtitle(items, play_res_x, play_res_y,  font_size, output_file, visible_time, comment_color):
-    # Color: &H33BBGGRR
-    s = f"""[Script Info]
-ScriptType: v4.00+
-PlayResX: {play_res_x}
-PlayResY: {play_res_y}
-Aspect Ratio: {play_res_x}:{play_res_y}
-Collisions: Normal
-WrapStyle: 2
-ScaledBorderAndShadow: yes
-YCbCr Matrix: TV.601
-
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: danmakuWhite, sans-serif, {font_size}, &H33FFFFFF, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
-Style: danmakuBlue, sans-serif, {font_size}, &H33FF0000, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
-Style: danmakuRed, sans-serif, {font_size}, &H330000FF, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
-Style: danmakuGreen, sans-serif, {font_size}, &H3300FF00, &H33FFFFFF, &H33000000, &H33000000, 0, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 7, 0, 0, 0, 0
-
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-"""
-
-    # f string doesn't accept backslash.
-    newline = '\n'
-    move_command = '\move'
-
-    # Write the comments as subtitle.
-    with open(output_file, mode='w', encoding="utf8") as f:
-        f.write(s) # Write file header.
+    if profile:
+        print_profile(profiler.report())
         
-        for item in items:
-            time = item['time']
-            td1 = str(timedelta(seconds=time)) + '.00'
-            td2 = str(timedelta(seconds = time + visible_time)) + '.00'
-            
-            message = item['message']
-            
-            y = item['y'] # Comment's height
-            
-            x2 = font_size * len(message) * -1 # Comment's length (display speed)
-
-            # Write a comment to output file.
-            f.write(f'Dialogue: 2,{td1},{td2},{comment_color},,0000,0000,0000,,{{{move_command}(854,{str(y)},{str(x2)},{str(y)})}}{message}{newline}')
+    if stats_json:
+        with open(stats_json, mode='w', encoding="utf8") as f:
+            json.dump(profiler.report(), f, indent=2, ensure_ascii=False)
 
 
 if __name__ == '__main__':
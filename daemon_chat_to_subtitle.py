@@ -0,0 +1,469 @@
+#========================================================
+#  Convert chat clips in a long-running process, over a Unix domain socket.
+#  The compiled ban lists, text measures and recently used chat files stay warm between
+#  conversions, so a short clip costs its conversion only.
+#
+#  Protocol: one json object per line each way, any number of requests per connection.
+#    {"command": "convert", "input_file": "vod.json", "output_file": "clip.ass", "start_time": 60, "end_time": 360,
+#     "ban_file": "ban.json", "options": {"font_size": 48, "comment_color": "Red"}}
+#    {"command": "stats"}
+#    {"command": "stop"}
+#  Responses are {"ok": true, ...} or {"ok": false, "error": "message"}. Paths are read by the
+#  daemon: send absolute paths. As on the command line, an output file named with the extension
+#  of another format gets the extension of its format (clip.ass -> clip.vtt).
+#========================================================
+
+import collections, json, math, os, queue, socket, socketserver, sys, tempfile, threading, time, click
+from chat_to_subtitle import print
+import chat_to_subtitle
+
+
+# Default socket of the daemon.
+DAEMON_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'chat-converter.sock')
+
+# Compiled ban files and Converters (ban lists, style and text measure cache) kept warm.
+BAN_CACHE_SIZE = 16
+CONVERTER_CACHE_SIZE = 64
+
+# Chat files remembered as too large for the cache of parsed chat files.
+STREAMED_FILES_CACHE_SIZE = 1024
+
+# Latencies of the last conversions, for the percentiles.
+LATENCY_WINDOW = 10000
+
+# Options of a convert request, passed to the Converter ('format' is its only output format).
+JOB_OPTIONS = ['play_res_x', 'play_res_y', 'font_size', 'visible_time', 'comment_color', 'lane_policy', 'format', 'font_metrics', 'retroactive', 'dedup_window', 'max_per_second', 'max_on_screen']
+
+
+# Least recently used values, bounded by their number and by the sum of their sizes (0: no limit).
+class LRUCache:
+    def __init__(self, max_entries=0, max_size=0):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = collections.OrderedDict() # Key -> (value, size).
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Return the value of a key, or None.
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    # Store a value, removing the least recently used ones over the limits. A value larger than max_size is not stored.
+    def put(self, key, value, size=1):
+        with self.lock:
+            if self.max_size and size > self.max_size:
+                return
+
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while (self.max_entries and len(self.entries) > self.max_entries) or (self.max_size and self.size > self.max_size):
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def report(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / lookups, 4) if lookups else None}
+
+
+# Return the key of a file in the caches: a changed file is a new key.
+def get_file_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise chat_to_subtitle.ConversionError(f'File {path} not found. Confirm the file name.') from e
+
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+# Approximate memory of a CommentRecord in a list, in bytes.
+RECORD_SIZE = sys.getsizeof(chat_to_subtitle.CommentRecord(0.0, '', '', '')) + sys.getsizeof(0.0) + 8 # Slot in the list.
+
+def get_record_size(record):
+    return RECORD_SIZE + sys.getsizeof(record.body) + sys.getsizeof(record.user_id) + sys.getsizeof(record.name)
+
+
+# Return the value at a percentile (nearest rank) of sorted values, or None.
+def get_percentile(values, percentile):
+    if not values:
+        return None
+
+    return values[max(0, math.ceil(len(values) * percentile / 100) - 1)]
+
+
+# Conversions queued by the connections and run by a pool of worker threads, which share the caches.
+# A job waits in the queue while every worker is busy: its latency counts the wait.
+# The conversions are Python code, run one at a time by the interpreter lock: more workers only
+# overlap the file reads and writes, and a clip waits behind a long conversion with any number of them.
+# A chat file is parsed into the cache until its records reach chat_cache_size (MB). A larger one is
+# streamed from the file by each conversion, in constant memory, like the command line does.
+class Daemon:
+    def __init__(self, jobs=1, chat_cache_size=256):
+        self.ban_lists = LRUCache(BAN_CACHE_SIZE)
+        self.converters = LRUCache(CONVERTER_CACHE_SIZE)
+        self.chat_cache_bytes = chat_cache_size << 20
+        self.chat_files = LRUCache(max_size=self.chat_cache_bytes)
+        self.streamed_files = LRUCache(STREAMED_FILES_CACHE_SIZE) # Keys of the files too large for the cache.
+        self.queue = queue.Queue()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.converted = 0
+        self.failed = 0
+        self.streamed = 0
+        self.started = time.perf_counter()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(jobs)]
+
+        for worker in self.workers:
+            worker.start()
+
+    # Return the response to a request.
+    def handle(self, request):
+        command = request.get('command') if isinstance(request, dict) else None
+
+        if command == 'convert':
+            return self.submit(request)
+
+        if command == 'stats':
+            return {'ok': True, 'stats': self.report()}
+
+        if command == 'stop':
+            return {'ok': True}
+
+        return {'ok': False, 'error': 'The command must be convert, stats or stop.'}
+
+    # Queue a conversion and wait for its response.
+    def submit(self, request):
+        job = {'request': request, 'queued': time.perf_counter(), 'done': threading.Event()}
+        self.queue.put(job)
+        job['done'].wait()
+        return job['response']
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+
+            if job is None:
+                return
+
+            with self.lock:
+                self.running += 1
+
+            try:
+                response = {'ok': True, 'stats': self.convert(job['request'])}
+            except chat_to_subtitle.ConversionError as e:
+                response = {'ok': False, 'error': str(e)}
+            except Exception as e:
+                # Eg. a comment without commenter: only this job fails.
+                response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+            latency = round(time.perf_counter() - job['queued'], 6)
+            response['seconds'] = latency
+
+            with self.lock:
+                self.running -= 1
+                self.latencies.append(latency)
+
+                if response['ok']:
+                    self.converted += 1
+                else:
+                    self.failed += 1
+
+            job['response'] = response
+            job['done'].set()
+
+    # Convert the comments of a convert request and return the counters (see Converter.convert).
+    def convert(self, request):
+        options = request.get('options') or {}
+        unknown = [name for name in options if name not in JOB_OPTIONS]
+
+        if unknown:
+            raise chat_to_subtitle.ConversionError(f"Unknown options: {', '.join(unknown)}.")
+
+        for name in ['input_file', 'output_file']:
+            if not isinstance(request.get(name), str):
+                raise chat_to_subtitle.ConversionError(f'{name} is required.')
+
+        converter = self.get_converter(request.get('ban_file'), options)
+        records = self.get_records(converter, request['input_file'])
+        output_file = chat_to_subtitle.get_output_file_name(request['output_file'], options.get('format', 'ass'))
+
+        # Converted into a temporary file, renamed when the conversion succeeds (the extensions
+        # are kept for the compression): a failed job never leaves a partial output.
+        try:
+            fd, temp_file = tempfile.mkstemp(prefix='.tmp-', suffix='-' + os.path.basename(output_file), dir=os.path.dirname(output_file) or '.')
+            os.close(fd)
+        except OSError as e:
+            raise chat_to_subtitle.ConversionError(f'Could not write {output_file}: {e}') from e
+
+        try:
+            if records is None:
+                stats = converter.convert_file(request['input_file'], temp_file, request.get('start_time', 0), request.get('end_time', 0))
+                
+                with self.lock:
+                    self.streamed += 1
+            else:
+                stats = converter.convert(records, temp_file, request.get('start_time', 0), request.get('end_time', 0))
+                
+            os.replace(temp_file, output_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+        return stats
+
+    # Return the Converter of a ban file and options, compiling the ban file once.
+    def get_converter(self, ban_file, options):
+        ban_key = None if ban_file is None else get_file_key(ban_file)
+        key = (ban_key, json.dumps(options, sort_keys=True))
+        converter = self.converters.get(key)
+
+        if converter is None:
+            ban_lists = self.ban_lists.get(ban_key)
+
+            if ban_lists is None:
+                with chat_to_subtitle.raise_conversion_errors():
+                    ban_lists = chat_to_subtitle.compile_ban_lists(*chat_to_subtitle.load_ban_file(ban_file))
+
+                self.ban_lists.put(ban_key, ban_lists)
+
+            options = dict(options)
+            formats = (options.pop('format', 'ass'),)
+
+            try:
+                converter = chat_to_subtitle.Converter(ban_lists=ban_lists, formats=formats, **options)
+            except TypeError as e:
+                raise chat_to_subtitle.ConversionError(f'Invalid options: {e}') from e
+
+            self.converters.put(key, converter)
+
+        return converter
+
+    # Return the comments of a chat file as a RecordList, parsing the file once while it stays in the cache.
+    # Return None for a file whose records do not fit in the cache: the parsing stops at the limit.
+    def get_records(self, converter, input_file):
+        key = get_file_key(input_file)
+        records = self.chat_files.get(key)
+
+        if records is not None or self.streamed_files.get(key) is not None:
+            return records
+
+        records = []
+        size = sys.getsizeof(records)
+
+        with chat_to_subtitle.raise_conversion_errors():
+            for comment in chat_to_subtitle.iter_json_comments(input_file):
+                record = chat_to_subtitle.CommentRecord.from_comment(comment)
+                size += get_record_size(record)
+
+                if size > self.chat_cache_bytes:
+                    self.streamed_files.put(key, True)
+                    return None
+
+                records.append(record)
+
+        records = chat_to_subtitle.RecordList(records)
+        self.chat_files.put(key, records, size + records.offsets.itemsize * len(records))
+        return records
+
+    # Return the queue depth, counters, latency percentiles and cache statistics.
+    def report(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            report = {'queue_depth': self.queue.qsize(), 'running': self.running, 'workers': len(self.workers), 'converted': self.converted, 'failed': self.failed, 'streamed': self.streamed}
+
+        report['uptime_seconds'] = round(time.perf_counter() - self.started, 3)
+        report['latency_seconds'] = {f'p{percentile}': get_percentile(latencies, percentile) for percentile in [50, 95, 99]}
+        report['caches'] = {'ban_lists': self.ban_lists.report(), 'converters': self.converters.report(), 'chat_files': self.chat_files.report()}
+        return report
+
+    # Stop the workers after the queued jobs.
+    def close(self):
+        for worker in self.workers:
+            self.queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+
+# Answer the requests of a connection, one json object per line.
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+                response = {'ok': False, 'error': 'A request must be a json object on one line.'}
+            else:
+                response = self.server.chat_daemon.handle(request)
+
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+            if isinstance(request, dict) and request.get('command') == 'stop':
+                # shutdown waits for serve_forever to return: not in its thread.
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+# Return a server listening on socket_path for the requests of a daemon (call serve_forever).
+# Only the user of the daemon can connect: the daemon reads and writes any file it is sent.
+def open_server(socket_path, daemon):
+    if os.path.exists(socket_path):
+        if is_daemon_running(socket_path):
+            sys.exit(f'A daemon is already listening on {socket_path}.')
+
+        # Left by a daemon that did not stop cleanly.
+        os.remove(socket_path)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonHandler)
+    server.daemon_threads = True
+    server.chat_daemon = daemon
+    os.chmod(socket_path, 0o600)
+    return server
+
+
+# Send requests to the daemon and return its responses, one per request.
+def send_requests(socket_path, requests, timeout=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+
+        with client.makefile('rwb') as stream:
+            for request in requests:
+                stream.write(json.dumps(request).encode('utf8') + b'\n')
+
+            stream.flush()
+            responses = []
+
+            for request in requests:
+                line = stream.readline()
+
+                if not line:
+                    raise ConnectionError('The daemon closed the connection.')
+
+                responses.append(json.loads(line))
+
+            return responses
+
+
+def send_request(socket_path, request, timeout=None):
+    return send_requests(socket_path, [request], timeout)[0]
+
+
+# Check if a daemon answers on a socket.
+def is_daemon_running(socket_path):
+    try:
+        return send_request(socket_path, {'command': 'stats'}, timeout=5)['ok']
+    except (OSError, ValueError):
+        return False
+
+
+# Send a request from the command line, exiting with the error of the daemon.
+def request_daemon(socket_path, request):
+    try:
+        response = send_request(socket_path, request)
+    except OSError as e:
+        sys.exit(f'Could not reach the daemon on {socket_path}: {e}')
+
+    if not response['ok']:
+        sys.exit(response['error'])
+
+    return response
+
+
+@click.group()
+def cli():
+    chat_to_subtitle.use_rich_output()
+
+
+@cli.command('serve')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET, show_default=True, help='The Unix socket to listen on.')
+@click.option('--jobs', '-j', type=click.IntRange(1), default=1, show_default=True, help='Number of conversions run at the same time; the others wait in the queue. The conversions share one core (threads): more jobs only overlap the file reads and writes.')
+@click.option('--chat-cache-size', type=click.IntRange(0), default=256, show_default=True, help='Maximum memory of the parsed chat files kept for the next conversions, in MB. A larger chat file is streamed from the disk by each conversion.')
+def serve_daemon(socket_path, jobs, chat_cache_size):
+    daemon = Daemon(jobs, chat_cache_size)
+    server = open_server(socket_path, daemon)
+    print(f'Listening on {socket_path} ({jobs} workers).')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+@cli.command('convert')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET, show_default=True, help='The Unix socket of the daemon.')
+@click.option('--input-file', '-i', default='chat.json', show_default=True, required=True, help='The input file: chat file in json format.')
+@click.option('--output-file', '-o', default='chat.ass', show_default=True, help='The output file: chat subtitle in ass format.')
+@click.option('--ban-file', '-b', help='The ban comments and users file.')
+@click.option('--start-time', '-s', type=click.UNPROCESSED, callback=chat_to_subtitle.validate_time, default='0:0:0', help='Start time of comments to output. Parameter format: h:m:s')
+@click.option('--end-time', '-e',  type=click.UNPROCESSED, callback=chat_to_subtitle.validate_time, default='0:0:0', help='End time of comments to output. Parameter format: h:m:s')
+@click.option('--play-res-x', '-x', type=click.IntRange(1), default=854, help='Comment player\'s x resolution.')
+@click.option('--play-res-y', '-y', type=click.IntRange(1), default=480, help='Comment player\'s y resolution.')
+@click.option('--font-size', '-f', type=click.IntRange(1), default=36, help='Font size of comments.')
+@click.option('--visible-time', '-v', type=click.IntRange(1), default=7, help='Time in seconds that comments stay visibles.')
+@click.option('--comment-color', '-c', type=click.Choice(['White', 'Blue', 'Red', 'Green'], case_sensitive=False), default='White', help='Color of comments displayed.')
+@click.option('--format', 'output_format', type=click.Choice(list(chat_to_subtitle.OUTPUT_FORMATS)), default='ass', show_default=True, help='Output format.')
+@click.option('--lane-policy', type=click.Choice(chat_to_subtitle.LANE_POLICIES), default='overlay', show_default=True, help='What to do with a comment when every lane is full.')
+@click.option('--retroactive', is_flag=True, help='Also delete the earlier comments of a user who writes a critical word.')
+def convert_clip(socket_path, input_file, output_file, ban_file, start_time, end_time, play_res_x, play_res_y, font_size, visible_time, comment_color, output_format, lane_policy, retroactive):
+    request = {
+        'command': 'convert',
+        'input_file': os.path.abspath(input_file),
+        'output_file': os.path.abspath(output_file),
+        'ban_file': None if ban_file is None else os.path.abspath(ban_file),
+        'start_time': chat_to_subtitle.convert_hms_to_seconds(start_time),
+        'end_time': chat_to_subtitle.convert_hms_to_seconds(end_time),
+        'options': {
+            'play_res_x': play_res_x,
+            'play_res_y': play_res_y,
+            'font_size': font_size,
+            'visible_time': visible_time,
+            'comment_color': comment_color,
+            'format': output_format,
+            'lane_policy': lane_policy,
+            'retroactive': retroactive
+        }
+    }
+
+    response = request_daemon(socket_path, request)
+    output_file = chat_to_subtitle.get_output_file_name(output_file, output_format)
+    print(f'Converted: {output_file}: {response["stats"]["in_range"]} comments in {response["seconds"]:.3f}s')
+
+
+@cli.command('stats')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET, show_default=True, help='The Unix socket of the daemon.')
+def print_stats(socket_path):
+    print(json.dumps(request_daemon(socket_path, {'command': 'stats'})['stats'], indent=2))
+
+
+@cli.command('stop')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET, show_default=True, help='The Unix socket of the daemon.')
+def stop_daemon(socket_path):
+    request_daemon(socket_path, {'command': 'stop'})
+    print('Stopped.')
+
+
+if __name__ == '__main__':
+    cli()
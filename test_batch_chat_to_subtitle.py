@@ -0,0 +1,129 @@
+import unittest
+import batch_chat_to_subtitle
+import json, os, tempfile, time
+from click.testing import CliRunner
+
+
+# Write a chat file with one comment per body.
+def write_chat_file(path, bodies):
+    comments = [{'content_offset_seconds': i, 'commenter': {'name': 'name-A', '_id': 'id-A'}, 'message': {'body': body}} for i, body in enumerate(bodies)]
+    
+    with open(path, mode='w', encoding="utf8") as f:
+        json.dump({'comments': comments}, f)
+
+
+class TestBatchChatToSubtitle(unittest.TestCase):
+
+#===================================================
+#  find_chat_files
+#===================================================
+    def test_find_chat_files_when_directory_and_glob_overlap_returns_each_file_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['a.json', 'b.json', 'ban.json', 'notes.txt']:
+                open(os.path.join(directory, name), mode='w').close()
+                
+            result = batch_chat_to_subtitle.find_chat_files([directory, os.path.join(directory, 'a*')], os.path.join(directory, 'ban.json'))
+            
+            self.assertEqual(['a.json', 'b.json'], [os.path.basename(path) for path in result])
+            
+    def test_find_chat_files_when_directory_has_compressed_chat_files_returns_them(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['a.json', 'b.json.gz', 'c.json.xz', 'd.ass.gz']:
+                open(os.path.join(directory, name), mode='w').close()
+                
+            result = batch_chat_to_subtitle.find_chat_files([directory])
+            
+            self.assertEqual(['a.json', 'b.json.gz', 'c.json.xz'], [os.path.basename(path) for path in result])
+
+
+#===================================================
+#  get_output_file
+#===================================================
+    def test_get_output_file_when_output_dir_is_none_returns_file_next_to_input(self):
+        result = batch_chat_to_subtitle.get_output_file(os.path.join('chats', 'vod.json'))
+        self.assertEqual(os.path.join('chats', 'vod.ass'), result)
+        
+    def test_get_output_file_when_output_dir_is_set_returns_file_in_output_dir(self):
+        result = batch_chat_to_subtitle.get_output_file(os.path.join('chats', 'vod.json'), 'out')
+        self.assertEqual(os.path.join('out', 'vod.ass'), result)
+        
+    def test_get_output_file_when_input_is_compressed_returns_uncompressed_ass_name(self):
+        result = batch_chat_to_subtitle.get_output_file(os.path.join('chats', 'vod.json.bz2'))
+        self.assertEqual(os.path.join('chats', 'vod.ass'), result)
+
+
+#===================================================
+#  is_up_to_date
+#===================================================
+    def test_is_up_to_date_when_output_does_not_exist_returns_false(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            open(input_file, mode='w').close()
+            
+            result = batch_chat_to_subtitle.is_up_to_date(input_file, os.path.join(directory, 'vod.ass'))
+            self.assertEqual(False, result)
+            
+    def test_is_up_to_date_when_ban_file_is_newer_than_output_returns_false(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file, output_file, ban_file = [os.path.join(directory, name) for name in ['vod.json', 'vod.ass', 'ban.json']]
+            
+            for path in [input_file, output_file, ban_file]:
+                open(path, mode='w').close()
+                
+            now = time.time()
+            os.utime(input_file, (now - 20, now - 20))
+            os.utime(output_file, (now - 10, now - 10))
+            
+            self.assertEqual(True, batch_chat_to_subtitle.is_up_to_date(input_file, output_file))
+            self.assertEqual(False, batch_chat_to_subtitle.is_up_to_date(input_file, output_file, ban_file))
+
+
+#===================================================
+#  convert_batch
+#===================================================
+    def test_convert_batch_when_run_twice_skips_up_to_date_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_chat_file(os.path.join(directory, 'a.json'), ['hello', 'world'])
+            write_chat_file(os.path.join(directory, 'b.json'), ['bye'])
+            output_dir = os.path.join(directory, 'out')
+            
+            runner = CliRunner()
+            first = runner.invoke(batch_chat_to_subtitle.convert_batch, [directory, '-o', output_dir, '-j', '2'])
+            second = runner.invoke(batch_chat_to_subtitle.convert_batch, [directory, '-o', output_dir, '-j', '2'])
+            
+            self.assertEqual(0, first.exit_code, first.output)
+            self.assertIn('2 converted', first.output)
+            self.assertIn('2 up to date', second.output)
+            
+            with open(os.path.join(output_dir, 'a.ass'), encoding="utf8") as f:
+                self.assertIn('}world', f.read())
+                
+    def test_convert_batch_when_a_file_is_not_json_reports_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_chat_file(os.path.join(directory, 'a.json'), ['hello'])
+            
+            with open(os.path.join(directory, 'b.json'), mode='w', encoding="utf8") as f:
+                f.write('not json')
+                
+            result = CliRunner().invoke(batch_chat_to_subtitle.convert_batch, [directory, '-j', '1'])
+            
+            self.assertEqual(1, result.exit_code)
+            self.assertIn('1 converted', result.output)
+            self.assertIn('1 failed', result.output)
+            
+    def test_convert_batch_when_a_comment_has_no_commenter_reports_failure_and_retries_it(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_chat_file(os.path.join(directory, 'a.json'), ['hello'])
+            
+            with open(os.path.join(directory, 'b.json'), mode='w', encoding="utf8") as f:
+                json.dump({'comments': [{'content_offset_seconds': 0, 'message': {'body': 'no commenter'}}]}, f)
+                
+            first = CliRunner().invoke(batch_chat_to_subtitle.convert_batch, [directory, '-j', '1'])
+            second = CliRunner().invoke(batch_chat_to_subtitle.convert_batch, [directory, '-j', '1'])
+            
+            self.assertEqual(1, first.exit_code)
+            self.assertIn('1 converted', first.output)
+            self.assertIn('KeyError', first.output)
+            self.assertEqual(False, os.path.exists(os.path.join(directory, 'b.ass')))
+            self.assertIn('1 up to date, 1 failed', second.output)
+            self.assertEqual(['a.ass', 'a.json', 'b.json'], sorted(os.listdir(directory)))
@@ -1,8 +1,37 @@
 import unittest
 import chat_to_subtitle
+import chat_converter
 import click
+import bz2, gzip, json, lzma, os, pickle, subprocess, sys, tempfile, threading, time
+import xml.dom.minidom
 from unittest.mock import patch
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # The vectorized path is optional.
+
+
+# Build a TwitchDownloader-like comment.
+def make_comment(time, body, name='name-A', _id='id-A'):
+    return {
+        'content_offset_seconds': time,
+        'commenter': {'name': name, '_id': _id},
+        'message': {'body': body}
+    }
+
+
+# Write a chat file in a temporary directory and return its path.
+def write_chat_file(directory, comments, name='chat.json'):
+    path = os.path.join(directory, name)
+    data = {'streamer': {'name': 'streamer'}, 'comments': comments, 'video': {'start': 0, 'end': 100}}
+    
+    with open(path, mode='w', encoding="utf8") as f:
+        json.dump(data, f)
+        
+    return path
+
+
 class TestChatToSubtitle(unittest.TestCase):
 
 #===================================================
@@ -138,7 +167,7 @@ class TestChatToSubtitle(unittest.TestCase):
            "critical_word": ["boring"]
         }
         
-        with patch('chat_to_subtitle.load_json_file', return_value=mock_dict):
+        with patch('chat_converter.load_json_file', return_value=mock_dict):
             result = chat_to_subtitle.load_ban_file(ban_file)
             
             self.assertEqual((["abc", "[a]+", "BibleThump","NotLikeThis"], ["aaa", "bbb"], ["1", "2", "3"], ["boring"]), result)
@@ -154,7 +183,7 @@ class TestChatToSubtitle(unittest.TestCase):
            "user": ["1", "2", "3"]
         }
         
-        with patch('chat_to_subtitle.load_json_file', return_value=mock_dict):
+        with patch('chat_converter.load_json_file', return_value=mock_dict):
             with self.assertRaises(SystemExit):
                 chat_to_subtitle.load_ban_file(ban_file)
                 
@@ -171,7 +200,7 @@ class TestChatToSubtitle(unittest.TestCase):
            "critical_word": "word"
         }
         
-        with patch('chat_to_subtitle.load_json_file', return_value=mock_dict):
+        with patch('chat_converter.load_json_file', return_value=mock_dict):
             with self.assertRaises(SystemExit):
                 chat_to_subtitle.load_ban_file(ban_file)
     
@@ -279,6 +308,22 @@ class TestChatToSubtitle(unittest.TestCase):
 
 #===================================================
 #  clean_up_comment    #=================================================== 
+    def test_clean_up_comment_when_remover_is_compiled_returns_same_as_pattern_list(self):
+        patterns = ["abc", "[a]+", "BibleThump", "NotLikeThis"]
+        remover = chat_to_subtitle.WordRemover(patterns)
+        
+        for message in ["aabcc", " BibleThump hi ", "nothing here", "NotLikeThisabc", ""]:
+            result = chat_to_subtitle.clean_up_comment(message, remover)
+            self.assertEqual(chat_to_subtitle.clean_up_comment(message, patterns), result)
+            
+    def test_clean_up_comment_when_patterns_use_backreference_returns_same_as_pattern_list(self):
+        patterns = ["(x)\\1", "(?i)kappa"]
+        remover = chat_to_subtitle.WordRemover(patterns)
+        
+        result = chat_to_subtitle.clean_up_comment("xx KAPPA y", remover)
+        self.assertEqual("y", result)
+        self.assertIsNone(remover.any_pattern)
+        
 
 
 #===================================================
@@ -302,6 +347,37 @@ class TestChatToSubtitle(unittest.TestCase):
         self.assertEqual("www", result)
 
 
+#===================================================
+#  WordRemover.normalize
+#=================================================== 
+    def test_normalize_when_bodies_repeat_returns_same_as_substitute_and_clean_up(self):
+        bodies = [".a.b.", "wwwwW gg", " Kappa. ", "abc ｗｗｗｗ", "", "aaa", "x.y wwww Kappa"] * 3
+        
+        for patterns in [[], ["abc", "[a]+", "Kappa"], ["(x)\\1", "(?i)y"]]:
+            remover = chat_to_subtitle.WordRemover(patterns)
+            
+            for body in bodies:
+                expected = chat_to_subtitle.clean_up_comment(chat_to_subtitle.substitute_message(body), patterns)
+                self.assertEqual(expected, remover.normalize(body)[0])
+                
+            self.assertEqual((14, 7), (remover.normalize.cache_info().hits, remover.normalize.cache_info().misses))
+            
+    def test_normalize_when_body_is_substituted_returns_substitution_counts(self):
+        remover = chat_to_subtitle.WordRemover(["spam"])
+        
+        result = remover.normalize("a.b. wwwww spam spam")
+        self.assertEqual(("a b  www", (('.', 2), ('[wWｗＷ]{4,}', 1), ('spam', 2))), result)
+        
+    def test_normalize_when_remover_is_pickled_returns_same_with_new_cache(self):
+        remover = chat_to_subtitle.WordRemover(["abc"], cache_size=16)
+        remover.normalize("abc.d")
+        
+        result = pickle.loads(pickle.dumps(remover))
+        
+        self.assertEqual(remover.normalize("abc.d"), result.normalize("abc.d"))
+        self.assertEqual((0, 1, 16), (result.normalize.cache_info().hits, result.normalize.cache_info().misses, result.normalize.cache_info().maxsize))
+
+
 #===================================================
 #  convert_hms_to_seconds
 #=================================================== 
@@ -314,5 +390,1118 @@ class TestChatToSubtitle(unittest.TestCase):
         hms = ['6', '32', '17']
         result = chat_to_subtitle.convert_hms_to_seconds(hms)
         self.assertEqual(23537, result)
+
+
+#===================================================
+#  iter_json_comments
+#=================================================== 
+    def test_iter_json_comments_when_chat_file_is_read_in_small_chunks_returns_all_comments(self):
+        comments = [make_comment(i, 'comment ' + str(i) + ' ｗｗｗ') for i in range(50)]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, comments)
+            result = list(chat_to_subtitle.iter_json_comments(path, chunk_size=7))
+            
+        self.assertEqual(comments, result)
+        
+    def test_iter_json_comments_when_comments_is_empty_returns_nothing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, [])
+            result = list(chat_to_subtitle.iter_json_comments(path))
+            
+        self.assertEqual([], result)
+        
+    def test_iter_json_comments_when_file_is_not_json_raise_SystemExit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chat.json')
+            
+            with open(path, mode='w', encoding="utf8") as f:
+                f.write('{"comments": [{"a": 1}, oops]}')
+                
+            with self.assertRaises(SystemExit):
+                list(chat_to_subtitle.iter_json_comments(path))
+                
+    def test_iter_json_comments_when_file_does_not_exist_raise_SystemExit(self):
+        with self.assertRaises(SystemExit):
+            list(chat_to_subtitle.iter_json_comments('no-such-chat.json'))
+
+
+#===================================================
+#  process_comments
+#=================================================== 
+    def test_process_comments_when_comments_are_an_iterator_yields_items(self):
+        comments = iter([make_comment(0, 'a.b'), make_comment(1, 'c'), make_comment(5, 'd')])
+        
+        result = list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36))
+        
+        self.assertEqual([
+            {'time': 0, 'message': 'a b', 'y': 0, 'layer': 2, 'width': 65},
+            {'time': 1, 'message': 'c', 'y': 0, 'layer': 2, 'width': 22},
+            {'time': 5, 'message': 'd', 'y': 0, 'layer': 2, 'width': 22}
+        ], result)
+
+
+#===================================================
+#  WordMatcher
+#=================================================== 
+    def test_word_matcher_when_word_is_in_text_returns_true(self):
+        matcher = chat_to_subtitle.WordMatcher(['he', 'she', 'his', 'hers'])
+        
+        self.assertEqual(True, matcher.search('ushers'))
+        self.assertEqual(True, matcher.search('ahis'))
+        
+    def test_word_matcher_when_word_is_only_reached_by_failure_link_returns_true(self):
+        matcher = chat_to_subtitle.WordMatcher(['abcd', 'bc'])
+        
+        self.assertEqual(True, matcher.search('xabcx'))
+        
+    def test_word_matcher_when_no_word_is_in_text_returns_false(self):
+        matcher = chat_to_subtitle.WordMatcher(['aaa', 'bbb'])
+        
+        self.assertEqual(False, matcher.search('aabbabab'))
+        
+    def test_word_matcher_when_word_is_empty_returns_true(self):
+        matcher = chat_to_subtitle.WordMatcher([''])
+        
+        self.assertEqual(True, matcher.search('anything'))
+        
+    def test_is_banned_comment_when_matcher_is_compiled_returns_same_as_word_list(self):
+        words = ['aaa', 'bbb', '草']
+        matcher = chat_to_subtitle.WordMatcher(words)
+        
+        for body in ['aaa', 'xbbbx', 'ab', '草生える', '']:
+            comment = make_comment(0, body)
+            self.assertEqual(chat_to_subtitle.is_banned_comment(comment, words), chat_to_subtitle.is_banned_comment(comment, matcher))
+
+
+#===================================================
+#  LaneLayout
+#=================================================== 
+    def test_lane_layout_when_lane_tail_has_not_cleared_uses_next_lane(self):
+        layout = chat_to_subtitle.LaneLayout(854, 480, 36, 7)
+        
+        self.assertEqual((0, 0, 2), layout.place(0, 360))
+        self.assertEqual((0.5, 36, 2), layout.place(0.5, 360))
+        
+    def test_lane_layout_when_lane_tail_has_cleared_reuses_top_lane(self):
+        layout = chat_to_subtitle.LaneLayout(854, 480, 36, 7)
+        layout.place(0, 36)
+        layout.place(0, 36)
+        
+        self.assertEqual((1, 0, 2), layout.place(1, 36))
+        
+    def test_lane_layout_when_faster_comment_would_catch_up_uses_next_lane(self):
+        layout = chat_to_subtitle.LaneLayout(854, 480, 36, 7)
+        layout.place(0, 36)
+        
+        # The tail of the first comment has cleared, but a long comment would catch it up.
+        self.assertEqual((2, 36, 2), layout.place(2, 2000))
+        
+    def test_lane_layout_when_screen_is_full_and_policy_is_drop_returns_none(self):
+        layout = chat_to_subtitle.LaneLayout(854, 72, 36, 7, 'drop')
+        layout.place(0, 360)
+        layout.place(0, 360)
+        
+        self.assertEqual(None, layout.place(0, 360))
+        self.assertEqual(1, layout.dropped)
+        
+    def test_lane_layout_when_screen_is_full_and_policy_is_overlay_returns_overlay_layer(self):
+        layout = chat_to_subtitle.LaneLayout(854, 108, 36, 7, 'overlay')
+        layout.place(0, 360)
+        layout.place(0, 360)
+        layout.place(0, 360)
+        
+        self.assertEqual((0, 18, 3), layout.place(0, 360))
+        
+    def test_lane_layout_when_screen_is_full_and_policy_is_queue_delays_comment(self):
+        layout = chat_to_subtitle.LaneLayout(854, 36, 36, 7, 'queue')
+        layout.place(0, 360)
+        
+        time, y, layer = layout.place(0, 360)
+        
+        self.assertAlmostEqual(7 * 360 / (854 + 360), time)
+        self.assertEqual((0, 2), (y, layer))
+        self.assertEqual(1, layout.queued)
+
+
+#===================================================
+#  select_time_range
+#=================================================== 
+    def test_select_time_range_when_list_is_sorted_returns_comments_in_range(self):
+        comments = [make_comment(t, str(t)) for t in [0, 10, 20, 20, 30, 100, 101]]
+        
+        result = chat_to_subtitle.select_time_range(comments, 20, 100)
+        self.assertEqual([20, 20, 30, 100], [c['content_offset_seconds'] for c in result])
+        
+    def test_select_time_range_when_end_time_is_zero_returns_comments_to_the_end(self):
+        comments = [make_comment(t, str(t)) for t in [0, 10, 20]]
+        
+        result = chat_to_subtitle.select_time_range(comments, 5, 0)
+        self.assertEqual([10, 20], [c['content_offset_seconds'] for c in result])
+        
+    def test_select_time_range_when_list_is_not_sorted_returns_sorted_comments_in_range(self):
+        comments = [make_comment(t, str(t)) for t in [30, 0, 20, 10, 40]]
+        
+        result = chat_to_subtitle.select_time_range(comments, 10, 30)
+        self.assertEqual([10, 20, 30], [c['content_offset_seconds'] for c in result])
+        
+    def test_select_time_range_when_stream_is_not_sorted_returns_every_comment_in_range(self):
+        def stream():
+            for t in [1, 50, 2, 3]:
+                yield make_comment(t, f'm{t}')
+            
+        result = chat_to_subtitle.select_time_range(stream(), 0, 10)
+        self.assertEqual(['m1', 'm2', 'm3'], [c['message']['body'] for c in result])
+
+
+#===================================================
+#  build_chat_cache / ChatCache
+#=================================================== 
+    def test_build_chat_cache_when_cache_is_opened_returns_same_comments(self):
+        comments = [make_comment(i * 0.5, 'コメント ' + str(i), 'name-' + str(i % 3), 'id-' + str(i % 3)) for i in range(20)]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, comments)
+            chat_to_subtitle.build_chat_cache(path, path + '.chatcache')
+            with chat_to_subtitle.open_chat_cache(path) as cache:
+                result = list(cache)
+            
+        self.assertEqual(comments, result)
+        
+    def test_build_chat_cache_when_comments_are_not_sorted_returns_sorted_comments(self):
+        comments = [make_comment(t, str(t)) for t in [3, 1, 2, 0]]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, comments)
+            chat_to_subtitle.build_chat_cache(path, path + '.chatcache')
+            with chat_to_subtitle.open_chat_cache(path) as cache:
+                result = [(c['content_offset_seconds'], c['message']['body']) for c in cache]
+            
+        self.assertEqual([(0, '0'), (1, '1'), (2, '2'), (3, '3')], result)
+        
+    def test_select_time_range_when_comments_are_a_chat_cache_returns_cache_slice(self):
+        comments = [make_comment(t, str(t)) for t in range(10)]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, comments)
+            chat_to_subtitle.build_chat_cache(path, path + '.chatcache')
+            with chat_to_subtitle.open_chat_cache(path) as cache:
+                result = chat_to_subtitle.select_time_range(cache, 3, 5)
+                
+                self.assertIsInstance(result, chat_to_subtitle.ChatCache)
+                self.assertEqual(comments[3:6], list(result))
+        
+    def test_open_chat_cache_when_json_file_changed_returns_none(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, [make_comment(0, 'a')])
+            chat_to_subtitle.build_chat_cache(path, path + '.chatcache')
+            
+            write_chat_file(directory, [make_comment(0, 'a'), make_comment(1, 'b')])
+            
+            self.assertIsNone(chat_to_subtitle.open_chat_cache(path))
+            
+    def test_load_comments_when_build_cache_is_set_returns_chat_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, [make_comment(0, 'a')])
+            
+            self.assertNotIsInstance(chat_to_subtitle.load_comments(path), chat_to_subtitle.ChatCache)
+            self.assertIsInstance(chat_to_subtitle.load_comments(path, True), chat_to_subtitle.ChatCache)
+            self.assertIsInstance(chat_to_subtitle.load_comments(path), chat_to_subtitle.ChatCache)
+
+
+#===================================================
+#  filter_comments_parallel
+#=================================================== 
+    def test_filter_comments_parallel_when_chunks_are_small_returns_same_as_sequential(self):
+        comments = [make_comment(i, ['aaa', 'abc hi', 'wwwww.', 'x'][i % 4], 'name-' + str(i % 5), str(i % 5)) for i in range(50)]
+        ban_lists = chat_to_subtitle.compile_ban_lists(["abc", "[a]+"], ["aaa"], ["1"], [])
+        
+        sequential = list(chat_to_subtitle.filter_comments(comments, *ban_lists))
+        result = list(chat_to_subtitle.filter_comments_parallel(iter(comments), ban_lists, 2, chunk_size=3))
+        
+        self.assertEqual(sequential, result)
+        
+    def test_process_comments_when_jobs_is_2_returns_same_as_sequential(self):
+        comments = [make_comment(i / 3, 'comment ' + str(i) + ' aaa' * (i % 7 == 0), 'name-' + str(i % 5), str(i % 5)) for i in range(3000)]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            ban_file = os.path.join(directory, 'ban.json')
+            
+            with open(ban_file, mode='w', encoding="utf8") as f:
+                json.dump({"word_only": ["comment"], "whole_comment": ["aaa"], "user": ["1"], "critical_word": []}, f)
+                
+            sequential = list(chat_to_subtitle.process_comments(comments, 10, 900, ban_file, 480, 36))
+            result = list(chat_to_subtitle.process_comments(iter(comments), 10, 900, ban_file, 480, 36, jobs=2))
+            
+        self.assertEqual(sequential, result)
+
+
+#===================================================
+#  output_as_subtitle (time split)
+#=================================================== 
+    def read_dialogues(self, path):
+        with open(path, encoding="utf8") as f:
+            return [line.split(',')[1] + ' ' + line.rsplit('}', 1)[1].strip() for line in f if line.startswith('Dialogue:')]
+            
+    def test_output_as_subtitle_when_segment_length_is_set_writes_rebased_segment_files(self):
+        items = [{'time': t, 'message': str(t), 'y': 0, 'layer': 2} for t in [0, 5, 12, 25]]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'chat.ass')
+            chat_to_subtitle.output_as_subtitle(items, 854, 480, 36, output_file, 7, 'danmakuWhite', 10)
+            
+            self.assertEqual(['0:00:00.00 0', '0:00:05.00 5'], self.read_dialogues(os.path.join(directory, 'chat_1.ass')))
+            self.assertEqual(['0:00:02.00 12'], self.read_dialogues(os.path.join(directory, 'chat_2.ass')))
+            self.assertEqual(['0:00:05.00 25'], self.read_dialogues(os.path.join(directory, 'chat_3.ass')))
+            self.assertFalse(os.path.exists(output_file))
+            
+    def test_output_as_subtitle_when_segment_has_no_comment_writes_header_only_file(self):
+        items = [{'time': t, 'message': str(t), 'y': 0, 'layer': 2} for t in [0, 25]]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'chat.ass')
+            chat_to_subtitle.output_as_subtitle(items, 854, 480, 36, output_file, 7, 'danmakuWhite', 10, 4)
+            
+            self.assertEqual([], self.read_dialogues(os.path.join(directory, 'chat_2.ass')))
+            self.assertEqual([], self.read_dialogues(os.path.join(directory, 'chat_4.ass')))
+            
+            with open(os.path.join(directory, 'chat_4.ass'), encoding="utf8") as f:
+                self.assertTrue(f.read().startswith('[Script Info]'))
+                
+    def test_output_as_subtitle_when_segment_count_is_set_puts_late_comments_in_last_segment(self):
+        items = [{'time': t, 'message': str(t), 'y': 0, 'layer': 2} for t in [0, 35]]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'chat.ass')
+            chat_to_subtitle.output_as_subtitle(items, 854, 480, 36, output_file, 7, 'danmakuWhite', 10, 3)
+            
+            self.assertEqual(['0:00:15.00 35'], self.read_dialogues(os.path.join(directory, 'chat_3.ass')))
+            
+    def test_output_as_subtitle_when_items_fail_keeps_existing_output(self):
+        def items():
+            yield {'time': 0, 'message': 'new', 'y': 0, 'layer': 2}
+            raise SystemExit('corrupt input')
+            
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'chat.ass')
+            
+            with open(output_file, mode='w', encoding="utf8") as f:
+                f.write('old')
+                
+            with self.assertRaises(SystemExit):
+                chat_to_subtitle.output_as_subtitle(items(), 854, 480, 36, output_file, 7, 'danmakuWhite', 10, 2)
+                
+            with open(output_file, encoding="utf8") as f:
+                self.assertEqual('old', f.read())
+                
+            self.assertEqual(['chat.ass'], os.listdir(directory))
+            
+    def test_convert_chat_when_input_is_missing_or_corrupt_keeps_existing_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'chat.ass')
+            corrupt_file = os.path.join(directory, 'corrupt.json')
+            
+            with open(output_file, mode='w', encoding="utf8") as f:
+                f.write('old')
+                
+            with open(corrupt_file, mode='w', encoding="utf8") as f:
+                f.write('{"comments": [')
+                
+            for input_file in [os.path.join(directory, 'missing.json'), corrupt_file]:
+                with self.assertRaises(SystemExit):
+                    chat_to_subtitle.convert_chat.main(['-i', input_file, '-o', output_file, '--no-cache'], standalone_mode=False)
+                    
+            with open(output_file, encoding="utf8") as f:
+                self.assertEqual('old', f.read())
+                
+            self.assertEqual(['chat.ass', 'corrupt.json'], sorted(os.listdir(directory)))
+
+
+#===================================================
+#  get_chat_end_time
+#=================================================== 
+    def test_get_chat_end_time_when_video_is_before_comments_returns_video_end(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chat.json')
+            
+            with open(path, mode='w', encoding="utf8") as f:
+                json.dump({'streamer': {'name': 's'}, 'video': {'start': 0, 'end': 3600}, 'comments': [make_comment(0, 'a')]}, f)
+                
+            result = chat_to_subtitle.get_chat_end_time(path, None)
+            
+        self.assertEqual(3600, result)
+        
+    def test_get_chat_end_time_when_video_is_after_comments_returns_none(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_chat_file(directory, [make_comment(0, 'a')])
+            result = chat_to_subtitle.get_chat_end_time(path, None)
+            
+        self.assertEqual(None, result)
+
+
+#===================================================
+#  format_ass_time
+#=================================================== 
+    def test_format_ass_time_when_time_is_zero_returns_zero_timestamp(self):
+        result = chat_to_subtitle.format_ass_time(0)
+        self.assertEqual('0:00:00.00', result)
+        
+    def test_format_ass_time_when_time_has_centiseconds_returns_centiseconds(self):
+        result = chat_to_subtitle.format_ass_time(round(199.7 * 100))
+        self.assertEqual('0:03:19.70', result)
+        
+    def test_format_ass_time_when_time_is_over_a_day_returns_hours(self):
+        result = chat_to_subtitle.format_ass_time(25 * 360000 + 1)
+        self.assertEqual('25:00:00.01', result)
+
+
+#===================================================
+#  DialogueSerializer
+#=================================================== 
+    def test_dialogue_serializer_when_item_is_formatted_returns_dialogue_line(self):
+        serializer = chat_to_subtitle.DialogueSerializer(1280, 36, 7, 'danmakuRed')
+        item = {'time': 65.25, 'message': 'abc', 'y': 72, 'layer': 2}
+        
+        result = serializer.format(item, item['time'])
+        self.assertEqual('Dialogue: 2,0:01:05.25,0:01:12.25,danmakuRed,,0000,0000,0000,,{\\move(1280,72,-108,72)}abc\n', result)
+
+
+#===================================================
+#  follow_jsonl_comments / convert_file (follow)
+#=================================================== 
+    def test_follow_jsonl_comments_when_feed_has_partial_last_line_returns_it_at_timeout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.jsonl')
+            
+            with open(path, mode='w', encoding="utf8") as f:
+                f.write(json.dumps(make_comment(0, 'a')) + '\n\n' + json.dumps(make_comment(1, 'b')))
+                
+            result = list(chat_to_subtitle.follow_jsonl_comments(path, idle_timeout=0.1))
+            
+        self.assertEqual([make_comment(0, 'a'), make_comment(1, 'b')], result)
+        
+    def test_convert_file_when_follow_is_set_writes_comments_while_feed_grows(self):
+        def read_output(path):
+            try:
+                with open(path, encoding="utf8") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return ''
+                
+        def wait_for(path, text):
+            deadline = time.monotonic() + 5
+            while text not in read_output(path) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return read_output(path)
+            
+        with tempfile.TemporaryDirectory() as directory:
+            feed = os.path.join(directory, 'feed.jsonl')
+            output_file = os.path.join(directory, 'chat.ass')
+            open(feed, mode='w').close()
+            
+            thread = threading.Thread(target=chat_to_subtitle.convert_file, args=(feed, output_file, None, 0, 0, 854, 480, 36, 7, 'danmakuWhite'), kwargs={'follow': True, 'follow_timeout': 1})
+            thread.start()
+            
+            with open(feed, mode='a', encoding="utf8") as f:
+                f.write(json.dumps(make_comment(0, 'first')) + '\n')
+                f.flush()
+                self.assertIn('}first', wait_for(output_file, '}first'))
+                
+                # A line written in two parts.
+                line = json.dumps(make_comment(1, 'second')) + '\n'
+                f.write(line[:10])
+                f.flush()
+                time.sleep(0.1)
+                f.write(line[10:])
+                f.flush()
+                self.assertIn('}second', wait_for(output_file, '}second'))
+                
+            thread.join()
+            
+            self.assertEqual(2, read_output(output_file).count('Dialogue:'))
+
+
+#===================================================
+#  Profile
+#=================================================== 
+    def test_process_comments_when_profile_is_set_returns_same_items_and_counts_matches(self):
+        comments = [make_comment(0, 'a.b'), make_comment(1, 'wwww spam'), make_comment(2, 'bad word'), make_comment(3, 'hi', name='troll', _id='id-B')]
+        ban_lists = chat_to_subtitle.compile_ban_lists(['spam'], ['bad'], ['troll'], [])
+        profile = chat_to_subtitle.Profile()
+        
+        expected = list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists))
+        result = list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists, stats=profile.comments, profile=profile))
+        
+        self.assertEqual(expected, result)
+        self.assertEqual({'user': 1, 'critical_word': 0, 'whole_comment': 1, 'escalated': 0, 'retroactive': 0, 'empty': 0}, profile.bans)
+        self.assertEqual({'.': 1, '[wWｗＷ]{4,}': 1, 'spam': 1}, profile.substitutions)
+        self.assertEqual(4, profile.stages['load']['calls'])
+        self.assertEqual(2, profile.stages['layout']['calls'])
+        
+    def test_process_comments_when_profile_is_set_and_bodies_repeat_counts_each_substitution_and_reports_hit_rate(self):
+        comments = [make_comment(i, ['wwww spam', 'a.b', 'gg'][i % 3], _id=f'id-{i}') for i in range(30)]
+        ban_lists = chat_to_subtitle.compile_ban_lists(['spam'], [], [], [])
+        profile = chat_to_subtitle.Profile()
+        
+        list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists, stats=profile.comments, profile=profile))
+        report = profile.report()
+        
+        self.assertEqual({'.': 10, '[wWｗＷ]{4,}': 10, 'spam': 10}, report['substitutions'])
+        self.assertEqual({'hits': 27, 'misses': 3, 'size': 3, 'hit_rate': 0.9}, report['normalize_cache'])
+        
+    def test_convert_file_when_profile_is_set_returns_json_serializable_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, [make_comment(0, 'a'), make_comment(1, 'b')])
+            output_file = os.path.join(directory, 'chat.ass')
+            profile = chat_to_subtitle.Profile(trace_memory=True)
+            
+            chat_to_subtitle.convert_file(input_file, output_file, None, 0, 0, 854, 480, 36, 7, 'danmakuWhite', profile=profile)
+            result = json.loads(json.dumps(profile.report()))
+            
+        self.assertEqual(2, result['comments']['in_range'])
+        self.assertEqual(2, result['stages']['serialize']['calls'])
+        self.assertEqual(2, sum(lane['comments'] for lane in result['layout']['lane_counts']))
+        self.assertGreater(result['peak_traced_bytes'], 0)
+
+        
+    def test_profile_add_when_memory_is_freed_in_stage_returns_peak_of_stage(self):
+        profile = chat_to_subtitle.Profile(trace_memory=True)
+        profile.start()
+        
+        start = profile.enter()
+        block = bytearray(8 << 20)
+        del block
+        profile.add('load', time.perf_counter() - start)
+        
+        start = profile.enter()
+        profile.add('filter', time.perf_counter() - start)
+        profile.stop()
+        
+        self.assertGreaterEqual(profile.stages['load']['peak_traced_bytes'], 8 << 20)
+        self.assertLess(profile.stages['filter']['peak_traced_bytes'], 1 << 20)
+        self.assertGreaterEqual(profile.peak_traced_bytes, 8 << 20)
+
+
+#===================================================
+#  Moderation (critical_word)
+#=================================================== 
+    def test_process_comments_when_user_writes_critical_word_deletes_later_comments_of_user(self):
+        comments = [make_comment(0, 'before'), make_comment(1, 'boring'), make_comment(2, 'after'), make_comment(3, 'other', name='name-B', _id='id-B')]
+        ban_lists = chat_to_subtitle.compile_ban_lists([], [], [], ['boring'])
+        stats = {}
+        
+        result = [item['message'] for item in chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists, stats=stats)]
         
-        
\ No newline at end of file
+        self.assertEqual(['before', 'other'], result)
+        self.assertEqual(1, stats['deleted_by']['critical_word'])
+        self.assertEqual(1, stats['deleted_by']['escalated'])
+        
+    def test_process_comments_when_retroactive_is_set_deletes_earlier_comments_of_user(self):
+        comments = [make_comment(0, 'before'), make_comment(1, 'other', name='name-B', _id='id-B'), make_comment(2, 'boring'), make_comment(3, 'after')]
+        ban_lists = chat_to_subtitle.compile_ban_lists([], [], [], ['boring'])
+        stats = {}
+        
+        result = [item['message'] for item in chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists, stats=stats, retroactive=True)]
+        
+        self.assertEqual(['other'], result)
+        self.assertEqual(3, stats['deleted'])
+        self.assertEqual(1, stats['deleted_by']['retroactive'])
+        
+    def test_process_comments_when_user_is_banned_by_name_deletes_comments_with_any_id(self):
+        comments = [make_comment(0, 'boring', _id='id-A'), make_comment(1, 'again', _id='id-C')]
+        ban_lists = chat_to_subtitle.compile_ban_lists([], [], [], ['boring'])
+        
+        result = list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists))
+        
+        self.assertEqual([], result)
+        
+    def test_process_comments_when_jobs_is_set_returns_same_as_sequential_with_critical_word(self):
+        comments = [make_comment(i, 'boring' if i == 5 else f'text {i}', name=f'name-{i % 3}', _id=f'id-{i % 3}') for i in range(20)]
+        ban_lists = chat_to_subtitle.compile_ban_lists([], [], [], ['boring'])
+        
+        sequential = list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, ban_lists=ban_lists))
+        
+        result = list(chat_to_subtitle.process_comments(comments, 0, 0, None, 480, 36, jobs=2, ban_lists=ban_lists))
+            
+        self.assertEqual(sequential, result)
+
+
+#===================================================
+#  ResultCache / get_result_key
+#=================================================== 
+    def test_get_result_key_when_ban_file_or_options_change_returns_other_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, [make_comment(0, 'a')])
+            ban_file = os.path.join(directory, 'ban.json')
+            
+            with open(ban_file, mode='w', encoding="utf8") as f:
+                json.dump({'word_only': [], 'whole_comment': [], 'user': [], 'critical_word': []}, f)
+                
+            key = chat_to_subtitle.get_result_key(input_file, None, {'font_size': 36})
+            
+            self.assertEqual(key, chat_to_subtitle.get_result_key(input_file, None, {'font_size': 36}))
+            self.assertNotEqual(key, chat_to_subtitle.get_result_key(input_file, ban_file, {'font_size': 36}))
+            self.assertNotEqual(key, chat_to_subtitle.get_result_key(input_file, None, {'font_size': 24}))
+            
+    def test_get_file_hash_when_file_is_unchanged_returns_memoized_hash_without_reading_it(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chat.json')
+            hash_file = os.path.join(directory, 'cache', 'file_hashes.json')
+            
+            with open(path, mode='w') as f:
+                f.write('aaaa')
+                
+            first = chat_to_subtitle.get_file_hash(path, hash_file)
+            stat = os.stat(path)
+            
+            # Same size and modification time: the content is not read again.
+            with open(path, mode='w') as f:
+                f.write('bbbb')
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            
+            self.assertEqual(first, chat_to_subtitle.get_file_hash(path, hash_file))
+            
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+            self.assertEqual(chat_to_subtitle.get_file_hash(path), chat_to_subtitle.get_file_hash(path, hash_file))
+            self.assertNotEqual(first, chat_to_subtitle.get_file_hash(path, hash_file))
+            
+    def test_result_cache_when_output_is_stored_fetch_copies_it(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = chat_to_subtitle.ResultCache(os.path.join(directory, 'cache'), 1000)
+            output_file = os.path.join(directory, 'chat.ass')
+            copy_file = os.path.join(directory, 'copy.ass')
+            
+            with open(output_file, mode='w', encoding="utf8") as f:
+                f.write('subtitle')
+                
+            missed = cache.fetch('key', copy_file)
+            cache.store('key', output_file)
+            hit = cache.fetch('key', copy_file)
+            
+            with open(copy_file, encoding="utf8") as f:
+                result = f.read()
+                
+        self.assertFalse(missed)
+        self.assertTrue(hit)
+        self.assertEqual('subtitle', result)
+        
+    def test_result_cache_when_size_is_over_limit_removes_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = chat_to_subtitle.ResultCache(os.path.join(directory, 'cache'), 25)
+            output_file = os.path.join(directory, 'chat.ass')
+            
+            with open(output_file, mode='w', encoding="utf8") as f:
+                f.write('1234567890')
+                
+            cache.store('a', output_file)
+            cache.store('b', output_file)
+            os.utime(cache.get_file_name('a'), ns=(1, 1))
+            os.utime(cache.get_file_name('b'), ns=(2, 2))
+            cache.store('c', output_file)
+            
+            result = sorted(os.listdir(cache.directory))
+            
+        self.assertEqual(['b.ass', 'c.ass'], result)
+        
+    def test_result_cache_when_output_is_larger_than_limit_keeps_other_outputs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = chat_to_subtitle.ResultCache(os.path.join(directory, 'cache'), 1000)
+            small_file, large_file = os.path.join(directory, 'small.ass'), os.path.join(directory, 'large.ass')
+            
+            with open(small_file, mode='w', encoding="utf8") as f:
+                f.write('x' * 200)
+                
+            with open(large_file, mode='w', encoding="utf8") as f:
+                f.write('x' * 5000)
+                
+            for key in 'abc':
+                cache.store(key, small_file)
+                
+            cache.store('large', large_file)
+            result = sorted(os.listdir(cache.directory))
+            
+        self.assertEqual(['a.ass', 'b.ass', 'c.ass'], [name for name in result if name.endswith('.ass')])
+
+
+#===================================================
+#  DensityControl
+#=================================================== 
+    def test_get_duplicate_key_when_messages_differ_by_case_punctuation_or_repetition_returns_same_key(self):
+        result = {chat_to_subtitle.get_duplicate_key(message) for message in ['LOL', 'lol!!', 'lol lol lol', 'Lol']}
+        
+        self.assertEqual({'lol'}, result)
+        
+    def test_density_control_when_duplicates_are_in_window_returns_merged_message_with_count(self):
+        density = chat_to_subtitle.DensityControl(dedup_window=5)
+        comments = [(0, 'LOL'), (1, 'hello'), (2, 'lol!'), (4, 'lol'), (6, 'lol')]
+        
+        result = list(density.reduce(iter(comments)))
+        
+        self.assertEqual([(0, 'LOL ×3'), (1, 'hello'), (6, 'lol')], result)
+        self.assertEqual(2, density.merged)
+        
+    def test_density_control_when_second_is_over_cap_returns_cap_comments_in_time_order(self):
+        density = chat_to_subtitle.DensityControl(max_per_second=3)
+        comments = [(i / 10, str(i)) for i in range(10)] + [(1.5, 'next')]
+        
+        result = list(density.reduce(iter(comments)))
+        
+        self.assertEqual(4, len(result))
+        self.assertEqual(sorted(result), result)
+        self.assertEqual((1.5, 'next'), result[-1])
+        self.assertEqual(7, density.rate_limited)
+        
+    def test_density_control_when_screen_is_full_drops_comments_until_one_ends(self):
+        density = chat_to_subtitle.DensityControl(max_on_screen=2, visible_time=7)
+        comments = [(0, 'a'), (1, 'b'), (2, 'c'), (7, 'd')]
+        
+        result = list(density.reduce(iter(comments)))
+        
+        self.assertEqual([(0, 'a'), (1, 'b'), (7, 'd')], result)
+        self.assertEqual(1, density.screen_limited)
+
+
+#===================================================
+#  TextMeasure
+#=================================================== 
+    def test_text_measure_when_message_is_fullwidth_returns_twice_narrow_width(self):
+        measure = chat_to_subtitle.TextMeasure(10)
+        
+        self.assertEqual(6, measure.measure('a'))
+        self.assertEqual(10, measure.measure('あ'))
+        self.assertEqual(10, measure.measure('Ａ'))
+        
+    def test_text_measure_when_message_has_combining_mark_returns_base_width_only(self):
+        measure = chat_to_subtitle.TextMeasure(10)
+        
+        result = measure.measure('e\u0301')
+        
+        self.assertEqual(6, result)
+        
+    def test_text_measure_when_font_advances_are_given_returns_font_widths(self):
+        measure = chat_to_subtitle.TextMeasure(10, {'i': 0.3, 'W': 0.9})
+        
+        result = measure.measure('iW漢')
+        
+        self.assertEqual(22, result)
+        
+    def test_load_font_advances_when_json_table_returns_widths_in_ems(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'font.json')
+            
+            with open(path, mode='w', encoding="utf8") as f:
+                json.dump({'units_per_em': 1000, 'advances': {'a': 500, 'W': 900}}, f)
+                
+            result = chat_to_subtitle.load_font_advances(path)
+            
+        self.assertEqual({'a': 0.5, 'W': 0.9}, result)
+
+
+#===================================================
+#  Output formats
+#=================================================== 
+    def test_validate_formats_when_value_has_unknown_format_raise_BadParameter_error(self):
+        with self.assertRaises(click.exceptions.BadParameter):
+            chat_to_subtitle.validate_formats(None, None, 'ass,mp4')
+            
+    def test_validate_formats_when_value_has_duplicates_returns_formats_once(self):
+        result = chat_to_subtitle.validate_formats(None, None, 'ass, VTT,ass')
+        
+        self.assertEqual(['ass', 'vtt'], result)
+        
+    def test_srt_serializer_when_items_are_formatted_returns_numbered_cues(self):
+        serializer = chat_to_subtitle.SrtSerializer(854, 36, 7, 'danmakuWhite')
+        
+        first = serializer.format({'time': 1.5, 'message': 'a', 'y': 0, 'layer': 2}, 1.5)
+        second = serializer.format({'time': 3661, 'message': 'b', 'y': 0, 'layer': 2}, 3661)
+        
+        self.assertEqual('1\n00:00:01,500 --> 00:00:08,500\na\n\n', first)
+        self.assertEqual('2\n01:01:01,000 --> 01:01:08,000\nb\n\n', second)
+        
+    def test_vtt_serializer_when_message_has_markup_returns_escaped_cue_on_lane_line(self):
+        serializer = chat_to_subtitle.VttSerializer(854, 36, 7, 'danmakuWhite', 480)
+        
+        result = serializer.format({'time': 0, 'message': '<3 & -->', 'y': 240, 'layer': 2}, 0)
+        
+        self.assertEqual('00:00:00.000 --> 00:00:07.000 line:50% align:start\n&lt;3 &amp; --&gt;\n\n', result)
+        
+    def test_output_as_subtitle_when_several_formats_writes_one_valid_file_per_format(self):
+        items = [{'time': 0, 'message': 'a<b', 'y': 0, 'layer': 2}, {'time': 70, 'message': 'c', 'y': 36, 'layer': 2}]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'chat.ass')
+            chat_to_subtitle.output_as_subtitle(iter(items), 854, 480, 36, output_file, 7, 'danmakuRed', 60, formats=['ass', 'vtt', 'xml', 'nico'])
+            
+            result = sorted(os.listdir(directory))
+            
+            bilibili = xml.dom.minidom.parse(os.path.join(directory, 'chat_1.xml'))
+            niconico = xml.dom.minidom.parse(os.path.join(directory, 'chat_nico_2.xml'))
+            
+        self.assertEqual(['chat_1.ass', 'chat_1.vtt', 'chat_1.xml', 'chat_2.ass', 'chat_2.vtt', 'chat_2.xml', 'chat_nico_1.xml', 'chat_nico_2.xml'], result)
+        self.assertEqual('0.000,1,36,16711680,0,0,0,0', bilibili.getElementsByTagName('d')[0].getAttribute('p'))
+        self.assertEqual('a<b', bilibili.getElementsByTagName('d')[0].firstChild.data)
+        self.assertEqual('1000', niconico.getElementsByTagName('chat')[0].getAttribute('vpos'))
+        
+    def test_get_output_file_name_when_extension_is_of_another_format_returns_name_of_format(self):
+        self.assertEqual('chat.vtt', chat_to_subtitle.get_output_file_name('chat.ass', 'vtt'))
+        self.assertEqual('chat_nico.xml.gz', chat_to_subtitle.get_output_file_name('chat.ass.gz', 'nico'))
+        self.assertEqual('danmaku.xml', chat_to_subtitle.get_output_file_name('danmaku.xml', 'nico'))
+        self.assertEqual('chat.txt', chat_to_subtitle.get_output_file_name('chat.txt', 'srt'))
+        self.assertEqual('chat.ass', chat_to_subtitle.get_output_file_name('chat.ass', 'ass'))
+        self.assertEqual('chat.srt', chat_to_subtitle.get_output_file_name('chat.ass', 'srt', several=True))
+        
+    def test_convert_chat_when_single_format_differs_from_output_extension_writes_file_of_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, [make_comment(0, 'a')])
+            output_file = os.path.join(directory, 'chat.ass')
+            
+            for name in ['vtt', 'nico']:
+                chat_to_subtitle.convert_chat.main(['-i', input_file, '-o', output_file, '--format', name, '--cache-dir', os.path.join(directory, 'cache')], standalone_mode=False)
+                
+            result = sorted(name for name in os.listdir(directory) if name != 'cache')
+            
+            with open(os.path.join(directory, 'chat.vtt'), encoding="utf8") as f:
+                vtt = f.read()
+                
+        self.assertEqual(['chat.json', 'chat.vtt', 'chat_nico.xml'], result)
+        self.assertTrue(vtt.startswith('WEBVTT'))
+
+
+#===================================================
+#  convert_variants
+#=================================================== 
+    def test_validate_variants_when_value_is_well_formed_returns_variant(self):
+        result = chat_to_subtitle.validate_variants(None, None, ('1280x720:48:Red:7',))
+        
+        self.assertEqual([{'play_res_x': 1280, 'play_res_y': 720, 'font_size': 48, 'comment_color': 'danmakuRed', 'visible_time': 7}], result)
+        
+    def test_validate_variants_when_color_is_unknown_raise_BadParameter_error(self):
+        with self.assertRaises(click.exceptions.BadParameter):
+            chat_to_subtitle.validate_variants(None, None, ('1280x720:48:Pink:7',))
+            
+    def test_convert_variants_when_jobs_is_set_writes_same_files_as_convert_file(self):
+        comments = [make_comment(i / 4, f'comment {i}') for i in range(200)]
+        variants = chat_to_subtitle.validate_variants(None, None, ('854x480:36:White:7', '1280x720:48:Red:5'))
+        
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, comments)
+            output_file = os.path.join(directory, 'chat.ass')
+            expected = []
+            
+            for variant in variants:
+                single_file = os.path.join(directory, 'single.ass')
+                chat_to_subtitle.convert_file(input_file, single_file, None, 0, 0, variant['play_res_x'], variant['play_res_y'], variant['font_size'], variant['visible_time'], variant['comment_color'])
+                
+                with open(single_file, encoding="utf8") as f:
+                    expected.append(f.read())
+                    
+            chat_to_subtitle.convert_variants(input_file, output_file, None, 0, 0, variants, jobs=2)
+            result = []
+            
+            for name in ['chat_854x480_36_white_7.ass', 'chat_1280x720_48_red_5.ass']:
+                with open(os.path.join(directory, name), encoding="utf8") as f:
+                    result.append(f.read())
+                    
+        self.assertEqual(expected, result)
+
+
+#===================================================
+#  Converter
+#=================================================== 
+    def test_filter_records_when_records_are_of_comments_returns_same_as_filter_comments(self):
+        comments = [make_comment(i, ['aaa', 'abc', 'wwwww.', 'boring', 'x'][i % 5], 'name-' + str(i % 7), str(i % 7)) for i in range(70)]
+        records = [chat_to_subtitle.CommentRecord.from_comment(comment) for comment in comments]
+        ban_lists = chat_to_subtitle.compile_ban_lists(["abc", "[a]+"], ["aaa"], ["1", "name-2"], ["boring"])
+        
+        expected = list(chat_to_subtitle.filter_comments(comments, *ban_lists))
+        result = list(chat_to_subtitle.filter_records(records, *ban_lists))
+        
+        self.assertEqual(expected, result)
+        self.assertEqual({None, 'user', 'critical_word', 'whole_comment', 'empty'}, {category for _, _, category, _ in result})
+        
+    def test_converter_when_comments_are_dicts_or_records_writes_same_file_as_convert_file(self):
+        comments = [make_comment(i / 2, f'comment {i}.', _id=f'id-{i % 5}') for i in range(100)]
+        records = [chat_to_subtitle.CommentRecord.from_comment(comment) for comment in comments]
+        ban_lists = chat_to_subtitle.compile_ban_lists(['comment'], ['7'], ['id-3'], ['99'])
+        converter = chat_to_subtitle.Converter(ban_lists=ban_lists, comment_color='red')
+        
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, comments)
+            expected_file = os.path.join(directory, 'expected.ass')
+            chat_to_subtitle.convert_file(input_file, expected_file, None, 5, 40, 854, 480, 36, 7, 'danmakuRed', ban_lists=ban_lists)
+            
+            results = []
+            for source in [iter(comments), records, converter.load(input_file)]:
+                output_file = os.path.join(directory, 'chat.ass')
+                stats = converter.convert(source, output_file, 5, 40)
+                
+                with open(output_file, encoding="utf8") as f:
+                    results.append(f.read())
+                    
+            with open(expected_file, encoding="utf8") as f:
+                expected = f.read()
+                
+        self.assertEqual([expected] * 3, results)
+        self.assertEqual(71, stats['in_range'])
+        
+    def test_select_record_range_when_records_are_a_record_list_bisects_its_offsets(self):
+        records = chat_to_subtitle.RecordList([make_comment(t, str(t)) for t in [3, 1, 2, 5, 4]])
+        
+        with patch('chat_converter.array') as array:
+            result = chat_to_subtitle.select_record_range(records, 2, 4)
+            
+        array.assert_not_called()
+        self.assertEqual([1, 2, 3, 4, 5], [record.offset for record in records])
+        self.assertEqual(['2', '3', '4'], [record.body for record in result])
+        self.assertEqual(['4', '5'], [record.body for record in chat_to_subtitle.select_record_range(records, 4, 0)])
+        
+    def test_converter_load_when_comments_are_not_sorted_returns_sorted_record_list(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, [make_comment(t, str(t)) for t in [2, 0, 1]])
+            records = chat_to_subtitle.Converter().load(input_file)
+            
+        self.assertIsInstance(records, chat_to_subtitle.RecordList)
+        self.assertEqual([0, 1, 2], list(records.offsets))
+        self.assertEqual(['0', '1', '2'], [record.body for record in records])
+        
+    def test_converter_when_ban_file_is_invalid_raise_ConversionError(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ban_file = os.path.join(directory, 'ban.json')
+            
+            with open(ban_file, mode='w', encoding="utf8") as f:
+                json.dump({'user': []}, f)
+                
+            with self.assertRaises(chat_to_subtitle.ConversionError):
+                chat_to_subtitle.Converter(ban_file)
+                
+    def test_converter_when_input_file_does_not_exist_raise_ConversionError(self):
+        converter = chat_to_subtitle.Converter()
+        
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(chat_to_subtitle.ConversionError):
+                converter.convert_file(os.path.join(directory, 'missing.json'), os.path.join(directory, 'chat.ass'))
+        
+    def test_converter_iter_items_when_stream_is_not_sorted_returns_every_comment_in_range(self):
+        comments = [make_comment(t, f'm{t}') for t in [1, 50, 2, 3]]
+        
+        result = list(chat_to_subtitle.Converter().iter_items(iter(comments), 0, 10))
+        self.assertEqual(['m1', 'm2', 'm3'], [item['message'] for item in result])
+
+
+#===================================================
+#  Compressed files
+#=================================================== 
+    def test_iter_json_comments_when_file_is_gzip_without_extension_returns_comments(self):
+        comments = [make_comment(0, 'a'), make_comment(1, 'b')]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chat')
+            
+            with gzip.open(path, mode='wt', encoding="utf8") as f:
+                json.dump({'comments': comments}, f)
+                
+            result = list(chat_to_subtitle.iter_json_comments(path, chunk_size=8))
+            
+        self.assertEqual(comments, result)
+        
+    def test_iter_json_comments_when_compressed_file_is_truncated_raise_SystemExit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chat.json.xz')
+            
+            with open(path, mode='wb') as f:
+                f.write(lzma.compress(json.dumps({'comments': [make_comment(0, 'a')]}).encode())[:20])
+                
+            with self.assertRaises(SystemExit):
+                list(chat_to_subtitle.iter_json_comments(path))
+                
+    def test_convert_chat_when_follow_output_is_compressed_raise_SystemExit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            feed = os.path.join(directory, 'feed.jsonl')
+            open(feed, mode='w').close()
+            
+            for options in [['-o', os.path.join(directory, 'chat.ass'), '--compress', 'gz'], ['-o', os.path.join(directory, 'chat.ass.xz')]]:
+                with self.assertRaises(SystemExit) as cm:
+                    chat_to_subtitle.convert_chat.main(['-i', feed, '--follow', '--follow-timeout', '1', *options], standalone_mode=False)
+                    
+                self.assertIn('compressed', str(cm.exception.code))
+                
+            self.assertEqual(['feed.jsonl'], os.listdir(directory))
+            
+    def test_output_as_subtitle_when_output_is_compressed_writes_compressed_segments(self):
+        items = [{'time': 0, 'message': 'a', 'y': 0, 'layer': 2}, {'time': 70, 'message': 'b', 'y': 0, 'layer': 2}]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            chat_to_subtitle.output_as_subtitle(iter(items), 854, 480, 36, os.path.join(directory, 'chat.ass.bz2'), 7, 'danmakuWhite', 60)
+            
+            result = sorted(os.listdir(directory))
+            
+            with bz2.open(os.path.join(directory, 'chat_2.ass.bz2'), mode='rt', encoding="utf8") as f:
+                text = f.read()
+                
+        self.assertEqual(['chat_1.ass.bz2', 'chat_2.ass.bz2'], result)
+        self.assertIn('}b\n', text)
+
+
+#===================================================
+#  Vectorized layout and serialization
+#=================================================== 
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_place_batch_when_comments_overflow_returns_same_placements_as_place(self):
+        times = [i / 20 for i in range(400)]
+        widths = [36 * (1 + i * 7 % 25) for i in range(400)]
+        
+        for policy in chat_to_subtitle.LANE_POLICIES:
+            layout = chat_to_subtitle.LaneLayout(854, 180, 36, 7, policy)
+            expected = [layout.place(time, width) for time, width in zip(times, widths)]
+            
+            batch_layout = chat_to_subtitle.LaneLayout(854, 180, 36, 7, policy)
+            start_times, ys, layers, placed = batch_layout.place_batch(numpy.array(times), numpy.array(widths))
+            result = [(time, y, layer) if is_placed else None for time, y, layer, is_placed in zip(start_times.tolist(), ys.tolist(), layers.tolist(), placed.tolist())]
+            
+            self.assertEqual(expected, result, policy)
+            self.assertEqual((layout.placed, layout.dropped, layout.queued), (batch_layout.placed, batch_layout.dropped, batch_layout.queued))
+            
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_measure_batch_when_messages_are_mixed_returns_same_widths_as_measure(self):
+        messages = ['gg', 'かわいい', '', 'Kappa 草', 'e\u0301', 'ｗｗｗ']
+        measure = chat_to_subtitle.TextMeasure(36)
+        
+        result = measure.measure_batch(messages).tolist()
+        self.assertEqual([measure.measure(message) for message in messages], result)
+        
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_format_ass_times_when_times_span_hours_returns_same_as_format_ass_time(self):
+        centiseconds = [0, 5, 99, 100, 6000, 359999, 360000, 3600000, 360005]
+        
+        result = chat_to_subtitle.format_ass_times(numpy.array(centiseconds))
+        self.assertEqual([chat_to_subtitle.format_ass_time(c) for c in centiseconds], result)
+        
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_convert_file_when_vectorize_writes_same_files(self):
+        comments = [make_comment(i / 7, f'comment {i} ' + 'かわいい' * (i % 3), _id=str(i % 5)) for i in range(600)]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            chat_file = write_chat_file(directory, comments)
+            outputs = []
+            
+            for vectorize in [False, True]:
+                output_dir = os.path.join(directory, str(vectorize))
+                os.mkdir(output_dir)
+                
+                with patch('chat_converter.LAYOUT_BATCH_SIZE', 64):
+                    stats = chat_to_subtitle.convert_file(chat_file, os.path.join(output_dir, 'chat.ass'), None, 3, 0, 854, 480, 36, 7, 'danmakuWhite',
+                                                          split_every=20, formats=('ass', 'srt', 'nico'), vectorize=vectorize)
+                    
+                files = {}
+                for name in sorted(os.listdir(output_dir)):
+                    with open(os.path.join(output_dir, name), encoding="utf8") as f:
+                        files[name] = f.read()
+                        
+                outputs.append((stats, files))
+                
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn('chat_5.srt', outputs[1][1])
+
+
+#===================================================
+#  Pipeline
+#=================================================== 
+    def test_convert_file_when_pipeline_writes_same_files(self):
+        comments = [make_comment(i / 3, f'comment {i}', _id=str(i % 7)) for i in range(3000)]
+        
+        with tempfile.TemporaryDirectory() as directory:
+            chat_file = write_chat_file(directory, comments)
+            outputs = []
+            
+            for pipeline in [False, True]:
+                output_dir = os.path.join(directory, str(pipeline))
+                os.mkdir(output_dir)
+                
+                with patch('chat_converter.READ_BUFFER_SIZE', 4096):
+                    stats = chat_to_subtitle.convert_file(chat_file, os.path.join(output_dir, 'chat.ass'), None, 10, 900, 854, 480, 36, 7, 'danmakuWhite', split_every=300, pipeline=pipeline)
+                    
+                files = {}
+                for name in sorted(os.listdir(output_dir)):
+                    with open(os.path.join(output_dir, name), encoding="utf8") as f:
+                        files[name] = f.read()
+                        
+                outputs.append((stats, files))
+                
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(['chat_1.ass', 'chat_2.ass', 'chat_3.ass'], list(outputs[1][1]))
+        
+    def test_convert_file_when_pipeline_input_is_missing_raise_SystemExit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(SystemExit) as cm:
+                chat_to_subtitle.convert_file(os.path.join(directory, 'missing.json'), os.path.join(directory, 'chat.ass'), None, 0, 0, 854, 480, 36, 7, 'danmakuWhite', pipeline=True)
+                
+        self.assertIn('not found', str(cm.exception.code))
+        
+    def test_channel_when_consumer_closes_it_producer_stops(self):
+        channel = chat_to_subtitle.Channel(batch_size=2, queue_size=1)
+        produced = []
+        
+        def produce():
+            for i in range(1000000):
+                produced.append(i)
+                yield i
+                
+        thread = threading.Thread(target=channel.send, args=(produce(),))
+        thread.start()
+        
+        result = []
+        for value in channel:
+            result.append(value)
+            if len(result) == 3:
+                break
+                
+        channel.close()
+        thread.join(timeout=5)
+        
+        self.assertEqual(False, thread.is_alive())
+        self.assertEqual([0, 1, 2], result)
+        self.assertLess(len(produced), 10)
+        
+    def test_run_pipeline_when_a_stage_fails_before_sending_raise_its_error(self):
+        channel = chat_to_subtitle.Channel()
+        received = []
+        
+        def read():
+            sys.exit('Could not read.')
+            
+        with self.assertRaises(SystemExit) as cm:
+            chat_to_subtitle.run_pipeline([(read, None, channel), (lambda: received.extend(channel), channel, None)])
+            
+        self.assertEqual('Could not read.', cm.exception.code)
+        self.assertEqual([], received)
+
+
+#===================================================
+#  Startup
+#=================================================== 
+    def test_chat_converter_when_imported_does_not_import_optional_modules(self):
+        script = 'import sys, chat_converter; print(" ".join(sys.modules))'
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(chat_converter.__file__)), check=True)
+        
+        modules = result.stdout.split()
+        optional = ['asyncio', 'bz2', 'click', 'concurrent.futures', 'gzip', 'hashlib', 'html', 'lzma', 'multiprocessing', 'queue', 'random', 'rich', 'shutil', 'tempfile', 'tracemalloc', 'unicodedata']
+        self.assertEqual([], [module for module in optional if module in modules])
+        
+    def test_chat_to_subtitle_when_imported_does_not_import_engine_until_used(self):
+        script = 'import sys, chat_to_subtitle; print("chat_converter" in sys.modules); chat_to_subtitle.convert_file; print("chat_converter" in sys.modules)'
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(chat_converter.__file__)), check=True)
+        
+        self.assertEqual(['False', 'True'], result.stdout.split())
+        
+        with self.assertRaises(AttributeError):
+            chat_to_subtitle.no_such_function
+        
+    def test_print_when_stdout_is_not_a_terminal_prints_plain_text(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = write_chat_file(directory, [make_comment(0, 'gg wwwwww')])
+            result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(chat_converter.__file__)), 'chat_to_subtitle.py'), '-i', input_file, '-o', os.path.join(directory, 'chat.ass'), '--no-cache', '--profile'], capture_output=True, text=True)
+            
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertIn('Comments in range: 1\n', result.stdout)
+        self.assertIn('  [wWｗＷ]{4,}: 1 substitutions\n', result.stdout)
+        self.assertNotIn('\x1b[', result.stdout)
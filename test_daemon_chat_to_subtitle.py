@@ -0,0 +1,243 @@
+import unittest
+import chat_to_subtitle
+import daemon_chat_to_subtitle
+import json, os, tempfile, threading, time
+from click.testing import CliRunner
+
+
+# Write a chat file with one comment per body, one second apart.
+def write_chat_file(path, bodies):
+    comments = [{'content_offset_seconds': i, 'commenter': {'name': 'name-A', '_id': 'id-A'}, 'message': {'body': body}} for i, body in enumerate(bodies)]
+
+    with open(path, mode='w', encoding="utf8") as f:
+        json.dump({'comments': comments}, f)
+
+
+class TestDaemonChatToSubtitle(unittest.TestCase):
+
+    # Serve a daemon on a socket of a temporary directory during the test.
+    def start_daemon(self, directory, jobs=1, chat_cache_size=256):
+        socket_path = os.path.join(directory, 'daemon.sock')
+        daemon = daemon_chat_to_subtitle.Daemon(jobs, chat_cache_size)
+        server = daemon_chat_to_subtitle.open_server(socket_path, daemon)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            if thread.is_alive():
+                server.shutdown()
+
+            thread.join()
+            server.server_close()
+            daemon.close()
+
+        self.addCleanup(stop)
+        return socket_path, daemon
+
+
+#===================================================
+#  LRUCache
+#===================================================
+    def test_lru_cache_when_max_entries_is_reached_removes_least_recently_used(self):
+        cache = daemon_chat_to_subtitle.LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual([1, None, 3], [cache.get('a'), cache.get('b'), cache.get('c')])
+        self.assertEqual({'entries': 2, 'size': 2, 'hits': 3, 'misses': 1, 'hit_rate': 0.75}, cache.report())
+
+    def test_lru_cache_when_max_size_is_reached_removes_values_until_under_it(self):
+        cache = daemon_chat_to_subtitle.LRUCache(max_size=10)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 4)
+        cache.put('c', 'C', 5)
+        cache.put('d', 'D', 11)
+
+        self.assertEqual([None, 'B', 'C', None], [cache.get(key) for key in 'abcd'])
+        self.assertEqual(9, cache.size)
+
+
+#===================================================
+#  get_percentile
+#===================================================
+    def test_get_percentile_when_values_are_sorted_returns_nearest_rank(self):
+        values = list(range(1, 101))
+
+        self.assertEqual([50, 95, 99, 100], [daemon_chat_to_subtitle.get_percentile(values, p) for p in [50, 95, 99, 100]])
+        self.assertEqual(7, daemon_chat_to_subtitle.get_percentile([7], 99))
+        self.assertEqual(None, daemon_chat_to_subtitle.get_percentile([], 50))
+
+
+#===================================================
+#  Daemon
+#===================================================
+    def test_daemon_when_clip_is_converted_writes_same_file_as_convert_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            write_chat_file(input_file, [f'comment {i}.' for i in range(100)])
+            expected_file = os.path.join(directory, 'expected.ass')
+            chat_to_subtitle.convert_file(input_file, expected_file, None, 10, 40, 854, 480, 48, 7, 'danmakuRed')
+            socket_path, daemon = self.start_daemon(directory)
+
+            output_file = os.path.join(directory, 'clip.ass')
+            request = {'command': 'convert', 'input_file': input_file, 'output_file': output_file, 'start_time': 10, 'end_time': 40, 'options': {'font_size': 48, 'comment_color': 'Red'}}
+            response = daemon_chat_to_subtitle.send_request(socket_path, request)
+
+            self.assertEqual(True, response['ok'], response)
+            self.assertEqual(31, response['stats']['in_range'])
+
+            with open(expected_file, encoding="utf8") as f, open(output_file, encoding="utf8") as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_daemon_when_same_files_are_converted_again_uses_warm_caches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file, ban_file = os.path.join(directory, 'vod.json'), os.path.join(directory, 'ban.json')
+            write_chat_file(input_file, ['hello', 'spam', 'world'])
+
+            with open(ban_file, mode='w', encoding="utf8") as f:
+                json.dump({'word_only': [], 'whole_comment': ['spam'], 'user': [], 'critical_word': []}, f)
+
+            socket_path, daemon = self.start_daemon(directory)
+            requests = [{'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, f'clip{i}.ass'), 'ban_file': ban_file, 'start_time': i} for i in range(3)]
+            responses = daemon_chat_to_subtitle.send_requests(socket_path, requests + [{'command': 'stats'}])
+
+            self.assertEqual([True] * 4, [response['ok'] for response in responses])
+            self.assertEqual([1, 1, 0], [response['stats']['deleted'] for response in responses[:3]])
+
+            stats = responses[3]['stats']
+            self.assertEqual({'hits': 2, 'misses': 1}, {key: stats['caches']['chat_files'][key] for key in ['hits', 'misses']})
+            self.assertEqual(1, stats['caches']['ban_lists']['misses'])
+            self.assertEqual(2, stats['caches']['converters']['hits'])
+            self.assertEqual(3, stats['converted'])
+            self.assertEqual(0, stats['queue_depth'])
+            self.assertEqual(['p50', 'p95', 'p99'], list(stats['latency_seconds']))
+            self.assertGreater(stats['latency_seconds']['p99'], 0)
+
+    def test_daemon_when_chat_file_is_larger_than_cache_streams_it(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            write_chat_file(input_file, [f'comment {i}.' for i in range(100)])
+            expected_file = os.path.join(directory, 'expected.ass')
+            chat_to_subtitle.convert_file(input_file, expected_file, None, 10, 40, 854, 480, 36, 7, 'danmakuWhite')
+            socket_path, daemon = self.start_daemon(directory, chat_cache_size=0)
+
+            requests = [{'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, f'clip{i}.ass'), 'start_time': 10, 'end_time': 40} for i in range(2)]
+            responses = daemon_chat_to_subtitle.send_requests(socket_path, requests)
+
+            self.assertEqual([31, 31], [response['stats']['in_range'] for response in responses])
+
+            with open(expected_file, encoding="utf8") as f, open(os.path.join(directory, 'clip1.ass'), encoding="utf8") as g:
+                self.assertEqual(f.read(), g.read())
+
+            report = daemon.report()
+            self.assertEqual(2, report['streamed'])
+            self.assertEqual(0, report['caches']['chat_files']['entries'])
+            self.assertEqual(1, daemon.streamed_files.hits)
+
+    def test_daemon_when_output_has_extension_of_another_format_writes_file_of_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            write_chat_file(input_file, ['hello'])
+            socket_path, daemon = self.start_daemon(directory)
+
+            request = {'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, 'clip.ass'), 'options': {'format': 'vtt'}}
+            response = daemon_chat_to_subtitle.send_request(socket_path, request)
+
+            self.assertEqual(True, response['ok'], response)
+            self.assertEqual(['clip.vtt', 'daemon.sock', 'vod.json'], sorted(os.listdir(directory)))
+
+    def test_daemon_when_chat_file_changes_converts_new_comments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file, output_file = os.path.join(directory, 'vod.json'), os.path.join(directory, 'clip.ass')
+            write_chat_file(input_file, ['hello'])
+            socket_path, daemon = self.start_daemon(directory)
+            request = {'command': 'convert', 'input_file': input_file, 'output_file': output_file}
+
+            first = daemon_chat_to_subtitle.send_request(socket_path, request)
+            write_chat_file(input_file, ['hello', 'world'])
+            os.utime(input_file, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+            second = daemon_chat_to_subtitle.send_request(socket_path, request)
+
+            self.assertEqual([1, 2], [first['stats']['in_range'], second['stats']['in_range']])
+
+    def test_daemon_when_requests_are_invalid_returns_errors_and_keeps_serving(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            write_chat_file(input_file, ['hello'])
+
+            with open(os.path.join(directory, 'bad.json'), mode='w', encoding="utf8") as f:
+                json.dump({'comments': [{'content_offset_seconds': 0, 'message': {'body': 'no commenter'}}]}, f)
+
+            socket_path, daemon = self.start_daemon(directory)
+            requests = [
+                {'command': 'unknown'},
+                {'command': 'convert', 'input_file': os.path.join(directory, 'missing.json'), 'output_file': os.path.join(directory, 'a.ass')},
+                {'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, 'b.ass'), 'options': {'font': 'Arial'}},
+                {'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, 'c.ass'), 'options': {'font_size': 0}},
+                {'command': 'convert', 'input_file': os.path.join(directory, 'bad.json'), 'output_file': os.path.join(directory, 'd.ass')},
+                {'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, 'e.ass')}
+            ]
+            responses = daemon_chat_to_subtitle.send_requests(socket_path, requests)
+
+            self.assertEqual([False, False, False, False, False, True], [response['ok'] for response in responses])
+            self.assertIn('not found', responses[1]['error'])
+            self.assertIn('font', responses[2]['error'])
+            self.assertIn('KeyError', responses[4]['error'])
+            self.assertEqual(['bad.json', 'daemon.sock', 'e.ass', 'vod.json'], sorted(os.listdir(directory)))
+            self.assertEqual(4, daemon.report()['failed'])
+
+    def test_daemon_when_jobs_are_sent_at_once_queues_them_for_the_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            write_chat_file(input_file, [f'comment {i}' for i in range(2000)])
+            socket_path, daemon = self.start_daemon(directory, jobs=2)
+            results = []
+
+            def convert(i):
+                request = {'command': 'convert', 'input_file': input_file, 'output_file': os.path.join(directory, f'clip{i}.ass')}
+                results.append(daemon_chat_to_subtitle.send_request(socket_path, request)['ok'])
+
+            threads = [threading.Thread(target=convert, args=(i,)) for i in range(6)]
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            report = daemon.report()
+
+        self.assertEqual([True] * 6, results)
+        self.assertEqual({'queue_depth': 0, 'running': 0, 'workers': 2, 'converted': 6}, {key: report[key] for key in ['queue_depth', 'running', 'workers', 'converted']})
+
+
+#===================================================
+#  Client
+#===================================================
+    def test_cli_when_daemon_is_running_converts_prints_stats_and_stops(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'vod.json')
+            write_chat_file(input_file, ['hello', 'world'])
+            socket_path, daemon = self.start_daemon(directory)
+            runner = CliRunner()
+
+            converted = runner.invoke(daemon_chat_to_subtitle.cli, ['convert', '--socket', socket_path, '-i', input_file, '-o', os.path.join(directory, 'clip.srt'), '--format', 'srt', '-s', '0:0:1'])
+            stats = runner.invoke(daemon_chat_to_subtitle.cli, ['stats', '--socket', socket_path])
+            stopped = runner.invoke(daemon_chat_to_subtitle.cli, ['stop', '--socket', socket_path])
+
+            self.assertEqual(0, converted.exit_code, converted.output)
+            self.assertIn('1 comments', converted.output)
+            self.assertEqual(1, json.loads(stats.output)['converted'])
+            self.assertEqual(0, stopped.exit_code, stopped.output)
+
+            with open(os.path.join(directory, 'clip.srt'), encoding="utf8") as f:
+                self.assertIn('world', f.read())
+
+    def test_cli_when_daemon_is_not_running_exits_with_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = CliRunner().invoke(daemon_chat_to_subtitle.cli, ['stats', '--socket', os.path.join(directory, 'daemon.sock')])
+
+            self.assertEqual(1, result.exit_code)
+            self.assertIn('Could not reach the daemon', str(result.exception))
+